@@ -20,7 +20,6 @@ import subprocess
 import re
 import json
 import requests
-import netaddr
 import asfpy.daemon
 import yaml
 import socket
@@ -28,7 +27,8 @@ import time
 import sys
 import argparse
 import syslog
-import copy
+import collections
+import bisect
 
 DEBUG = False
 CONFIG = None
@@ -36,8 +36,18 @@ SYSLOG = None
 MAX_IPTABLES_TRIES = 10
 IPTABLES_EXEC = '/sbin/iptables'
 IP6TABLES_EXEC = '/sbin/ip6tables'
+IPTABLES_RESTORE_EXEC = '/sbin/iptables-restore'
+IP6TABLES_RESTORE_EXEC = '/sbin/ip6tables-restore'
+IPSET_EXEC = '/sbin/ipset'
+IPSET = None # Name prefix of the ban sets, if the ipset backend is enabled
+IPSET_MAXELEM = 1048576
 LAST_UPLOAD = 0
 UPLOAD_FREQUENCY = 180
+FULL_UPLOAD_FREQUENCY = 3600
+LAST_FULL_UPLOAD = 0
+LAST_RULES = None # Our rules as the server last saw them, by (chain, source)
+SYNC_STATE = {} # Per server list: last revision, ETag and entries seen
+SESSION = requests.Session()
 
 def getbans(chain = 'INPUT'):
    """ Gets a list of all bans in a chain """
@@ -74,7 +84,6 @@ def getbans(chain = 'INPUT'):
                   'protocol': protocol,
                   'option': option,
                   'source': source,
-                  'asNet': netaddr.IPNetwork(source),
                   'destination': destination,
                   'extensions': extensions,
                }
@@ -113,7 +122,6 @@ def getbans(chain = 'INPUT'):
                   'protocol': protocol,
                   'option': '---',
                   'source': source,
-                  'asNet': netaddr.IPNetwork(source),
                   'destination': destination,
                   'extensions': extensions,
                }
@@ -122,6 +130,72 @@ def getbans(chain = 'INPUT'):
          break
    return banlist
       
+def getipset():
+   """ Gets a list of all bans in the blocky ipsets """
+   banlist = []
+   for suffix in ('4', '6'):
+      name = IPSET + suffix
+      try:
+         out = subprocess.check_output([IPSET_EXEC, 'save', name], stderr = subprocess.STDOUT)
+      except subprocess.CalledProcessError as err:
+         syslog.syslog(syslog.LOG_WARNING, "Could not list ipset %s: %s" % (name, err.output.strip()))
+         continue
+      for line in out.split("\n"):
+         m = re.match(r'^add\s+\S+\s+([0-9a-f.:/]+)(?:\s+comment\s+"(.*?)")?', line)
+         if m:
+            entry = make_entry(m.group(1), name, m.group(2) or '')
+            entry['ipset'] = name
+            banlist.append(entry)
+   return banlist
+
+def getallbans():
+   """ Gets all bans: the configured iptables chains plus, if enabled, the ipsets """
+   banlist = []
+   ychains = CONFIG.get('iptables', {}).get('chains')
+   chains = ychains if ychains else ['INPUT']
+   for chain in chains:
+      banlist += getbans(chain)
+   if IPSET:
+      banlist += getipset()
+   return banlist
+
+def ipset_setup():
+   """ Creates the blocky ipsets if they don't exist yet, and makes sure
+       the INPUT chains drop anything matching them """
+   for suffix, family, exe in (('4', 'inet', IPTABLES_EXEC), ('6', 'inet6', IP6TABLES_EXEC)):
+      name = IPSET + suffix
+      subprocess.check_call([IPSET_EXEC, 'create', name, 'hash:net', 'family', family,
+                             'maxelem', str(IPSET_MAXELEM), 'comment', '-exist'])
+      if not os.path.exists(exe):
+         continue
+      rule = ['INPUT', '-m', 'set', '--match-set', name, 'src', '-j', 'DROP']
+      if subprocess.call([exe, '-C'] + rule, stderr=open(os.devnull, 'wb')) != 0:
+         subprocess.check_call([exe, '-I'] + rule)
+
+def ipset_restore(bans, unbans):
+   """ Adds and removes any number of IPs/blocks to/from the blocky ipsets
+       in a single 'ipset restore' transaction. Returns true if succeeded """
+   lines = []
+   for ip in unbans:
+      lines.append("del %s%s %s" % (IPSET, '6' if ':' in ip else '4', ip))
+   for ip in bans:
+      lines.append('add %s%s %s comment "Banned by Blocky/2.0"' % (IPSET, '6' if ':' in ip else '4', ip))
+   if not lines:
+      return True
+   if DEBUG:
+      print("Would have applied %u ipset changes here..." % len(lines))
+      return True
+   try:
+      proc = subprocess.Popen([IPSET_EXEC, 'restore', '-exist'], stdin = subprocess.PIPE, stderr = subprocess.PIPE)
+      _, err = proc.communicate("\n".join(lines) + "\n")
+   except OSError as err:
+      print("%s not found or inaccessible: %s" % (IPSET_EXEC, err))
+      return False
+   if proc.returncode != 0:
+      syslog.syslog(syslog.LOG_WARNING, "ipset restore failed: %s" % err.strip())
+      return False
+   return True
+
 def iptables(ip, action):
     """ Runs an iptables action on an IP (-A, -C or -D), returns true if
         succeeded, false otherwise """
@@ -148,10 +222,18 @@ def iptables(ip, action):
 
 def ban(ip):
    """ Bans an IP or CIDR block generically """
+   if IPSET:
+      return ipset_restore([ip], [])
    if iptables(ip, '-A'):
       return True
    return False
 
+def unban(entry):
+   """ Removes a ban as found by getallbans, wherever it lives """
+   if entry.get('ipset'):
+      return ipset_restore([], [entry['source']])
+   return unban_line(entry['source'], entry['linenumber'], chain = entry.get('chain', 'INPUT'))
+
 def unban_line(ip, linenumber, chain = 'INPUT'):
     """ Unbans an IP or block by line number """
     if not linenumber:
@@ -174,52 +256,283 @@ def unban_line(ip, linenumber, chain = 'INPUT'):
         return False
     return True
 
-def inlist(banlist, ip):
-   """ Check if an IP or CIDR is listed in iptables,
+def iptables_restore(bans, unbans):
+   """ Adds and removes any number of iptables bans in a single
+       'iptables-restore --noflush' transaction per address family.
+       Unbans are (chain, ip, linenumber) tuples, in the order they should
+       be removed. Returns true if all transactions succeeded """
+   ok = True
+   for exe, v6 in ((IPTABLES_RESTORE_EXEC, False), (IP6TABLES_RESTORE_EXEC, True)):
+      lines = []
+      for chain, ip, linenumber in unbans:
+         if (':' in ip) == v6:
+            lines.append("-D %s %s" % (chain, linenumber))
+      for ip in bans:
+         if (':' in ip) == v6:
+            lines.append('-A INPUT -s %s -j DROP -m comment --comment "Banned by Blocky/2.0"' % ip)
+      if not lines:
+         continue
+      if DEBUG:
+         print("Would have applied %u %s changes here..." % (len(lines), 'ip6tables' if v6 else 'iptables'))
+         continue
+      # Rules only go in or out if the whole batch for this family does
+      try:
+         proc = subprocess.Popen([exe, '--noflush'], stdin = subprocess.PIPE, stderr = subprocess.PIPE)
+         _, err = proc.communicate("*filter\n%s\nCOMMIT\n" % "\n".join(lines))
+      except OSError as err:
+         print("%s not found or inaccessible: %s" % (exe, err))
+         ok = False
+         continue
+      if proc.returncode != 0:
+         syslog.syslog(syslog.LOG_WARNING, "%s failed: %s" % (exe, err.strip()))
+         ok = False
+   return ok
+
+def apply_changes(bans, unbans):
+   """ Applies a planned set of bans (IPs) and unbans ((entry, linenumber)
+       tuples) to whichever backend holds them. Returns true if succeeded """
+   ok = True
+   bans = [ip for ip in bans if usable_ip(ip)]
+   if IPSET:
+      ok = ipset_restore(bans, [e['source'] for e, ln in unbans if e.get('ipset')])
+      bans = []
+   tounban = [(e['chain'], e['source'], ln) for e, ln in unbans if not e.get('ipset')]
+   return iptables_restore(bans, tounban) and ok
+
+def rule_key(entry):
+   """ Identifies a rule by chain and network, regardless of how the
+       address happens to be spelled """
+   net = parse_cidr(entry['source'])
+   if net:
+      return entry['chain'], net[0], bytes(net[1]), net[2]
+   return entry['chain'], entry['source']
+
+def parse_cidr(ip):
+   """ Parses an IP or CIDR block into (version, address bytes, prefix length),
+       or returns None if it isn't one. Host bits are cleared, so that
+       10.3.1.220/26 comes out as 10.3.1.192/26 """
+   addr, _, plen = ip.strip().partition('/')
+   try:
+      if ':' in addr:
+         version, packed = 6, socket.inet_pton(socket.AF_INET6, addr)
+      else:
+         version, packed = 4, socket.inet_aton(addr)
+      plen = int(plen) if plen else len(packed) * 8
+   except (socket.error, ValueError):
+      return None
+   if not 0 <= plen <= len(packed) * 8:
+      return None
+   octets = bytearray(packed)
+   for i in range(len(octets)):
+      keep = min(max(plen - i * 8, 0), 8)
+      octets[i] &= (0xff00 >> keep) & 0xff
+   return version, octets, plen
+
+def usable_ip(ip):
+   """ Returns an IP or CIDR block from the server with any surrounding
+       whitespace removed, or None (and logs why) if it isn't one or is a /0.
+       One bad entry would otherwise fail the whole batch it is applied in """
+   if not ip:
+      return None
+   net = parse_cidr(ip) if hasattr(ip, 'strip') else None
+   if not net or net[2] == 0:
+      syslog.syslog(syslog.LOG_WARNING, "Ignoring invalid IP or block %r" % ip)
+      return None
+   return ip.strip()
+
+
+class CIDRIndex(object):
+   """ Prefix trie over IPv4 and IPv6 blocks, for finding the entries that
+   contain, or are contained within, an IP or CIDR block without scanning
+   all of them. Entries are dicts with the block in 'source'.
+   
+   The trie branches on one address byte at a time. Each node is a pair of
+   dicts: its children by byte, and the entries whose prefix ends within
+   its byte, keyed by (number of bits, value of those bits). """
+   
+   def __init__(self, entries = ()):
+      self.roots = {4: [{}, {}], 6: [{}, {}]}
+      self.size = 0
+      for entry in entries:
+         self.add(entry)
+   
+   def __len__(self):
+      return self.size
+   
+   def locate(self, net, create = False):
+      """ Walks down to the node holding a block, returns (node, key) """
+      version, octets, plen = net
+      node = self.roots[version]
+      full = (plen - 1) // 8 if plen else 0
+      for byte in octets[:full]:
+         kid = node[0].get(byte)
+         if kid is None:
+            if not create:
+               return None, None
+            kid = node[0][byte] = [{}, {}]
+         node = kid
+      rem = plen - full * 8
+      return node, ((rem, octets[full] >> (8 - rem)) if rem else (0, 0))
+   
+   def add(self, entry):
+      net = parse_cidr(entry['source'])
+      if net:
+         node, key = self.locate(net, True)
+         node[1].setdefault(key, []).append(entry)
+         self.size += 1
+   
+   def remove(self, entry):
+      net = parse_cidr(entry['source'])
+      if net:
+         node, key = self.locate(net)
+         if node and key in node[1]:
+            left = [e for e in node[1][key] if e is not entry]
+            self.size -= len(node[1][key]) - len(left)
+            if left:
+               node[1][key] = left
+            else:
+               del node[1][key]
+   
+   def covering(self, ip, net = None):
+      """ Entries for blocks that contain (or equal) an IP or block """
+      net = net or parse_cidr(ip)
+      if not net or not self.size:
+         return []
+      version, octets, plen = net
+      found = []
+      node = self.roots[version]
+      depth = 0
+      for byte in octets:
+         for (rem, bits), entries in node[1].items():
+            if depth + rem <= plen and (rem == 0 or bits == byte >> (8 - rem)):
+               found.extend(entries)
+         depth += 8
+         if depth >= plen:
+            break
+         node = node[0].get(byte)
+         if node is None:
+            break
+      return found
+   
+   def within(self, ip, net = None):
+      """ Entries for blocks inside (or equal to) an IP or block """
+      net = net or parse_cidr(ip)
+      if not net or not self.size:
+         return []
+      version, octets, plen = net
+      found = []
+      node = self.roots[version]
+      full = plen // 8
+      for i, byte in enumerate(octets[:full]):
+         # A block ending exactly on this byte lives in the parent node. If
+         # the query goes on into the next byte, that block is wider than it.
+         if i == full - 1 and plen % 8 == 0:
+            found.extend(node[1].get((8, byte), []))
+         node = node[0].get(byte)
+         if node is None:
+            return found
+      r = plen - full * 8
+      partial = octets[full] >> (8 - r) if r else 0
+      for (rem, bits), entries in node[1].items():
+         if rem >= r and rem > 0 and bits >> (rem - r) == partial:
+            found.extend(entries)
+      if plen == 0:
+         found.extend(node[1].get((0, 0), []))
+      stack = [kid for byte, kid in node[0].items() if byte >> (8 - r) == partial] if r else list(node[0].values())
+      while stack:
+         kid = stack.pop()
+         for entries in kid[1].values():
+            found.extend(entries)
+         stack.extend(kid[0].values())
+      return found
+   
+   def overlapping(self, ip):
+      """ Entries for blocks that contain, or are within, an IP or block """
+      net = parse_cidr(ip)
+      found = self.covering(ip, net)
+      seen = set(id(e) for e in found)
+      return found + [e for e in self.within(ip, net) if id(e) not in seen]
+
+
+def inlist(index, ip):
+   """ Check if an IP or CIDR is listed in iptables (as indexed by a CIDRIndex),
    either by itself or contained within a block (or the reverse) """
-   lines = []
    if '/0' in ip: # DO NOT WANT
-      return lines
-   # First, check verbatim
-   for entry in banlist:
-      if entry['source'] == ip:
-         lines.append(entry)
-   # Check if block, then check for matches within
+      return []
+   # Block? Then check for matches within
    if '/' in ip:
-      me = netaddr.IPNetwork(ip)
-      for entry in banlist:
-         them = entry['asNet']
-         if them in me:
-            lines.append(entry)
-   
-   # Then the reverse; IP found within blocks?
-   else:
-      me = netaddr.IPAddress(ip)
-      for entry in banlist:
-         if '/' in entry['source'] and '/0' not in entry['source']: # blocks, but not /0
-            them = entry['asNet']
-            if me in them:
-               lines.append(entry)
-   return lines
+      return index.within(ip)
+   # Otherwise, the IP itself or blocks (but not /0) it is found within
+   return [entry for entry in index.covering(ip) if '/0' not in entry['source']]
+
+
+def forget_ban(index, mylist, entry):
+   """ Drops a removed rule from our view of the firewall, renumbering the
+       rules that came after it in the same chain """
+   index.remove(entry)
+   forget_bans(mylist, [entry])
+
+def forget_bans(mylist, entries):
+   """ Drops any number of removed rules from mylist, renumbering the rules
+       that came after them in one pass, rather than one per removal """
+   gone = set(id(e) for e in entries)
+   removed = {} # (chain, v6) -> sorted line numbers that went away
+   for entry in entries:
+      if entry['linenumber'] and not entry.get('ipset'):
+         removed.setdefault((entry['chain'], ':' in entry['source']), []).append(int(entry['linenumber']))
+   for lines in removed.values():
+      lines.sort()
+   mylist[:] = [e for e in mylist if id(e) not in gone]
+   if not removed:
+      return
+   for other in mylist:
+      lines = removed.get((other['chain'], ':' in other['source']))
+      if lines and other['linenumber'] and not other.get('ipset'):
+         linenumber = int(other['linenumber'])
+         before = bisect.bisect_left(lines, linenumber)
+         if before:
+            other['linenumber'] = str(linenumber - before)
+
+
+def make_entry(ip, chain, extensions = '/* Banned by Blocky/2.0 */'):
+   """ Describes a ban we just added, the way getbans would have """
+   return {
+      'chain': chain,
+      'linenumber': None,
+      'action': 'DROP',
+      'protocol': 'all',
+      'option': '--',
+      'source': ip,
+      'destination': '::/0' if ':' in ip else '0.0.0.0/0',
+      'extensions': extensions,
+   }
+
+def banned_entry(ip):
+   """ Describes a ban placed by ban(), the way getallbans would """
+   if IPSET:
+      entry = make_entry(ip, IPSET + ('6' if ':' in ip else '4'))
+      entry['ipset'] = entry['chain']
+      return entry
+   return make_entry(ip, 'INPUT')
 
 
 def note_ban(me, entry):
    apiurl = "%s/note" % CONFIG['server']['apiurl']
    try:
-      requests.post(apiurl, json = {
+      SESSION.post(apiurl, json = {
          'hostname': me,
          'action': 'ban',
          'ip': entry['source'],
          'reason': entry.get('reason', "No reason specified")
       })
-   except request.RequestException:
+   except requests.RequestException:
       pass # If it fails with a http error, it fails - we'll continue anyway
            # Not sure if we should even syslog that..
 
 def note_unban(me, entry):
    apiurl = "%s/note" % CONFIG['server']['apiurl']
    try:
-      requests.post(apiurl, json = {
+      SESSION.post(apiurl, json = {
          'hostname': me,
          'action': 'unban',
          'ip': entry['source'],
@@ -233,11 +546,8 @@ def run_legacy_checks():
    """ Runs checks using the legacy blocky UI server (mod_lua) """
    apiurl = CONFIG['server']['legacyurl']
    actions = []
-   mylist = []
-   ychains = CONFIG.get('iptables', {}).get('chains')
-   chains = ychains if ychains else ['INPUT']
-   for chain in chains:
-      mylist += getbans(chain)
+   mylist = getallbans()
+   myindex = CIDRIndex(mylist)
    print("Found %u bans in iptables" % len(mylist))
    
    try:
@@ -246,7 +556,7 @@ def run_legacy_checks():
    except:
       syslog.syslog(syslog.LOG_WARNING, "Could not retrieve blocky actions list from %s - server down??!" % apiurl)
    
-   whitelist = [] # Things we are unbanning, and thus shouldn't just ban right again
+   whitelist = CIDRIndex() # Things we are unbanning, and thus shouldn't just ban right again
    
    # For each action element, find out what to do, and who to do it to.
    for action in actions:
@@ -258,23 +568,15 @@ def run_legacy_checks():
             ip = action.get('ip')
             if ip:
                ip = ip.strip()
-               block = None
-               if '/' in ip:
-                  block = netaddr.IPNetwork(ip)
-               else:
-                  if ':' in ip:
-                     block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-                  else:
-                     block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-               whitelist.append(block)
-               found = inlist(mylist, ip)
+               whitelist.add({'source': ip})
+               found = inlist(myindex, ip)
                if found:
                   entry = found[0]
                   syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found at line %s as %s)" % (ip, entry['linenumber'], entry['source']))
-                  if not unban_line(ip, found[0]['linenumber']):
+                  if not unban(entry):
                      syslog.syslog(syslog.LOG_WARNING, "Could not remove ban for %s from iptables!" % ip)
                   else:
-                     mylist = getbans() # Refresh after action succeeded
+                     forget_ban(myindex, mylist, entry)
                      
       # Ban request?
       elif 'ip' in action:
@@ -283,132 +585,170 @@ def run_legacy_checks():
             if ip:
                ip = ip.strip() # backwards compat
                banit = True
-               block = None
-               if '/' in ip:
-                  block = netaddr.IPNetwork(ip)
-               else:
-                  if ':' in ip:
-                     block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-                  else:
-                     block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-               for wblock in whitelist:
-                  if block in wblock or wblock in block:
-                     syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
-                     banit = False
+               for wentry in whitelist.overlapping(ip):
+                  syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (ip, wentry['source']))
+                  banit = False
                if banit:
-                  found = inlist(mylist, ip)
+                  found = inlist(myindex, ip)
                   if not found:
                      reason = action.get('reason', "No reason specified")
                      syslog.syslog(syslog.LOG_INFO, "Adding %s to block list; %s" % (ip, reason))
                      if not ban(ip):
                         syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s in iptables!" % ip)
                      else:
-                        mylist = getbans() # Refresh after action succeeded
+                        newentry = banned_entry(ip)
+                        mylist.append(newentry)
+                        myindex.add(newentry)
                         
+def upload_rules(mylist):
+   """ Sends our rules to the server: the full list now and then, and
+       otherwise only what changed since the last upload. Returns true if
+       the server took it """
+   global LAST_RULES, LAST_FULL_UPLOAD
+   apiurl = "%s/myrules" % CONFIG['server']['apiurl']
+   # Copies, as forget_ban renumbers the rules in mylist in place
+   rules = collections.OrderedDict(((e['chain'], e['source']), dict(e)) for e in mylist)
+   try:
+      if LAST_RULES is not None and LAST_FULL_UPLOAD > (time.time() - FULL_UPLOAD_FREQUENCY):
+         js = {
+            'hostname': CONFIG['client']['hostname'],
+            'added': [e for k, e in rules.items() if LAST_RULES.get(k) != e],
+            'removed': [{'chain': k[0], 'source': k[1]} for k in LAST_RULES if k not in rules],
+         }
+         rv = SESSION.patch(apiurl, json = js)
+         if rv.status_code == 200:
+            LAST_RULES = rules
+            return True
+         # Server doesn't do deltas, or lost track of us; send it all
+         syslog.syslog(syslog.LOG_INFO, "Server answered %u to a rule delta, sending full list" % rv.status_code)
+      js = {
+         'hostname': CONFIG['client']['hostname'],
+         'iptables': mylist
+      }
+      rv = SESSION.put(apiurl, json = js)
+      print(rv.status_code)
+      assert(rv.status_code == 200)
+      LAST_RULES = rules
+      LAST_FULL_UPLOAD = time.time()
+      return True
+   except Exception as e:
+      print(e)
+      syslog.syslog(syslog.LOG_WARNING, "Could not send my iptables list to server at %s - server down?" % apiurl)
+   return False
+
+def fetch_list(name):
+   """ Fetches the whitelist or the ban list from the server.
+   
+   Once we have a copy, we ask for what changed since the revision we saw
+   last (?since=) and let the server answer 304 if nothing did (ETag).
+   A server answering with 'added'/'removed' lists gets those applied to our
+   copy; any other answer is taken to be the full list. Returns our copy,
+   or the last known one if the server can't be reached. """
+   state = SYNC_STATE.setdefault(name, {'revision': None, 'etag': None, 'entries': None})
+   url = "%s/%s" % (CONFIG['server']['apiurl'], name)
+   headers = {}
+   params = {}
+   if state['entries'] is not None:
+      if state['etag']:
+         headers['If-None-Match'] = state['etag']
+      if state['revision'] is not None:
+         params['since'] = state['revision']
+   try:
+      rv = SESSION.get(url, headers = headers, params = params)
+      if rv.status_code != 304:
+         rv.raise_for_status()
+         js = rv.json()
+         if params and 'added' in js:
+            for entry in js.get('removed', []):
+               state['entries'].pop((entry.get('ip'), entry.get('target', '*')), None)
+            for entry in js['added']:
+               state['entries'][(entry.get('ip'), entry.get('target', '*'))] = entry
+         else:
+            state['entries'] = collections.OrderedDict(((e.get('ip'), e.get('target', '*')), e) for e in js[name])
+         state['revision'] = js.get('revision')
+         state['etag'] = rv.headers.get('ETag')
+   except Exception as e:
+      syslog.syslog(syslog.LOG_WARNING, "Could not fetch %s entries at %s - server down?" % (name, url))
+   return list(state['entries'].values()) if state['entries'] else []
+
 def run_new_checks():
    """ Runs the blocky process using the modern UI server """
    global LAST_UPLOAD
    
    # First, get our rules and post 'em to the server
-   mylist = []
-   ychains = CONFIG.get('iptables', {}).get('chains')
-   chains = ychains if ychains else ['INPUT']
-   for chain in chains:
-      mylist += getbans(chain)
+   mylist = getallbans()
    print("Found %u bans in iptables" % len(mylist))
    
    if LAST_UPLOAD < (time.time() - UPLOAD_FREQUENCY):
-      try:
-         mylistbare = copy.deepcopy(mylist)
-         for el in mylistbare:
-            del el['asNet']
-         js = {
-            'hostname': CONFIG['client']['hostname'],
-            'iptables': mylistbare
-         }
-         apiurl = "%s/myrules" % CONFIG['server']['apiurl']
-         rv = requests.put(apiurl, json = js)
-         print(rv.status_code)
-         assert(rv.status_code == 200)
+      if upload_rules(mylist):
          LAST_UPLOAD = time.time()
-      except Exception as e:
-         print(e)
-         print(rv.text)
-         syslog.syslog(syslog.LOG_WARNING, "Could not send my iptables list to server at %s - server down?" % apiurl)
 
    # Then, get applicable actions from the server
-   whitelist = []
-   whiteblocks = [] # same as above, but as IPNetwork classes
-   banlist = []
-   try:
-      whiteurl = "%s/whitelist" % CONFIG['server']['apiurl']
-      whitelist = requests.get(whiteurl).json()['whitelist']
-   except:
-      syslog.syslog(syslog.LOG_WARNING, "Could not fetch whitelist entries at %s - server down?" % whiteurl)
-   try:
-      banurl = "%s/bans" % CONFIG['server']['apiurl']
-      banlist = requests.get(banurl).json()['bans']
-   except:
-      syslog.syslog(syslog.LOG_WARNING, "Could not fetch whitelist entries at %s - server down?" % banurl)
+   whiteblocks = CIDRIndex() # same as the whitelist, but indexed
+   whitelist = fetch_list('whitelist')
+   banlist = fetch_list('bans')
+   
+   myindex = CIDRIndex(mylist)
+   
+   # Plan the whole cycle first: changes are collected here and applied in
+   # one transaction per backend and family at the end, instead of one
+   # command per IP
+   unbans = [] # (entry, line number at the time of removal)
+   bans = []
+   removed = []
    
    # First, check if we've banned someone on the whitelist
    for entry in whitelist:
-      ip = entry.get('ip')
+      ip = usable_ip(entry.get('ip'))
       reason = entry.get('reason', 'No reason specified')
       target = entry.get('target', '*')
       if target == '*' or target == CONFIG['client']['hostname']:
          if ip:
-            block = None
-            if '/' in ip:
-               block = netaddr.IPNetwork(ip)
-            else:
-               if ':' in ip:
-                  block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-               else:
-                  block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-            whiteblocks.append(block)
-            found = inlist(mylist, ip)
-            if found:
-               entry = found[0]
-               syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found at line %s as %s)" % (ip, entry['linenumber'], entry['source']))
-               if not unban_line(ip, entry['linenumber'], chain = entry.get('chain', 'INPUT')):
-                  syslog.syslog(syslog.LOG_WARNING, "Could not remove ban for %s from iptables!" % ip)
-               else:
-                  note_unban(CONFIG['client']['hostname'], found[0])
-                  mylist = getbans() # Refresh after action succeeded
+            whiteblocks.add({'source': ip})
+            for fentry in inlist(myindex, ip):
+               syslog.syslog(syslog.LOG_INFO, "Removing %s from block list (found at line %s as %s)" % (ip, fentry['linenumber'], fentry['source']))
+               myindex.remove(fentry)
+               removed.append(fentry)
+   # Removing the highest line numbers first keeps the others where they
+   # are, so the rules can be removed by the line numbers we found them at
+   unbans = [(e, e['linenumber']) for e in sorted(removed, key = lambda e: -int(e['linenumber'] or 0))]
+   forget_bans(mylist, removed)
    
    # Then process bans
    for entry in banlist:
-      ip = entry.get('ip')
+      ip = usable_ip(entry.get('ip'))
       reason = entry.get('reason', 'No reason specified')
       target = entry.get('target', '*')
       if ip:
          if target == '*' or target == CONFIG['client']['hostname']:
             banit = True
-            block = None
-            if '/' in ip:
-               block = netaddr.IPNetwork(ip)
-            else:
-               if ':' in ip:
-                  block = netaddr.IPNetwork("%s/128" % ip) # IPv6
-               else:
-                  block = netaddr.IPNetwork("%s/32" % ip)  # IPv4
-            for wblock in whiteblocks:
-               if block in wblock or wblock in block:
-                  syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (block, wblock))
-                  banit = False
+            for wentry in whiteblocks.overlapping(ip):
+               syslog.syslog(syslog.LOG_WARNING, "%s was requested banned but %s is whitelisted, ignoring ban" % (ip, wentry['source']))
+               banit = False
             if banit:
-               found = inlist(mylist, ip)
+               found = inlist(myindex, ip)
                if not found:
                   reason = entry.get('reason', "No reason specified")
                   syslog.syslog(syslog.LOG_INFO, "Adding %s to block list; %s" % (ip, reason))
-                  if not ban(ip):
-                     syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s in iptables!" % ip)
-                  else:
-                     mylist = getbans() # Refresh after action succeeded
-                     found = inlist(mylist, ip)
-                     if found: # make sure we have it in iptables now
-                        note_ban(CONFIG['client']['hostname'], found[0])
+                  newentry = banned_entry(ip)
+                  newentry['reason'] = reason
+                  bans.append(newentry)
+                  mylist.append(newentry)
+                  myindex.add(newentry)
+   
+   # Apply it all, then check the outcome once
+   if bans or unbans:
+      if not apply_changes([e['source'] for e in bans], unbans):
+         syslog.syslog(syslog.LOG_WARNING, "Could not apply all of %u bans and %u unbans to the firewall!" % (len(bans), len(unbans)))
+      present = set(rule_key(e) for e in getallbans())
+      for entry, linenumber in unbans:
+         if rule_key(entry) not in present:
+            note_unban(CONFIG['client']['hostname'], entry)
+      for entry in bans:
+         if rule_key(entry) in present:
+            note_ban(CONFIG['client']['hostname'], entry)
+         else:
+            syslog.syslog(syslog.LOG_WARNING, "Could not add ban for %s!" % entry['source'])
    # All done for this time!
 
 def psyslog(a,b):
@@ -449,7 +789,7 @@ def base_parser():
 
 
 def start_client():
-   global CONFIG
+   global CONFIG, IPSET
    # Figure out who we are
    me = socket.getfqdn()
    
@@ -460,8 +800,13 @@ def start_client():
    if 'hostname' not in CONFIG['client']:
       CONFIG['client']['hostname'] = me
    
+   # ipset backend?
+   if CONFIG.get('ipset', {}).get('enabled'):
+      IPSET = CONFIG['ipset'].get('name', 'blocky')
+      ipset_setup()
+   
    # Get current list of bans in iptables, upload it to blocky server
-   l = getbans()
+   l = CIDRIndex(getallbans())
    
    args = base_parser().parse_args()
    
@@ -472,9 +817,8 @@ def start_client():
       if found:
          entry = found[0] # Only get the first entry, line numbers will then change ;\
          print("Found a block for %s on line %s in the %s chain (as %s), removing..." % (ip, entry['linenumber'], entry['chain'], entry['source']))
-         if unban_line(entry['linenumber']):
-            print("Refreshing ban list...")
-            l = getbans()
+         if unban(entry):
+            print("Removed.")
       else:
          print("%s wasn't found in iptables, nothing to do" % ip)
       return
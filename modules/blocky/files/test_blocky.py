@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tests for blocky. Run with: python test_blocky.py """
+
+import json
+import os
+import random
+import sys
+import threading
+import unittest
+try:
+   from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+   from urlparse import parse_qsl
+except ImportError:
+   from http.server import BaseHTTPRequestHandler, HTTPServer
+   from urllib.parse import parse_qsl
+
+import netaddr
+
+sys.argv = sys.argv[:1]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import blocky
+
+
+def random_block(rng, version):
+   """ A random block, with host bits possibly set, in a narrow part of the
+       address space so that blocks overlap a lot """
+   if version == 4:
+      addr = netaddr.IPAddress((10 << 24) | (rng.randrange(4) << 16) | rng.getrandbits(16), 4)
+      plen = rng.randrange(8, 33)
+   else:
+      addr = netaddr.IPAddress((0x2001db8 << 96) | (rng.randrange(4) << 80) | rng.getrandbits(80), 6)
+      plen = rng.randrange(32, 129)
+   return "%s/%u" % (addr, plen)
+
+
+class CIDRIndexTest(unittest.TestCase):
+
+   def setUp(self):
+      self.rng = random.Random(1234)
+      self.entries = []
+      for version in (4, 6):
+         for i in range(500):
+            net = netaddr.IPNetwork(random_block(self.rng, version))
+            self.entries.append({'source': str(net.cidr)})
+      # The same block may show up more than once
+      self.entries.extend(dict(e) for e in self.entries[:20])
+      self.index = blocky.CIDRIndex(self.entries)
+      self.nets = [(e, netaddr.IPNetwork(e['source'])) for e in self.entries]
+
+   def check(self, query):
+      q = netaddr.IPNetwork(query)
+      within = [e for e, n in self.nets if n.version == q.version and q.first <= n.first and n.last <= q.last]
+      covering = [e for e, n in self.nets if n.version == q.version and n.first <= q.first and q.last <= n.last]
+      self.assertEqual(sorted(map(id, self.index.within(query))), sorted(map(id, within)), "within(%s)" % query)
+      self.assertEqual(sorted(map(id, self.index.covering(query))), sorted(map(id, covering)), "covering(%s)" % query)
+
+   def test_random_prefixes(self):
+      for version in (4, 6):
+         for i in range(300):
+            self.check(random_block(self.rng, version))
+
+   def test_known_blocks(self):
+      for e in self.entries[:50]:
+         self.check(e['source'])
+
+   def test_partial_byte(self):
+      index = blocky.CIDRIndex([{'source': '10.0.0.0/8'}, {'source': '10.3.1.0/24'}, {'source': '10.3.1.200/30'}])
+      self.assertEqual([e['source'] for e in index.within('10.3.1.220/26')], ['10.3.1.200/30'])
+      self.assertEqual(sorted(e['source'] for e in index.within('10.2.0.0/15')), ['10.3.1.0/24', '10.3.1.200/30'])
+
+   def test_remove(self):
+      for e in self.entries[::3]:
+         self.index.remove(e)
+      self.nets = [x for i, x in enumerate(self.nets) if i % 3]
+      self.entries = [e for e, n in self.nets]
+      self.assertEqual(len(self.index), len(self.entries))
+      for version in (4, 6):
+         for i in range(200):
+            self.check(random_block(self.rng, version))
+
+   def test_host_bits(self):
+      self.assertEqual(blocky.parse_cidr('10.3.1.220/26'), blocky.parse_cidr('10.3.1.192/26'))
+      self.assertEqual(blocky.rule_key({'chain': 'INPUT', 'source': '10.3.1.220/26'}),
+                       blocky.rule_key({'chain': 'INPUT', 'source': '10.3.1.192/26'}))
+      self.assertEqual(blocky.parse_cidr('2001:db8::1/0'), blocky.parse_cidr('::/0'))
+      for i in range(200):
+         query = random_block(self.rng, self.rng.choice((4, 6)))
+         version, octets, plen = blocky.parse_cidr(query)
+         self.assertEqual(bytes(octets), netaddr.IPNetwork(query).network.packed)
+
+   def test_usable_ip(self):
+      self.assertEqual(blocky.usable_ip(' 10.1.2.3\n'), '10.1.2.3')
+      self.assertEqual(blocky.usable_ip('2001:db8::/32 '), '2001:db8::/32')
+      for ip in (None, '', 'example.org', '10.1.2.3/33', '0.0.0.0/0', '::/0', 1234):
+         self.assertEqual(blocky.usable_ip(ip), None, repr(ip))
+
+
+class RuleServer(BaseHTTPRequestHandler):
+   """ Stands in for the blocky server's /myrules, /whitelist and /bans
+       endpoints, noting what it was sent and how it answered """
+   requests = []
+   fetches = [] # (path, If-None-Match, what was sent back)
+   lists = {} # list name -> each revision of it so far
+
+   def handle_upload(self):
+      body = self.rfile.read(int(self.headers['Content-Length']))
+      RuleServer.requests.append((self.command, json.loads(body.decode('utf-8'))))
+      self.send_response(200)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+
+   do_PUT = do_PATCH = handle_upload
+
+   def do_GET(self):
+      path, _, query = self.path.partition('?')
+      name = path.strip('/')
+      revisions = RuleServer.lists[name]
+      current = len(revisions) - 1
+      etag = '"%s-%u"' % (name, current)
+      since = dict(parse_qsl(query)).get('since')
+      if self.headers.get('If-None-Match') == etag:
+         answer, js = 'not modified', None
+      elif since is not None and int(since) <= current:
+         old, new = revisions[int(since)], revisions[current]
+         answer, js = 'delta', {
+            'revision': current,
+            'added': [e for e in new if e not in old],
+            'removed': [e for e in old if e not in new],
+         }
+      else:
+         answer, js = 'full', {'revision': current, name: revisions[current]}
+      RuleServer.fetches.append((self.path, self.headers.get('If-None-Match'), answer))
+      if js is None:
+         self.send_response(304)
+         self.send_header('ETag', etag)
+         self.end_headers()
+         return
+      body = json.dumps(js).encode('utf-8')
+      self.send_response(200)
+      self.send_header('ETag', etag)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+   def log_message(self, *args):
+      pass
+
+
+class ServerTest(unittest.TestCase):
+   """ Runs a RuleServer for blocky to talk to """
+
+   def setUp(self):
+      RuleServer.requests = []
+      RuleServer.fetches = []
+      RuleServer.lists = {}
+      self.server = HTTPServer(('127.0.0.1', 0), RuleServer)
+      thread = threading.Thread(target = self.server.serve_forever)
+      thread.daemon = True
+      thread.start()
+      blocky.CONFIG = {
+         'server': {'apiurl': 'http://127.0.0.1:%u' % self.server.server_port},
+         'client': {'hostname': 'test'},
+      }
+      blocky.LAST_RULES = None
+      blocky.LAST_FULL_UPLOAD = 0
+      blocky.SYNC_STATE = {}
+
+   def tearDown(self):
+      self.server.shutdown()
+      self.server.server_close()
+
+
+class UploadRulesTest(ServerTest):
+
+   def test_renumbered_rules_are_sent(self):
+      mylist = [{'chain': 'INPUT', 'source': '10.0.0.%u' % i, 'linenumber': str(i)} for i in range(1, 4)]
+      index = blocky.CIDRIndex(mylist)
+      self.assertTrue(blocky.upload_rules(mylist))
+      self.assertTrue(blocky.upload_rules(mylist))
+      blocky.forget_ban(index, mylist, mylist[0])
+      self.assertTrue(blocky.upload_rules(mylist))
+      methods = [m for m, js in RuleServer.requests]
+      self.assertEqual(methods, ['PUT', 'PATCH', 'PATCH'])
+      self.assertEqual(RuleServer.requests[1][1]['added'], [])
+      self.assertEqual(RuleServer.requests[1][1]['removed'], [])
+      delta = RuleServer.requests[2][1]
+      self.assertEqual(delta['removed'], [{'chain': 'INPUT', 'source': '10.0.0.1'}])
+      self.assertEqual(sorted((e['source'], e['linenumber']) for e in delta['added']),
+                       [('10.0.0.2', '1'), ('10.0.0.3', '2')])
+
+
+class FetchListTest(ServerTest):
+
+   A = {'ip': '10.0.0.1', 'reason': 'a'}
+   B = {'ip': '10.0.0.2', 'reason': 'b'}
+   C = {'ip': '10.0.0.3', 'reason': 'c'}
+   B_HERE = {'ip': '10.0.0.2', 'reason': 'b, here only', 'target': 'test'}
+
+   def test_full_fetch(self):
+      RuleServer.lists['bans'] = [[self.A, self.B]]
+      self.assertEqual(blocky.fetch_list('bans'), [self.A, self.B])
+      self.assertEqual(RuleServer.fetches, [('/bans', None, 'full')])
+
+   def test_not_modified(self):
+      RuleServer.lists['whitelist'] = [[self.A, self.B]]
+      blocky.fetch_list('whitelist')
+      self.assertEqual(blocky.fetch_list('whitelist'), [self.A, self.B])
+      self.assertEqual(RuleServer.fetches[1], ('/whitelist?since=0', '"whitelist-0"', 'not modified'))
+
+   def test_delta(self):
+      RuleServer.lists['bans'] = [[self.A, self.B]]
+      blocky.fetch_list('bans')
+      RuleServer.lists['bans'].append([self.B, self.C, self.B_HERE])
+      self.assertEqual(blocky.fetch_list('bans'), [self.B, self.C, self.B_HERE])
+      RuleServer.lists['bans'].append([self.C, self.B_HERE])
+      self.assertEqual(blocky.fetch_list('bans'), [self.C, self.B_HERE])
+      self.assertEqual(RuleServer.fetches[1:], [
+         ('/bans?since=0', '"bans-0"', 'delta'),
+         ('/bans?since=1', '"bans-1"', 'delta'),
+      ])
+
+   def test_server_down(self):
+      RuleServer.lists['bans'] = [[self.A]]
+      blocky.fetch_list('bans')
+      self.server.shutdown()
+      self.server.server_close()
+      self.assertEqual(blocky.fetch_list('bans'), [self.A])
+
+
+class ForgetBansTest(unittest.TestCase):
+
+   def test_matches_one_at_a_time(self):
+      rng = random.Random(99)
+      rules = []
+      for chain in ('INPUT', 'FORWARD'):
+         for version in (4, 6):
+            for i in range(1, 60):
+               source = '10.0.%u.%u' % (version, i) if version == 4 else '2001:db8::%x:%x' % (version, i)
+               rules.append({'chain': chain, 'source': source, 'linenumber': str(i)})
+      rules.append({'chain': 'INPUT', 'source': '10.9.9.9', 'linenumber': None, 'ipset': True})
+      batched = [dict(r) for r in rules]
+      single = [dict(r) for r in rules]
+      picks = rng.sample(range(len(rules)), 40)
+      blocky.forget_bans(batched, [batched[i] for i in picks])
+      index = blocky.CIDRIndex(single)
+      for entry in [single[i] for i in picks]:
+         blocky.forget_ban(index, single, entry)
+      self.assertEqual(batched, single)
+
+
+if __name__ == '__main__':
+   unittest.main()
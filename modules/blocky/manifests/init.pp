@@ -11,6 +11,12 @@ class blocky (
 
   require python
   
+  if !defined(Package['ipset']) {
+    package { 'ipset':
+      ensure => present;
+    }
+  }
+
   if !defined(Python::Pip['netaddr']) {
     python::pip {
       'netaddr' :
@@ -1,6 +1,10 @@
 import ConfigParser
+import hashlib
+import json
 import os
 import re
+import tempfile
+import time
 
 import ldap
 
@@ -13,6 +17,126 @@ PGROUP_DN="cn=%(group)s,ou=project,ou=groups,dc=apache,dc=org" # New LDAP tree
 DN_RE=re.compile("uid=([^,]+),ou=people,dc=apache,dc=org")
 SUBPROJECT_RE=re.compile("-.+$")
 
+LDAP_URI = "ldaps://ldap-us-ro.apache.org ldaps://ldap-eu-ro.apache.org"
+LDAP_ATTRS = ["memberUid", "member"]
+
+# Group memberships are cached on disk, shared by all hook processes.
+# Fresh entries are used as is. For CACHE_GRACE seconds after they expire
+# they are still used while a background process refreshes them; after
+# that, LDAP is asked right away, so a revoked committer loses access
+# within CACHE_TTL + CACHE_GRACE. Only if LDAP can't be reached are older
+# entries used, for at most CACHE_MAX_STALE seconds.
+# Groups that don't exist are remembered for a shorter while.
+CACHE_DIR = "/x1/gitbox/db/ldap-cache"
+CACHE_TTL = 300
+CACHE_NEGATIVE_TTL = 60
+CACHE_GRACE = 60
+CACHE_MAX_STALE = 3600
+
+_connection = None
+
+
+def _ldap():
+    """ One LDAP connection per process, however many lookups it does """
+    global _connection
+    if _connection is None:
+        _connection = ldap.initialize(LDAP_URI)
+    return _connection
+
+
+def _search(dn):
+    """ Looks up the members of a group in LDAP. Returns None if there is
+    no such group, and raises if LDAP can't be asked. """
+    global _connection
+    try:
+        results = _ldap().search_s(dn, ldap.SCOPE_BASE, attrlist=LDAP_ATTRS)
+    except ldap.NO_SUCH_OBJECT:
+        return None
+    except ldap.SERVER_DOWN:
+        _connection = None  # try again once, on a new connection
+        results = _ldap().search_s(dn, ldap.SCOPE_BASE, attrlist=LDAP_ATTRS)
+    members = None
+    for ldapresult, attrs in results:
+        members = members or []
+        members += attrs.get("memberUid", [])
+        for result in attrs.get("member", []):
+            match = DN_RE.match(result)
+            if match:
+                members.append(match.group(1))
+    return members
+
+
+def _cache_path(dn, suffix=".json"):
+    return os.path.join(CACHE_DIR, hashlib.sha1(dn).hexdigest() + suffix)
+
+
+def _cache_read(dn):
+    try:
+        with open(_cache_path(dn)) as handle:
+            entry = json.load(handle)
+        if entry.get("dn") == dn:
+            return entry
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _cache_write(dn, members):
+    try:
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix=".tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump({"dn": dn, "time": time.time(), "members": members}, handle)
+        os.rename(tmp, _cache_path(dn))
+    except (IOError, OSError):
+        pass  # No cache this time, then.
+
+
+def _refresh_in_background(dn):
+    """ Refreshes a cache entry from LDAP in a detached process, so nobody
+    has to wait for it. Only one process refreshes a given entry at a time. """
+    global _connection
+    lock = util.trylock(_cache_path(dn, ".lock"))
+    if lock is None:
+        return
+    try:
+        if not util.detach():
+            util.unlock(lock)  # the refreshing process still holds it
+            return
+    except OSError:
+        util.unlock(lock)
+        return
+    try:
+        _connection = None
+        _cache_write(dn, _search(dn))
+    except Exception:
+        pass
+    finally:
+        util.unlock(lock)
+        os._exit(0)
+
+
+def group_members(dn):
+    """ Returns the members of an LDAP group, or None if there is no such
+    group (or LDAP couldn't tell us and we have nothing cached). """
+    entry = _cache_read(dn)
+    if entry:
+        age = time.time() - entry["time"]
+        ttl = CACHE_TTL if entry["members"] is not None else CACHE_NEGATIVE_TTL
+        if age < ttl:
+            return entry["members"]
+        if age < ttl + CACHE_GRACE:
+            _refresh_in_background(dn)
+            return entry["members"]
+    try:
+        members = _search(dn)
+    except Exception:
+        log.exception()
+        if entry and age < CACHE_MAX_STALE:
+            return entry["members"]  # LDAP is down, this beats locking everyone out
+        return None
+    _cache_write(dn, members)
+    return members
+
 
 def authorized_committers(repo_name):
     writers = set()
@@ -28,6 +152,7 @@ def authorized_committers(repo_name):
     # Override LDAP path present in config for repo?
     if parser.has_option("groups", repo_name):
         dn = parser.get("groups", repo_name).strip()
+        pdn = dn
     else:
         # drop subproject name if present
         repo_name = SUBPROJECT_RE.sub("", repo_name)
@@ -45,31 +170,13 @@ def authorized_committers(repo_name):
             writers.add(util.decode(person.strip()))
 
     # Add the committers listed in ldap for the project.
-    lh = ldap.initialize("ldaps://ldap-us-ro.apache.org ldaps://ldap-eu-ro.apache.org")
-    numldap = 0 # ldap entries fetched
-    attrs = ["memberUid", "member"]
     # check new style ldap groups DN first
-    try:
-        for ldapresult, attrs in lh.search_s(pdn, ldap.SCOPE_BASE, attrlist=attrs):
-            numldap += 1
-            for availid in attrs.get("memberUid", []):
-                writers.add(availid)
-            for result in attrs.get("member", []):
-                writers.add(DN_RE.match(result).group(1))
-    except:
-        log.exception()
+    members = group_members(pdn)
 
     # If new style doesn't exist, default to old style DN
-    if numldap == 0:
-        try:
-            for ldapresult, attrs in lh.search_s(dn, ldap.SCOPE_BASE, attrlist=attrs):
-                numldap += 1
-                for availid in attrs.get("memberUid", []):
-                    writers.add(availid)
-                for result in attrs.get("member", []):
-                    writers.add(DN_RE.match(result).group(1))
-        except:
-            log.exception()
+    if members is None and dn != pdn:
+        members = group_members(dn)
+    writers.update(members or [])
 
     # Add per-repository exceptions
     map(writers.add, cfg.extra_writers)
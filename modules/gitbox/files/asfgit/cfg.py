@@ -2,6 +2,7 @@ import ConfigParser
 import os
 import subprocess as sp
 
+import asfgit.context as context
 import asfgit.run as run
 import asfgit.util as util
 
@@ -38,11 +39,18 @@ def _repo_name():
     return util.decode(path)
 
 
+# Under the post-receive dispatcher, the repository state below has
+# already been looked up once for all hooks.
+_context = context.load()
+
 if os.environ.get('GIT_ORIGIN_REPO'):
   os.chdir(os.environ.get('GIT_ORIGIN_REPO'))
-_all_config = dict(c.split('=')
-                   for c in run.git('config', '--list')[1].splitlines()
-                   if c.strip())
+if _context:
+  _all_config = _context['config']
+else:
+  _all_config = dict(c.split('=')
+                     for c in run.git('config', '--list')[1].splitlines()
+                     if c.strip())
 if os.environ.get('GIT_WIKI_REPO'):
   os.chdir(os.environ.get('GIT_WIKI_REPO'))
 
@@ -77,26 +85,31 @@ max_emails = int(_git_config("hooks.asfgit.max-emails"))
 extra_writers = _git_config("hooks.asfgit.extra-writers", default='')
 extra_writers = extra_writers.split(',') if extra_writers != '' else []
 
-# Check if repo is empty
-is_empty = False
-try:
-  is_empty = len(run.git('rev-list', '-n1', '--all')[1].strip()) == 0
-except sp.CalledProcessError as e:  # This will break if repo is empty.
-  is_empty = True
-
-# Whether master branch exists (used for checking if main is default branch)
-has_master_branch = True
-try:
-  run.git('show-ref', 'refs/heads/master')
-except sp.CalledProcessError as e:  # No master branch, exit code 1
-  has_master_branch = False
-
-# Fetch default branch, default to master is repo is bare or has no default yet.
-default_branch = 'master'
-try:
-  default_branch = run.git('symbolic-ref', '--short', 'HEAD')[1].strip()
-except sp.CalledProcessError as e:  # This can break when repo is empty, beware.
-  pass
+if _context:
+  is_empty = _context['is_empty']
+  has_master_branch = _context['has_master_branch']
+  default_branch = _context['default_branch']
+else:
+  # Check if repo is empty
+  is_empty = False
+  try:
+    is_empty = len(run.git('rev-list', '-n1', '--all')[1].strip()) == 0
+  except sp.CalledProcessError as e:  # This will break if repo is empty.
+    is_empty = True
+
+  # Whether master branch exists (used for checking if main is default branch)
+  has_master_branch = True
+  try:
+    run.git('show-ref', 'refs/heads/master')
+  except sp.CalledProcessError as e:  # No master branch, exit code 1
+    has_master_branch = False
+
+  # Fetch default branch, default to master is repo is bare or has no default yet.
+  default_branch = 'master'
+  try:
+    default_branch = run.git('symbolic-ref', '--short', 'HEAD')[1].strip()
+  except sp.CalledProcessError as e:  # This can break when repo is empty, beware.
+    pass
 
 gitpubsub_host = _git_config("hooks.asfgit.pubsub-host", DEFAULT_PUBSUB_HOST)
 gitpubsub_port = _git_config("hooks.asfgit.pubsub-port", DEFAULT_PUBSUB_PORT)
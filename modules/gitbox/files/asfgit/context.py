@@ -0,0 +1,95 @@
+"""
+The push context: what the post-receive hooks all want to know about a
+push (repository config, default branch, ref updates, their commits and
+changed files, and .asf.yaml), worked out once by the post-receive
+dispatcher and handed to every hook through a JSON file named in
+$ASFGIT_PUSH_CONTEXT. Without that variable, everything is looked up
+from git as before.
+"""
+
+import json
+import os
+import StringIO
+import tempfile
+
+ENV = "ASFGIT_PUSH_CONTEXT"
+
+# Pushes bigger than this (e.g. importing a whole repository) don't get
+# their commits in the context; hooks then go to git for them as usual.
+MAX_COMMITS = 10000
+
+_context = None
+_loaded = False
+
+
+def load():
+    """ Returns the context for this push, or None if there isn't one """
+    global _context, _loaded
+    if not _loaded:
+        _loaded = True
+        path = os.environ.get(ENV)
+        if path:
+            try:
+                with open(path) as handle:
+                    _context = json.load(handle)
+            except (IOError, ValueError):
+                _context = None
+    return _context
+
+
+def build(stdin):
+    """ Works out the context for a push, given the ref updates the hooks
+    will get on stdin """
+    import asfgit.cfg as cfg
+    import asfgit.git as git
+    import asfgit.util as util
+
+    context = {
+        "config": cfg._all_config,
+        "is_empty": cfg.is_empty,
+        "has_master_branch": cfg.has_master_branch,
+        "default_branch": cfg.default_branch,
+        "refs": [],
+        "blobs": {},
+    }
+    total = 0
+    for ref in git.stream_refs(StringIO.StringIO(stdin)):
+        entry = {
+            "name": ref.name,
+            "oldsha": ref.oldsha,
+            "newsha": ref.newsha,
+            "commits": None,
+        }
+        if not ref.deleted():
+            spec = "%s:.asf.yaml" % ref.name
+            data = git.blob(spec)
+            context["blobs"][spec] = util.decode(data) if data is not None else None
+            commits = []
+            for commit in ref.commits():
+                total += 1
+                if total > MAX_COMMITS:
+                    commits = None
+                    break
+                parts = [unicode(getattr(commit, key)) for key, _ in git.FIELDS]
+                commits.append({
+                    "sha": commit.sha,
+                    "parts": parts + [commit.stats],
+                    "files": commit.files(),
+                })
+            entry["commits"] = commits
+        context["refs"].append(entry)
+    return context
+
+
+def save(stdin):
+    """ Builds the context for a push and writes it to a temporary file,
+    returning its path. The caller removes it when the hooks are done. """
+    cwd = os.getcwd()  # asfgit.cfg may move us around for wiki repos
+    try:
+        context = build(stdin)
+    finally:
+        os.chdir(cwd)
+    fd, path = tempfile.mkstemp(prefix="asfgit-push-", suffix=".json")
+    with os.fdopen(fd, "w") as handle:
+        json.dump(context, handle)
+    return path
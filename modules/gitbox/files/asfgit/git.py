@@ -1,3 +1,7 @@
+import re
+import subprocess as sp
+
+import asfgit.context as context
 import asfgit.run as run
 import asfgit.util as util
 import asfgit.cfg as cfg
@@ -19,15 +23,98 @@ FIELDS = [
     ("body", "%B")
 ]
 
+# Commits in a 'git log' stream start with their full sha between \x01s,
+# which can't be mistaken for the NUL separated fields or file names
+LOG_MARKER = re.compile(r"\x01([0-9a-f]{40,64})\x01")
+LOG_FORMAT = "--format=format:%%x01%%H%%x01%s%%x00" % r'%x00'.join([s for _, s in FIELDS])
+
+# Files changed per commit sha, filled in a whole commit range at a time
+_files = {}
+
+
+def log(*revs):
+    """ Yields (sha, parts) for every commit in a revision range, from a
+    single 'git log' rather than one 'git show' per commit """
+    args = ["log", "--stat=75", "--cc", "--root", "-z", LOG_FORMAT] + list(revs)
+    chunks = LOG_MARKER.split(run.git(*args, decode=False)[1])
+    for pos in range(1, len(chunks), 2):
+        # The fields, then whatever --stat had to say about the commit
+        parts = chunks[pos + 1].split("\x00", len(FIELDS))
+        parts[-1] = parts[-1].replace("\x00", "\n")
+        yield chunks[pos], map(util.decode, parts)
+
+
+def _load_files(revs):
+    args = ["log", "--name-only", "--cc", "--root", "-z", "--format=format:%x01%H%x01"] + list(revs)
+    chunks = LOG_MARKER.split(run.git(*args, decode=False)[1])
+    for pos in range(1, len(chunks), 2):
+        names = chunks[pos + 1]
+        if names.startswith("\n"):
+            names = names[1:]
+        _files[chunks[pos]] = [util.decode(n) for n in names.split("\x00") if n]
+
+
+class CatFile(object):
+    """ A long-lived 'git cat-file --batch', so any number of objects
+    (e.g. "refs/heads/master:.asf.yaml") can be read with one process """
+
+    def __init__(self):
+        self.proc = None
+
+    def read(self, spec):
+        """ Returns (type, contents) of an object, or None if there's no such thing """
+        if "\n" in spec:
+            return None
+        if self.proc is None:
+            self.proc = sp.Popen(["git", "cat-file", "--batch"], stdin=sp.PIPE, stdout=sp.PIPE)
+        self.proc.stdin.write("%s\n" % spec)
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:  # "<spec> missing" or "<spec> ambiguous"
+            return None
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)  # trailing LF
+        return header[1], data
+
+
+_catfile = CatFile()
+
+
+def blob(spec):
+    """ Returns the raw contents of a file at a given revision, e.g.
+    blob("refs/heads/master:.asf.yaml"), or None if it doesn't exist """
+    ctx = context.load()
+    if ctx and spec in ctx["blobs"]:
+        data = ctx["blobs"][spec]
+        return util.encode(data) if data is not None else None
+    obj = _catfile.read(spec)
+    if obj and obj[0] == "blob":
+        return obj[1]
+    return None
+
+
+_branches = None
+
+
+def branches():
+    """ All branch refs in the repository, looked up once per run """
+    global _branches
+    if _branches is None:
+        args = ["for-each-ref", "--format=%(refname)", "refs/heads/"]
+        _branches = [r.strip() for r in run.git(*args)[1].splitlines() if r.strip()]
+    return _branches
+
 
 class Commit(object):
-    def __init__(self, ref, sha):
+    def __init__(self, ref, sha, parts=None, revs=None):
         self.ref = ref
         self.sha = sha
+        self.revs = revs  # the range this commit was logged from, if any
 
-        fmt = "--format=format:%s%%x00" % r'%x00'.join([s for _, s in FIELDS])
-        args = ["show", "--stat=75", fmt, self.sha]
-        parts = map(util.decode, run.git(*args, decode=False)[1].split("\x00"))
+        if parts is None:
+            fmt = "--format=format:%s%%x00" % r'%x00'.join([s for _, s in FIELDS])
+            args = ["show", "--stat=75", fmt, self.sha]
+            parts = map(util.decode, run.git(*args, decode=False)[1].split("\x00"))
 
         self.stats = u"\n".join(filter(None, parts.pop(-1).splitlines()))
         for pos, (key, _) in enumerate(FIELDS):
@@ -48,8 +135,10 @@ class Commit(object):
         return len(self.parents.split()) > 1
 
     def files(self):
-        files = run.git("show", "--name-only", "--format=format:", self.sha)[1]
-        return [l.strip() for l in files.splitlines() if l.strip()]
+        # Commits from the same range get their files listed in one go
+        if self.sha not in _files:
+            _load_files(self.revs or ["-n", "1", self.sha])
+        return _files.get(self.sha, [])
 
     def diff(self, fname):
         args = ["show", "--format=format:", self.sha, "--", fname]
@@ -95,28 +184,32 @@ class RefUpdate(object):
         # Deleted refs have no commits.
         if self.deleted():
             return
+        # The dispatcher may have listed them for us already
+        for entry in (context.load() or {}).get("refs", []):
+            if (entry["name"], entry["oldsha"], entry["newsha"]) == (self.name, self.oldsha, self.newsha) \
+                    and entry["commits"] is not None:
+                commits = entry["commits"]
+                if num is not None:
+                    commits = commits[:num]
+                if reverse:
+                    commits = commits[::-1]
+                for c in commits:
+                    _files[c["sha"]] = c["files"]
+                    yield Commit(self, c["sha"], list(c["parts"]))
+                return
         # Only report commits that aren't reachable from any other branch
-        refs = []
-        args = ["for-each-ref", "--format=%(refname)"]
-        for r in run.git(*args)[1].splitlines():
-            if r.strip() == self.name:
-                continue
-            if r.strip().startswith("refs/heads/"):
-                refs.append("^%s" % r.strip())
-        args = ["rev-list"]
+        args = []
         if num is not None:
             args += ["-n", str(num)]
         if reverse:
             args.append("--reverse")
         if self.created():
-            args += refs
-        if self.created():
+            args += ["^%s" % r for r in branches() if r != self.name]
             args.append(self.newsha)
         else:
             args.append("%s..%s" % (self.oldsha, self.newsha))
-        for line in run.git(*args)[1].splitlines():
-            sha = line.strip()
-            yield Commit(self, sha)
+        for sha, parts in log(*args):
+            yield Commit(self, sha, parts, args)
 
     def merge_base(self):
         if ("0" * 40) in (self.oldsha, self.newsha):
@@ -2,9 +2,7 @@
 
 import fnmatch
 import io
-import os
 import re
-import subprocess
 import sys
 
 import asfpy.messaging
@@ -58,11 +56,9 @@ def contains(filename, value=None, fnvalue=None):
 
 def get_yaml(filename, refname):
     """ Fetch a yaml file from a specific branch, return its contents to caller as parsed object"""
-    try:
-        devnull = open(os.devnull, "w")
-        fdata = subprocess.check_output(("/usr/bin/git", "show", "%s:%s" % (refname, filename)), stderr=devnull)
-    except subprocess.CalledProcessError as e:  # Git show failure, no such file/branch
-        fdata = None
+    import asfgit.git as git
+
+    fdata = git.blob("%s:%s" % (refname, filename))  # None if no such file/branch
     if fdata:
         try:
             stream = io.BytesIO(fdata)
@@ -1,25 +1,32 @@
 #!/usr/local/bin/python
 
 import json
+import os
 import sys
+import tempfile
 import time
 import requests
 import yaml
-import subprocess
-import os
 
 import asfgit.cfg as cfg
 import asfgit.git as git
 import asfgit.log as log
+import asfgit.util as util
+
+PUBSUB_URL = "http://pubsub.apache.org:2069/git/%s/%s"
+
+# Events are handed to a spool and sent from there by a detached process,
+# so the push doesn't wait on pubsub. Whatever can't be sent stays in the
+# spool and goes out with the next push (unless it has gone stale by then).
+SPOOL_DIR = "/x1/gitbox/db/pubsub-spool"
+SPOOL_LOCK = os.path.join(SPOOL_DIR, ".lock")
+SPOOL_MAX_AGE = 86400
+SEND_TIMEOUT = 10
 
 def has_publishing_via_asfyaml(refname):
     """ Figure out if this branch has a .asf.yaml file with publishing enabled.
         If so, tell gitwcsub to ignore publishing it, so stageD can take over """
-    try:
-        FNULL = open(os.devnull, 'w')
-        ydata = subprocess.check_output(("/usr/bin/git", "show", "%s:.asf.yaml" % refname), stderr = FNULL)
-    except:
-        ydata = ""
+    ydata = git.blob("%s:.asf.yaml" % refname)
     if not ydata:
         return False
     try:
@@ -33,10 +40,10 @@ def has_publishing_via_asfyaml(refname):
     return False
 
 def main():
+    events = []
     for ref in git.stream_refs(sys.stdin):
         rname = ref.name if hasattr(ref, 'name') else "unknown"
-        via_asfyaml = has_publishing_via_asfyaml(rname)
-        send_json({
+        events.append(event({
             "repository": "git",
             "server": "gitbox",
             "project": cfg.repo_name,
@@ -47,9 +54,9 @@ def main():
             "action": "created" if ref.created() else "deleted" if ref.deleted() else "updated",
             "actor": cfg.committer,
             "date": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-        }, "push")    
+        }, "push"))
         if ref.is_tag():
-            send_json({
+            events.append(event({
                 "repository": "git",
                 "server": "gitbox",
                 "project": cfg.repo_name,
@@ -67,13 +74,16 @@ def main():
                 "log": "Create %s" % rname,
                 "body": "",
                 "files": []
-            })
+            }))
+            continue
+        if ref.deleted():
             continue
+        via_asfyaml = has_publishing_via_asfyaml(rname)
         for commit in ref.commits(num=10, reverse=True):
             cfiles = commit.files()
             if len(cfiles) > 1000:
                 cfiles = []  # Crop if payload is too large, prefer dummy payload over nothing.
-            send_json({
+            events.append(event({
                 "autopublish": via_asfyaml,
                 "repository": "git",
                 "server": "gitbox",
@@ -92,13 +102,87 @@ def main():
                 "log": commit.subject,
                 "body": commit.body,
                 "files": cfiles,
-            })
+            }))
+    publish(events)
+
 
+def event(data, key = "commit"):
+    # pubsub.a.o payload
+    return [PUBSUB_URL % (cfg.repo_name, key), json.dumps({key: data})]
 
-def send_json(data, key = "commit"):
+
+def publish(events):
+    """ Spools the events of this push and has them sent in the background.
+    If they can't be spooled, they are sent right away instead. """
+    if not events:
+        return
     try:
-        # pubsub.a.o payload
-        requests.post("http://pubsub.apache.org:2069/git/%s/%s" % (cfg.repo_name, key),
-                      data = json.dumps({key: data}))
-    except:
-        log.exception()
+        fd, path = tempfile.mkstemp(dir=SPOOL_DIR, prefix="%.6f-" % time.time(), suffix=".tmp")
+        with os.fdopen(fd, "w") as handle:
+            json.dump(events, handle)
+        os.rename(path, path[:-4] + ".json")
+    except (IOError, OSError):
+        send(requests.Session(), events)
+        return
+    if util.detach():
+        try:
+            drain()
+        finally:
+            os._exit(0)
+
+
+def send(session, events):
+    """ Sends events in order over one connection. Returns those that
+    couldn't be sent. Events pubsub rejects (4xx) are logged and dropped,
+    as they would only hold up the ones behind them. """
+    for i, (url, payload) in enumerate(events):
+        try:
+            session.post(url, data = payload, timeout = SEND_TIMEOUT).raise_for_status()
+        except requests.HTTPError as err:
+            log.exception()
+            if err.response is None or err.response.status_code >= 500:
+                return events[i:]
+        except:
+            log.exception()
+            return events[i:]
+    return []
+
+
+def drain():
+    """ Sends everything in the spool, oldest first, unless another process
+    is already at it. """
+    session = requests.Session()
+    while True:
+        lock = util.trylock(SPOOL_LOCK)
+        if lock is None:
+            return
+        try:
+            for name in sorted(os.listdir(SPOOL_DIR)):
+                path = os.path.join(SPOOL_DIR, name)
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    if time.time() - os.path.getmtime(path) > SPOOL_MAX_AGE:
+                        raise ValueError("stale")
+                    with open(path) as handle:
+                        events = json.load(handle)
+                except ValueError:
+                    os.unlink(path)
+                    continue
+                unsent = send(session, events)
+                if unsent:
+                    if len(unsent) < len(events):
+                        # Keep the original age, so the events still expire on time
+                        mtime = os.path.getmtime(path)
+                        fd, tmp = tempfile.mkstemp(dir=SPOOL_DIR, suffix=".tmp")
+                        with os.fdopen(fd, "w") as handle:
+                            json.dump(unsent, handle)
+                        os.utime(tmp, (mtime, mtime))
+                        os.rename(tmp, path)
+                    return  # pubsub is unwell; the next push will try again
+                os.unlink(path)
+        finally:
+            util.unlock(lock)
+        # Events spooled while we held the lock have nobody else to send them
+        if not any(n.endswith(".json") for n in os.listdir(SPOOL_DIR)):
+            return
@@ -1,4 +1,3 @@
-import pipes
 import subprocess as sp
 
 import asfgit.util as util
@@ -21,9 +20,7 @@ def cmd(comm, input=None, capture=False, decode=True, check=True, **kwargs):
     return (exitcode, stdout, stderr)
 
 def git(comm, *args, **kwargs):
-    gcomm = ["git", comm] + list(args)
-    gcomm = ' '.join(map(lambda a: pipes.quote(str(a)), gcomm))
-    kwargs["shell"] = True
+    gcomm = ["git", comm] + map(str, args)
     if "capture" not in kwargs:
         kwargs["capture"] = True
     return cmd(gcomm, **kwargs)
@@ -1,3 +1,4 @@
+import fcntl
 import os
 
 
@@ -24,3 +25,48 @@ def abort(mesg):
     assert isinstance(mesg, unicode), "String encoding error."
     print mesg.encode("utf-8")
     exit(1)
+
+
+def detach():
+    """ Forks off a process that outlives the hook without holding on to
+    its stdio, which git would otherwise wait for. Returns True in that
+    process, which must end with os._exit(), and False in the caller. """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return False
+    try:
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+    except Exception:
+        os._exit(1)
+    return True
+
+
+def trylock(path):
+    """ Takes an exclusive lock on a lock file, unless another process holds
+    it. Returns the descriptor to pass to unlock(), or None. The lock goes
+    away with the process holding it, so a dead one can't leave it behind. """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_WRONLY, 0o640)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+    return fd
+
+
+def unlock(fd):
+    """ Lets go of a lock from trylock(). A process forked while holding it
+    shares the lock, and keeps it until it lets go as well. """
+    try:
+        os.close(fd)
+    except OSError:
+        pass
@@ -6,9 +6,9 @@ if not os.environ.get("ASFGIT_ADMIN"):
     sys.exit(1)
 sys.path.append(os.environ["ASFGIT_ADMIN"])
 import yaml
-import subprocess
 import asfpy.messaging
 import asfgit.cfg as cfg
+import asfgit.git as git
 import asfgit.asfyaml
 
 #DEFAULT_CONTACT = 'team@infra.apache.org'
@@ -30,11 +30,7 @@ def get_yaml():
     if not line:
         return
     [oldrev, newrev, refname] = line.split()
-    try:
-        FNULL = open(os.devnull, 'w')
-        ydata = subprocess.check_output(("/usr/bin/git", "show", "%s:.asf.yaml" % refname), stderr = FNULL)
-    except:
-        ydata = ""
+    ydata = git.blob("%s:.asf.yaml" % refname)
     if not ydata:
         return
     try:
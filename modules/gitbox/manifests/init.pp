@@ -101,6 +101,16 @@ $pbcsPwd  = ''
       owner  => 'www-data',
       group  => 'www-data',
       mode   => '0750';
+    '/x1/gitbox/db/ldap-cache':
+      ensure => directory,
+      owner  => 'www-data',
+      group  => 'www-data',
+      mode   => '0750';
+    '/x1/gitbox/db/pubsub-spool':
+      ensure => directory,
+      owner  => 'www-data',
+      group  => 'www-data',
+      mode   => '0750';
     '/x1/gitbox/db/backups':
       ensure => directory,
       owner  => 'www-data',
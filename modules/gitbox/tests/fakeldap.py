@@ -0,0 +1,35 @@
+""" A stand-in for the python-ldap module, serving groups from memory.
+Tests put it in sys.modules as "ldap" before importing asfgit.auth. """
+
+SCOPE_BASE = 0
+
+
+class LDAPError(Exception):
+    pass
+
+
+class NO_SUCH_OBJECT(LDAPError):
+    pass
+
+
+class SERVER_DOWN(LDAPError):
+    pass
+
+
+groups = {}     # DN -> attributes of the group entry
+down = False    # whether the server is unreachable
+searches = []   # DNs looked up, in order
+
+
+class Connection(object):
+    def search_s(self, dn, scope, attrlist=None):
+        searches.append(dn)
+        if down:
+            raise SERVER_DOWN()
+        if dn not in groups:
+            raise NO_SUCH_OBJECT()
+        return [(dn, groups[dn])]
+
+
+def initialize(uri):
+    return Connection()
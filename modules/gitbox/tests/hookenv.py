@@ -0,0 +1,46 @@
+""" Sets up the environment asfgit.cfg expects when it runs as a hook (a
+push context, and the variables the git HTTP backend passes on), so
+that tests can import the asfgit modules. Import this before them. """
+
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+ROOT = tempfile.mkdtemp(prefix="asfgit-test-")
+atexit.register(shutil.rmtree, ROOT, True)
+REPO_DIR = os.path.join(ROOT, "test.git")
+os.mkdir(REPO_DIR)
+
+CONTEXT = {
+    "config": {
+        "hooks.asfgit.debug": "false",
+        "hooks.asfgit.protect": "",
+        "hooks.asfgit.no-merges": "false",
+        "hooks.asfgit.sendmail": "/bin/true",
+        "hooks.asfgit.recips": "",
+        "hooks.asfgit.max-size": "1000000",
+        "hooks.asfgit.max-emails": "100",
+    },
+    "is_empty": False,
+    "has_master_branch": True,
+    "default_branch": "master",
+}
+with open(os.path.join(ROOT, "context.json"), "w") as handle:
+    json.dump(CONTEXT, handle)
+
+os.environ.update({
+    "ASFGIT_PUSH_CONTEXT": os.path.join(ROOT, "context.json"),
+    "PATH_INFO": "/test.git",
+    "GIT_PROJECT_ROOT": ROOT,
+    "GIT_COMMITTER_NAME": "tester",
+    "GIT_COMMITTER_EMAIL": "tester@example.org",
+    "SCRIPT_NAME": "test",
+    "WEB_HOST": "https://gitbox.example.org",
+    "WRITE_LOCK": os.path.join(ROOT, "nocommit"),
+    "AUTH_FILE": os.path.join(ROOT, "auth.cfg"),
+})
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "files"))
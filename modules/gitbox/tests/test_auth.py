@@ -0,0 +1,92 @@
+""" Tests for the LDAP group membership cache, against a stand-in for
+LDAP. Run with: python test_auth.py """
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import hookenv
+import fakeldap
+sys.modules["ldap"] = fakeldap
+import asfgit.auth as auth
+import asfgit.log as log
+
+GROUP = "cn=test,ou=project,ou=groups,dc=apache,dc=org"
+MISSING = "cn=missing,ou=project,ou=groups,dc=apache,dc=org"
+
+
+class GroupMembersTest(unittest.TestCase):
+
+    def setUp(self):
+        auth.CACHE_DIR = tempfile.mkdtemp(dir=hookenv.ROOT)
+        auth._connection = None
+        fakeldap.groups = {GROUP: {
+            "memberUid": ["alice"],
+            "member": ["uid=bob,ou=people,dc=apache,dc=org", "cn=other,ou=groups,dc=apache,dc=org"],
+        }}
+        fakeldap.down = False
+        fakeldap.searches = []
+        self.exceptions = 0
+        self.log_exception = log.exception
+        log.exception = self.count_exception
+
+    def tearDown(self):
+        log.exception = self.log_exception
+        shutil.rmtree(auth.CACHE_DIR)
+
+    def count_exception(self):
+        self.exceptions += 1
+
+    def cache(self, dn, members, age):
+        """ Puts an entry of the given age in the cache """
+        with open(auth._cache_path(dn), "w") as handle:
+            json.dump({"dn": dn, "time": time.time() - age, "members": members}, handle)
+
+    def cached(self, dn):
+        return auth._cache_read(dn)["members"]
+
+    def test_fresh(self):
+        self.assertEqual(auth.group_members(GROUP), ["alice", "bob"])
+        self.assertEqual(auth.group_members(GROUP), ["alice", "bob"])
+        self.assertEqual(fakeldap.searches, [GROUP])
+
+    def test_grace_period(self):
+        self.cache(GROUP, ["carol"], auth.CACHE_TTL + auth.CACHE_GRACE / 2)
+        self.assertEqual(auth.group_members(GROUP), ["carol"])
+        # Refreshed by a detached process
+        deadline = time.time() + 10
+        while self.cached(GROUP) == ["carol"] and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.cached(GROUP), ["alice", "bob"])
+
+    def test_negative(self):
+        self.assertEqual(auth.group_members(MISSING), None)
+        self.assertEqual(auth.group_members(MISSING), None)
+        self.assertEqual(fakeldap.searches, [MISSING])
+        # Forgotten after the negative TTL, when the group may exist by now
+        self.cache(MISSING, None, auth.CACHE_NEGATIVE_TTL + auth.CACHE_GRACE + 1)
+        fakeldap.groups[MISSING] = {"memberUid": ["dave"]}
+        self.assertEqual(auth.group_members(MISSING), ["dave"])
+
+    def test_expired(self):
+        self.cache(GROUP, ["carol"], auth.CACHE_TTL + auth.CACHE_GRACE + 1)
+        self.assertEqual(auth.group_members(GROUP), ["alice", "bob"])
+        self.assertEqual(fakeldap.searches, [GROUP])
+        self.assertEqual(self.cached(GROUP), ["alice", "bob"])
+
+    def test_ldap_down(self):
+        fakeldap.down = True
+        self.cache(GROUP, ["carol"], auth.CACHE_TTL + auth.CACHE_GRACE + 1)
+        self.assertEqual(auth.group_members(GROUP), ["carol"])
+        self.cache(GROUP, ["carol"], auth.CACHE_MAX_STALE + 1)
+        self.assertEqual(auth.group_members(GROUP), None)
+        self.assertEqual(auth.group_members(MISSING), None)
+        self.assertEqual(self.exceptions, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
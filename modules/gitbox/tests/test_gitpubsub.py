@@ -0,0 +1,101 @@
+""" Tests for the gitpubsub hook's spool, against a local stand-in for
+pubsub. Run with: python test_gitpubsub.py """
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import hookenv
+import asfgit.hooks.gitpubsub as gitpubsub
+
+
+class PubSub(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Takes events like pubsub does, except that it rejects those posted
+    to a path with "reject" in it, and fails those with "fail" in it. """
+    received = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        PubSub.received.append((self.path, json.loads(body)))
+        status = 413 if "reject" in self.path else 503 if "fail" in self.path else 200
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        PubSub.received = []
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), PubSub)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%u" % self.server.server_port
+        self.spool = tempfile.mkdtemp(dir=hookenv.ROOT)
+        gitpubsub.SPOOL_DIR = self.spool
+        gitpubsub.SPOOL_LOCK = os.path.join(self.spool, ".lock")
+        gitpubsub.PUBSUB_URL = self.url + "/git/%s/%s"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.spool)
+
+    def spooled(self):
+        return sorted(n for n in os.listdir(self.spool) if n.endswith(".json"))
+
+    def spool_file(self, name, paths, age=0):
+        path = os.path.join(self.spool, name)
+        with open(path, "w") as handle:
+            json.dump([[self.url + p, json.dumps({"n": p})] for p in paths], handle)
+        then = time.time() - age
+        os.utime(path, (then, then))
+        return path
+
+    def test_publish_delivers_in_order(self):
+        events = [gitpubsub.event({"n": i}) for i in range(5)]
+        gitpubsub.publish(events)
+        # Sent by a detached process; wait for it to empty the spool
+        deadline = time.time() + 10
+        while self.spooled() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.spooled(), [])
+        self.assertEqual([body["commit"]["n"] for path, body in PubSub.received], range(5))
+        self.assertEqual(set(path for path, body in PubSub.received), set(["/git/test/commit"]))
+
+    def test_partial_failure_keeps_the_rest(self):
+        path = self.spool_file("1.json", ["/a", "/b", "/fail", "/c"], age=500)
+        self.spool_file("2.json", ["/d"])
+        gitpubsub.drain()
+        self.assertEqual([p for p, body in PubSub.received], ["/a", "/b", "/fail"])
+        self.assertEqual(self.spooled(), ["1.json", "2.json"])
+        with open(path) as handle:
+            self.assertEqual([url for url, payload in json.load(handle)], [self.url + "/fail", self.url + "/c"])
+        self.assertAlmostEqual(time.time() - os.path.getmtime(path), 500, delta=5)
+
+    def test_stale_files_are_dropped(self):
+        self.spool_file("1.json", ["/old"], age=gitpubsub.SPOOL_MAX_AGE + 60)
+        self.spool_file("2.json", ["/new"])
+        gitpubsub.drain()
+        self.assertEqual([p for p, body in PubSub.received], ["/new"])
+        self.assertEqual(self.spooled(), [])
+
+    def test_rejected_events_are_dropped(self):
+        self.spool_file("1.json", ["/a", "/reject", "/b"])
+        self.spool_file("2.json", ["/c"])
+        gitpubsub.drain()
+        self.assertEqual([p for p, body in PubSub.received], ["/a", "/reject", "/b", "/c"])
+        self.assertEqual(self.spooled(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
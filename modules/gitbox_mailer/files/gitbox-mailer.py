@@ -17,6 +17,9 @@
 """ Staging/live web site pubsubber for ASF git repos """
 import asfpy.messaging
 import asfpy.pubsub
+import concurrent.futures
+import heapq
+import itertools
 import uuid
 import git
 import os
@@ -33,6 +36,11 @@ import requests
 # Defaults and settings
 PUBSUB_URL = 'http://pubsub.apache.org:2069/github'  # Subscribe to github events only
 PUBSUB_QUEUE = {}
+PUBSUB_DEADLINES = []  # Heap of (deadline, seq, key) for the events in PUBSUB_QUEUE
+QUIET_PERIOD = 5  # Events (and streams of review comments) are sent once quiet for this long
+EPOCH_INTERVAL = 30  # How often to record our progress in epoch.dat
+MAIL_WORKERS = 4
+JIRA_WORKERS = 4
 ROOT_DIRS = ['/x1/repos/asf', '/x1/repos/private', '/x1/repos/svn']
 SCHEME_FILE = 'notifications.yaml'
 FALLBACK_ADDRESS = 'team@infra.apache.org'
@@ -62,6 +70,25 @@ RE_PROJECT = re.compile(r"(?:incubator-)?([^-]+)")
 RE_JIRA_TICKET = re.compile(r"\b([A-Z0-9]+-\d+)\b")
 
 TLOCK = threading.Lock()
+PUBSUB_READY = threading.Condition(TLOCK)
+PUBSUB_SEQ = itertools.count()
+
+# Emails and JIRA updates are sent by their own workers, so a slow JIRA doesn't hold up mail
+MAIL_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=MAIL_WORKERS)
+JIRA_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=JIRA_WORKERS)
+JIRA_SESSIONS = threading.local()
+
+
+def jira_session():
+    """ Returns this thread's JIRA session, keeping its connection alive between calls """
+    session = getattr(JIRA_SESSIONS, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.auth = JIRA_AUTH
+        session.headers.update(JIRA_HEADERS)
+        JIRA_SESSIONS.session = session
+    return session
+
 
 ####################################################
 def jira_update_ticket(ticket, txt, worklog=False):
@@ -77,10 +104,8 @@ def jira_update_ticket(ticket, txt, worklog=False):
             'comment': txt
         }
 
-    rv = requests.post(
+    rv = jira_session().post(
         "https://issues.apache.org/jira/rest/api/latest/issue/%s/%s" % (ticket, where),
-        headers=JIRA_HEADERS,
-        auth=JIRA_AUTH,
         json=data
     )
     if rv.status_code == 200 or rv.status_code == 201:
@@ -103,10 +128,8 @@ def jira_remote_link(ticket, url, prno):
                 }
             }
         }
-    rv = requests.post(
+    rv = jira_session().post(
         "https://issues.apache.org/jira/rest/api/latest/issue/%s/remotelink" % ticket,
-        headers=JIRA_HEADERS,
-        auth=JIRA_AUTH,
         json=data
         )
     if rv.status_code == 200 or rv.status_code == 201:
@@ -123,10 +146,8 @@ def jira_add_label(ticket):
             ]
         }
     }
-    rv = requests.put(
+    rv = jira_session().put(
         "https://issues.apache.org/jira/rest/api/latest/issue/%s" % ticket,
-        headers=JIRA_HEADERS,
-        auth=JIRA_AUTH,
         json=data
     )
     if rv.status_code == 200 or rv.status_code == 201:
@@ -135,41 +156,71 @@ def jira_add_label(ticket):
         raise Exception(rv.text)
 
 
+# Notification schemes and compiled templates, kept until their files change
+SCHEME_CACHE = {}   # repo -> (file stamps, scheme)
+TEMPLATE_CACHE = {} # template file -> (file stamp, compiled template)
+
+
+def file_stamp(path):
+    """ Returns something that changes when a file does, or None if it is missing """
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size, st.st_ino
+    except OSError:
+        return None
+
+
+def get_scheme(repo):
+    """ Returns the notification scheme for a repo, from its notifications.yaml
+    and git config. Parsed once, then reused until either file changes. """
+    repo_path = None
+    for root_dir in ROOT_DIRS:
+        if os.path.exists(os.path.join(root_dir, "%s.git" % repo)):
+            repo_path = os.path.join(root_dir, "%s.git" % repo)
+            break
+    if not repo_path:
+        return {}
+    scheme_path = os.path.join(repo_path, SCHEME_FILE)
+    cfg_path = os.path.join(repo_path, 'config')
+    stamps = (repo_path, file_stamp(scheme_path), file_stamp(cfg_path))
+    cached = SCHEME_CACHE.get(repo)
+    if cached and cached[0] == stamps:
+        return cached[1]
+
+    scheme = {}
+    # Check for notifications.yaml first
+    if stamps[1]:
+        try:
+            scheme = yaml.safe_load(open(scheme_path))
+        except:
+            pass
+
+    # Check standard git config
+    cfg = git.GitConfigParser(cfg_path)
+    if not 'commits' in scheme:
+        scheme['commits'] = cfg.get("hooks.asfgit", "recips") or FALLBACK_ADDRESS
+    if cfg.has_option('apache', 'dev'):
+        default_issue = cfg.get("apache", "dev")
+        if not 'issues' in scheme:
+            scheme['issues'] = default_issue
+        if not 'pullrequests' in scheme:
+            scheme['pullrequests'] = default_issue
+    if cfg.has_option('apache', 'jira'):
+        default_jira = cfg.get("apache", "jira")
+        if not 'jira_options' in scheme:
+            scheme['jira_options'] = default_jira
+    SCHEME_CACHE[repo] = (stamps, scheme)
+    return scheme
+
+
 def get_recipient(repo, itype, action):
     """ Finds the right email recipient for a repo and an action. """
-    scheme = {}
     m = RE_PROJECT.match(repo)
     if m:
         project = m.group(1)
     else:
         project = 'infra'
-    for root_dir in ROOT_DIRS:
-        repo_path = os.path.join(root_dir, "%s.git" % repo)
-        if os.path.exists(repo_path):
-            # Check for notifications.yaml first
-            scheme_path = os.path.join(repo_path, SCHEME_FILE)
-            if os.path.exists(scheme_path):
-                try:
-                    scheme = yaml.safe_load(open(scheme_path))
-                except:
-                    pass
-
-            # Check standard git config
-            cfg_path = os.path.join(repo_path, 'config')
-            cfg = git.GitConfigParser(cfg_path)
-            if not 'commits' in scheme:
-                scheme['commits'] = cfg.get("hooks.asfgit", "recips") or FALLBACK_ADDRESS
-            if cfg.has_option('apache', 'dev'):
-                default_issue = cfg.get("apache", "dev")
-                if not 'issues' in scheme:
-                    scheme['issues'] = default_issue
-                if not 'pullrequests' in scheme:
-                    scheme['pullrequests'] = default_issue
-            if cfg.has_option('apache', 'jira'):
-                default_jira = cfg.get("apache", "jira")
-                if not 'jira_options' in scheme:
-                    scheme['jira_options'] = default_jira
-            break
+    scheme = get_scheme(repo)
 
     if scheme:
         if itype not in ['commit', 'jira']:
@@ -193,6 +244,17 @@ def get_recipient(repo, itype, action):
     return "dev@%s.apache.org" % project
 
 
+def get_template(template):
+    """ Returns a compiled EZT template, compiling it again only if the file changed """
+    stamp = file_stamp(template)
+    cached = TEMPLATE_CACHE.get(template)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    compiled = ezt.Template(template, compress_whitespace=0)
+    TEMPLATE_CACHE[template] = (stamp, compiled)
+    return compiled
+
+
 class Event:
     def __init__(self, key, data):
         self.key = key
@@ -208,6 +270,7 @@ class Event:
         self.subject = None
         self.message = None
         self.updated = time.time()
+        self.deadline = self.updated + QUIET_PERIOD
         self.payload['reviews'] = None
 
         if data.get('filename'):
@@ -219,11 +282,12 @@ class Event:
             self.payload['reviews'] = []
         self.payload['reviews'].append(Helper(data))
         self.updated = time.time()
+        self.deadline = self.updated + QUIET_PERIOD
 
     def format_message(self, template = DEFAULT_TEMPLATE):
         self.payload['action_text'] = EMAIL_SUBJECTS.get(self.action, EMAIL_SUBJECTS['comment']) % self.payload
         self.subject = "[GitHub] [%(repo)s] %(user)s %(action_text)s #%(id)i: %(title)s" % self.payload
-        template = ezt.Template(template, compress_whitespace=0)
+        template = get_template(template)
         fp = io.StringIO()
         template.generate(fp, self.payload)
         self.message = fp.getvalue()
@@ -280,22 +344,25 @@ class Event:
             raise Exception("Could not send email: " + str(e))
 
     def process(self):
-        global LAST_CALL
+        """ Formats the message and hands it to the email and JIRA workers """
         no_children = len(self.payload.get('reviews', []) or [])
         print("Processing %s (%u sub-item(s))..." % (self.key, no_children))
         try:
             self.format_message()
-            self.send_email()
-            self.notify_jira()
         except Exception as e:
             print("Could not dispatch message: " + str(e))
+            return
+        MAIL_POOL.submit(self.mail)
+        if self.title and RE_JIRA_TICKET.search(self.title):
+            JIRA_POOL.submit(self.notify_jira)
+
+    def mail(self):
+        global LAST_CALL
         try:
-            LAST_CALL = int(time.time())
-            with open("epoch.dat", "w") as f:
-                f.write(str(LAST_CALL))
-                f.close()
-        except:
-            pass
+            self.send_email()
+        except Exception as e:
+            print("Could not dispatch message: " + str(e))
+        LAST_CALL = int(time.time())
 
 class Helper(object):
   def __init__(self, xhash):
@@ -306,24 +373,40 @@ class Actor(threading.Thread):
         threading.Thread.__init__(self)
 
     def run(self):
-        """ Copy queue, clear it and run each item """
+        """ Send out each event as soon as it has been quiet for QUIET_PERIOD seconds,
+            and now and then note how far we got in epoch.dat """
+        checkpoint = LAST_CALL
+        next_checkpoint = time.time() + EPOCH_INTERVAL
         while True:
-            QUEUE_COPY = {}
-            with TLOCK:
-                QUEUE_COPY = PUBSUB_QUEUE.copy()
-            for key, event_object in QUEUE_COPY.items():
-                now = time.time()
-                if now - event_object.updated > 5:
-                    try:
-                        with TLOCK:
+            due = []
+            with PUBSUB_READY:
+                while True:
+                    now = time.time()
+                    while PUBSUB_DEADLINES and PUBSUB_DEADLINES[0][0] <= now:
+                        deadline, seq, key = heapq.heappop(PUBSUB_DEADLINES)
+                        event_object = PUBSUB_QUEUE.get(key)
+                        # Events that got more comments since have a later deadline further down the heap
+                        if event_object and event_object.deadline == deadline:
                             del PUBSUB_QUEUE[key]
-                    except:
-                        print("[ERROR] Could not prune pubsub queue - double free?")
+                            due.append(event_object)
+                    if due or now >= next_checkpoint:
+                        break
+                    wake = min(PUBSUB_DEADLINES[0][0], next_checkpoint) if PUBSUB_DEADLINES else next_checkpoint
+                    PUBSUB_READY.wait(wake - now)
+            for event_object in due:
+                try:
+                    event_object.process()
+                except Exception as e:
+                    print("[WARNING] Could not process payload: %s" % e)
+            if time.time() >= next_checkpoint:
+                next_checkpoint = time.time() + EPOCH_INTERVAL
+                if LAST_CALL != checkpoint:
                     try:
-                        event_object.process()
-                    except Exception as e:
-                        print("[WARNING] Could not process payload: %s" % e)
-            time.sleep(10)
+                        checkpoint = LAST_CALL
+                        with open("epoch.dat", "w") as f:
+                            f.write(str(checkpoint))
+                    except:
+                        pass
 
 
 def process(js):
@@ -338,11 +421,13 @@ def process(js):
     # If not a file review, we don't want to fold...
     if 'filename' not in js:
         key += str(uuid.uuid4())
-    with TLOCK:
+    with PUBSUB_READY:
         if key not in PUBSUB_QUEUE:
             PUBSUB_QUEUE[key] = Event(key, js)
         else:
             PUBSUB_QUEUE[key].add(js)
+        heapq.heappush(PUBSUB_DEADLINES, (PUBSUB_QUEUE[key].deadline, next(PUBSUB_SEQ), key))
+        PUBSUB_READY.notify()
 
 if __name__ == '__main__':
     if DEBUG:
@@ -24,13 +24,21 @@ import subprocess
 import json
 import re
 import sqlite3
+import threading
 import time
+import collections
 import asfpy.messaging
-import contextlib
 import yaml
 import requests
 
-SEEN = []
+# The gitbox database, see Database below
+DB = None
+ASFID_TTL = 600
+
+# Webhooks already acted on, see Seen below
+SEEN = None
+SEEN_MAXAGE = 7 * 86400
+SEEN_MAXSIZE = 100000
 
 # GitHub -> GitBox code sync    
 def parse_payload(config, data):
@@ -79,26 +87,16 @@ def parse_payload(config, data):
         wikiurl = "https://github.com/apache/%s.wiki.git" % repo
         # If we don't have the wiki.git yet, clone it
         if not os.path.exists(wikipath):
-            os.chdir(config['wikipath'])
-            subprocess.check_output(['git','clone', '--mirror', wikiurl, wikipath])
+            subprocess.check_output(['git','clone', '--mirror', wikiurl, wikipath], cwd=config['wikipath'])
     
-        # chdir to wiki git, pull in changes
-        os.chdir(wikipath)
-        subprocess.check_output(['git','fetch'])
+        # pull in changes to the wiki git
+        subprocess.check_output(['git','fetch'], cwd=wikipath)
     
         ########################
         # Get ASF ID of pusher #
         ########################
-        asfid = "unknown"
         pusher = data['sender']['login']
-        conn = sqlite3.connect(config['database'])
-        cursor = conn.cursor()
-        cursor.execute("SELECT asfid FROM ids WHERE githubid=? COLLATE NOCASE", (pusher, ))
-        row = cursor.fetchone()
-        # Found it, yay!
-        if row:
-            asfid = row[0]
-        conn.close()
+        asfid = DB.asfid(pusher) or "unknown"
     
         # Ready the hook env
         gitenv = {
@@ -117,14 +115,14 @@ def parse_payload(config, data):
         }
         for page in data['pages']:
             after = page['sha']
-            before = subprocess.check_output(["git", "rev-list", "--parents", "-n", "1", after]).strip().split(' ')[1]
+            before = subprocess.check_output(["git", "rev-list", "--parents", "-n", "1", after], cwd=wikipath).strip().split(' ')[1]
             update = "%s %s refs/heads/master\n" % (before if before != after else EMPTY_HASH, after)
     
             # Fire off the multimail hook for the wiki
             try:
                 hook = "/x1/gitbox/hooks/post-receive"
                 # Fire off the email hook
-                process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv)
+                process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv, cwd=wikipath)
                 out, err = process.communicate(input=update)
                 log += out
                 log += "[%s] [%s]: Multimail deployed (%s -> %s)!\n" % (time.strftime("%c"), wikipath, before, after)
@@ -144,12 +142,13 @@ def parse_payload(config, data):
         after = data.get('after', EMPTY_HASH)
         
         # GitHub may send duplicate webhooks for the same push (for reasons unknown!), so dedup here.
+        # A push only counts as seen once it has been acted on (see the end of this branch),
+        # so one that failed, or was cut short by a restart, is done again when SQS redelivers it.
+        seen_hash = None
         if reponame and ref and before and after:
             seen_hash = "%s-%s-%s-%s" % (reponame, ref, before, after)  # kibble-newbranch-0000000000000000-fa676777662783462 or such
-            if seen_hash in SEEN:
+            if SEEN.check(seen_hash):
                 return
-            else:
-                SEEN.append(seen_hash)
         
         force_diff = False
         merge_from_fork = False
@@ -184,16 +183,9 @@ def parse_payload(config, data):
         if pusher != 'asfgit' and repopath and os.path.exists(repopath):
 
             # Figure out who pushed:
-            with contextlib.closing(sqlite3.connect(config['database'])) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT asfid FROM ids WHERE githubid=? COLLATE NOCASE", (pusher, ))
-                row = cursor.fetchone()
-
-
-            if row:
-                asfid = row[0]                
+            asfid = DB.asfid(pusher)
             # Didn't find it, time to notify!!
-            else:
+            if not asfid:
                 asfid = "(unknown)"
                 if '[bot]' not in pusher: # If not internal GitHub bot, complain!
                     # Send an email to users@infra.a.o with the bork
@@ -213,21 +205,13 @@ def parse_payload(config, data):
             #######################################
             if before and before != EMPTY_HASH:
                 try:
-                    with contextlib.closing(sqlite3.connect(config['database'])) as conn:
-                        cursor = conn.cursor()
-                        # First, check the db for pushes we have
-                        cursor.execute("SELECT id FROM pushlog WHERE new=?", (before, ))
-                        foundOld = cursor.fetchone()
-                        if not foundOld:
-                            # See if we've ever gotten any push logs for this repo, or if this is a first
-                            tcursor = conn.cursor() # make a temp cursor, try fetching one row
-                            tcursor.execute("SELECT id FROM pushlog WHERE repository=?", (reponame, ))
-                            foundAny = tcursor.fetchone()
-                            if foundAny:
-                                raise Exception("Could not find previous push (??->%s) in push log!" % before)
+                    # First, check the db for pushes we have
+                    if not DB.fetchone("SELECT id FROM pushlog WHERE new=? LIMIT 1", (before, )):
+                        # See if we've ever gotten any push logs for this repo, or if this is a first
+                        if DB.fetchone("SELECT id FROM pushlog WHERE repository=? LIMIT 1", (reponame, )):
+                            raise Exception("Could not find previous push (??->%s) in push log!" % before)
                     # Then, be doubly sure by doing cat-file on the old rev (AFTER sqlite is closed)
-                    os.chdir(repopath)
-                    subprocess.check_call(['git','cat-file','-e', before])
+                    subprocess.check_call(['git','cat-file','-e', before], cwd=repopath)
                 except Exception as errmsg:
                     # Send an email to users@infra.a.o with the bork
                     asfpy.messaging.mail(
@@ -245,12 +229,9 @@ def parse_payload(config, data):
             # Write Push log, text + sqlite3 #
             ##################################
             try:
-                with contextlib.closing(sqlite3.connect(config['database'], timeout = 15)) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute("""INSERT INTO pushlog
+                DB.execute("""INSERT INTO pushlog
                               (repository, asfid, githubid, baseref, ref, old, new, date)
                               VALUES (?,?,?,?,?,?,?,DATETIME('now'))""", (reponame, asfid, pusher, baseref, ref, before, after, ))
-                    conn.commit()
             # If sqlite borks, let infra know...but keep syncing
             except sqlite3.Error as e:
                 txt = e.args[0]
@@ -278,8 +259,6 @@ def parse_payload(config, data):
             ####################
             log = "[%s] [%s.git]: Got a sync call for %s.git, pushed by %s\n" % (time.strftime("%c"), reponame, reponame, asfid)
     
-            # Change to repo dir
-            os.chdir(repopath)
             # Run 'git fetch --prune' (fetch changes, prune away branches no longer present in remote)
             rv = True
             i = 0
@@ -289,6 +268,7 @@ def parse_payload(config, data):
                 i += 1
                 time.sleep(2)
                 p = subprocess.Popen(["git", "fetch", "--prune"],
+                    cwd=repopath,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE)
                 output,error = p.communicate()
@@ -346,38 +326,217 @@ def parse_payload(config, data):
                     update = "%s %s %s\n" % (before if before != after else EMPTY_HASH, after, ref)
     
                     try:
-                        # Change to repo dir
-                        os.chdir(repopath)
-    
                         # Fire off the email hook
-                        process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv)
+                        process = subprocess.Popen([hook], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=gitenv, cwd=repopath)
                         process.communicate(input=update)
                         log += "[%s] [%s.git]: Multimail deployed!\n" % (time.strftime("%c"), reponame)
     
                     except Exception as err:
                         log += "[%s] [%s.git]: Multimail hook failed: %s\n" % (time.strftime("%c"), reponame, err)
                 open(config['logfile'], "a").write(log)
+        
+        if seen_hash:
+            SEEN.record(seen_hash)
     
 
+class Database(object):
+    """ The gitbox database, on one connection kept open for the life of
+    the poller (so sqlite can keep its statements prepared), shared by the
+    worker threads. GitHub->ASF ID lookups are cached for a while. """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout = 15, check_same_thread = False)
+        self.ids = {} # lowercased github id -> (asf id, when looked up)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            # Looking up the parent of a push has to be quick, however long the log gets
+            self.conn.execute("CREATE INDEX IF NOT EXISTS pushlog_new ON pushlog (new)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS pushlog_repository ON pushlog (repository)")
+            self.conn.commit()
+
+    def fetchone(self, query, args = ()):
+        with self.lock:
+            return self.conn.execute(query, args).fetchone()
+
+    def fetchall(self, query, args = ()):
+        with self.lock:
+            return self.conn.execute(query, args).fetchall()
+
+    def execute(self, query, args = ()):
+        with self.lock:
+            try:
+                self.conn.execute(query, args)
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+
+    def asfid(self, githubid):
+        """ Returns the ASF ID linked to a GitHub ID, or None if there isn't one """
+        key = githubid.lower()
+        cached = self.ids.get(key)
+        if cached and cached[1] > time.time() - ASFID_TTL:
+            return cached[0]
+        row = self.fetchone("SELECT asfid FROM ids WHERE githubid=? COLLATE NOCASE", (githubid, ))
+        if not row:
+            return None # Not cached, so a newly linked account is picked up right away
+        self.ids[key] = (row[0], time.time())
+        return row[0]
+
+
+class Seen(object):
+    """ Remembers which webhooks we have seen, for up to `maxage` seconds
+    and no more than `maxsize` of them, keeping a copy in the database so
+    a restart doesn't forget them. Also counts how often each one came. """
+
+    def __init__(self, db, maxage, maxsize):
+        self.db = db
+        self.maxage = maxage
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # hash -> [first seen, hits], oldest first
+        self.received = 0
+        self.duplicates = 0
+        try:
+            self.db.execute("""CREATE TABLE IF NOT EXISTS webhooks
+                               (hash TEXT PRIMARY KEY, seen REAL, hits INTEGER)""")
+            self.db.execute("CREATE INDEX IF NOT EXISTS webhooks_seen ON webhooks (seen)")
+            rows = self.db.fetchall("SELECT hash, seen, hits FROM webhooks WHERE seen > ? ORDER BY seen DESC LIMIT ?",
+                                    (time.time() - self.maxage, self.maxsize))
+            for key, seen, hits in reversed(rows):
+                self.entries[key] = [seen, hits]
+        except sqlite3.Error as e:
+            print("Could not load seen webhooks: %s" % e)
+
+    def check(self, key):
+        """ Returns how many times a webhook was seen (and acted on) before """
+        with self.lock:
+            self.received += 1
+            entry = self.entries.get(key)
+            if entry:
+                entry[1] += 1
+                self.duplicates += 1
+                print("Dropping duplicate webhook %s (seen %u times; %u of %u webhooks were duplicates)" % (
+                    key, entry[1], self.duplicates, self.received))
+                self.store("UPDATE webhooks SET hits=? WHERE hash=?", (entry[1], key))
+                return entry[1] - 1
+            return 0
+
+    def record(self, key):
+        """ Records a webhook once it has been acted on """
+        now = time.time()
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = [now, 1]
+            expired = False
+            while self.entries:
+                oldest, (seen, hits) = next(iter(self.entries.items()))
+                if seen > now - self.maxage and len(self.entries) <= self.maxsize:
+                    break
+                del self.entries[oldest]
+                expired = True
+            self.store("INSERT OR REPLACE INTO webhooks (hash, seen, hits) VALUES (?,?,1)", (key, now))
+            if expired:
+                self.store("DELETE FROM webhooks WHERE seen < ?", (next(iter(self.entries.values()))[0], ))
+
+    def store(self, query, args):
+        try:
+            self.db.execute(query, args)
+        except sqlite3.Error as e:
+            print("Could not record seen webhook: %s" % e)
+
+
+def payload_repository(data):
+    """ Returns the repository a payload is about, or None if it can't tell """
+    try:
+        if 'pages' in data:
+            return "%s.wiki" % data['repository']['name']
+        return data['repository']['name']
+    except (KeyError, TypeError):
+        return None
+
+
+class Workers(object):
+    """ A pool of threads processing payloads. Payloads for different
+    repositories are processed at the same time, those for the same
+    repository one after the other, in the order they were received.
+    Each payload is removed from the queue as soon as it is done. """
+
+    def __init__(self, config, count):
+        self.config = config
+        self.lock = threading.Lock()
+        self.lanes = {}  # repository -> payloads waiting their turn
+        self.inflight = set()  # ids of payloads queued or being processed
+        self.ready = collections.deque()  # repositories with a payload up next
+        self.wakeup = threading.Condition(self.lock)
+        for i in range(count):
+            thread = threading.Thread(target = self.work)
+            thread.daemon = True
+            thread.start()
+
+    def add(self, payload):
+        """ Queues a payload, unless it is already queued or in progress """
+        with self.lock:
+            if payload['id'] in self.inflight:
+                return
+            self.inflight.add(payload['id'])
+            repository = payload_repository(payload['payload'])
+            if repository is None:
+                repository = payload['id'] # Not tied to a repository, gets a lane of its own
+            if repository in self.lanes:
+                self.lanes[repository].append(payload)
+            else:
+                self.lanes[repository] = collections.deque([payload])
+                self.ready.append(repository)
+                self.wakeup.notify()
+
+    def work(self):
+        while True:
+            with self.lock:
+                while not self.ready:
+                    self.wakeup.wait()
+                repository = self.ready.popleft()
+                payload = self.lanes[repository][0]
+            self.process(payload)
+            with self.lock:
+                self.inflight.discard(payload['id'])
+                lane = self.lanes[repository]
+                lane.popleft()
+                if lane:
+                    self.ready.append(repository)
+                    self.wakeup.notify()
+                else:
+                    del self.lanes[repository]
+
+    def process(self, payload):
+        try:
+            parse_payload(self.config, payload['payload'])
+            print("Processed %s, removing from queue..." % payload['id'][:31])
+            rv = requests.get("%s?id=%s" % (self.config['sqs_url_delete'], payload['id'])).text
+            print(rv)
+        except Exception as e:
+            print("Payload %s failed to process, putting back in queue for now" % payload['id'][:31])
+
+
 # Spawn thread, detach and return
 def main():
+    global DB, SEEN
     config = yaml.load(open('gitbox-poller.yaml'))
+    DB = Database(config['database'])
+    SEEN = Seen(DB, config.get('seen_maxage', SEEN_MAXAGE), config.get('seen_maxsize', SEEN_MAXSIZE))
     # Forever fetch items and process them...
     SQS_URL_GET = "%s/get" % config['sqs_api']
-    SQS_URL_DELETE = "%s/delete" % config['sqs_api']
+    config['sqs_url_delete'] = "%s/delete" % config['sqs_api']
+    workers = Workers(config, config.get('workers', 8))
     while True:
         try:
             payloads = requests.get(SQS_URL_GET).json()['payloads']
         except:
             payloads = []
         for payload in payloads:
-            try:
-                parse_payload(config, payload['payload'])
-                print("Processed %s, removing from queue..." % payload['id'][:31])
-                rv = requests.get("%s?id=%s" % (SQS_URL_DELETE, payload['id'])).text
-                print(rv)
-            except Exception as e:
-                print("Payload %s failed to process, putting back in queue for now" % payload['id'][:31])
+            workers.add(payload)
         # If we had payloads, don't sleep too long. Otherwise, do sleep long
         if payloads:
             time.sleep(1)
@@ -2,6 +2,7 @@ from threading import Thread
 import json, urllib.request, urllib.parse, configparser, re, base64, sys, os, time, atexit, signal, logging, subprocess, collections, argparse, grp, pwd, shutil
 from threading import Lock
 import threading;
+import concurrent.futures
 from collections import namedtuple
 import random, atexit, signal, inspect
 import time
@@ -31,6 +32,7 @@ logger.addHandler(log_handler)
 logger.setLevel(logging.INFO)
 
 pending = {}
+tracking = {} # (project, branch) -> [(path, repo), ...], see compileTracking
 
 
 
@@ -153,85 +155,168 @@ class Daemonize:
 		start() or restart()."""
 
 
+# Updates run in parallel, but never two at a time for the same path
+UPDATE_WORKERS = int(config.get("Misc", "workers")) if config.has_option("Misc", "workers") else 8
+FETCH_DEPTH = int(config.get("Misc", "depth")) if config.has_option("Misc", "depth") else 1
+updaters = concurrent.futures.ThreadPoolExecutor(max_workers=UPDATE_WORKERS)
+updating = set()
+# Guards updating, and pending, which checkRemote workers and the pubsub
+# thread add to while the main loop swaps it out
+updatingLock = Lock()
+
+
+# Func for finding the URL and branch of a tracked repo
+def resolveRepo(repo):
+    trueRepo = repo
+    httproot = config.get("Servers", "gitroot")
+    # Check if non-default git root, if so find new http root
+    m = re.match(r"^\$([^/]+)/(.+)$", repo)
+    if m:
+        trueRepo = m.group(2)
+        groot = m.group(1)
+        httproot = config.get("Servers", groot) if config.has_option("Servers", groot) else httproot
+    # Special branch via repo:branch syntax? Otherwise, default to config global
+    branch = config.get("Misc", "branch")
+    if ':' in trueRepo:
+        trueRepo, branch = trueRepo.split(':', 1)
+    return "%s%s.git" % (httproot, trueRepo), branch
+
+
 # Func for cloning a new repo
 def buildRepo(path, URL, branch):
     logging.info("%s does not exist, trying to clone into it as a new dir" % path)
     rv = "No output"
+    depth = ("--depth", str(FETCH_DEPTH)) if FETCH_DEPTH else ()
     try:
-        rv = subprocess.check_output(("git", "clone", "-b", branch, "--single-branch", URL, path))
+        rv = subprocess.check_output(("git", "clone", "-b", branch, "--single-branch") + depth + (URL, path))
     except Exception as err:
         rv = "Error while cloning: %s" % err
     logging.info(rv)
-   
-   
-# Func for updating whatever is in the queue
-def updatePending():
-    global pending
-    xpending = pending;
-    pending = {}
-    for entry in xpending:
-        repo = entry
-        path = xpending[entry]
-        trueRepo = repo
-        httproot = config.get("Servers", "gitroot")
-        # Check if non-default git root, if so find new http root
-        m = re.match(r"^\$([^/]+)/(.+)$", repo)
-        if m:
-            trueRepo = m.group(2)
-            groot = m.group(1)
-            httproot = config.get("Servers", groot) if config.has_option("Servers", groot) else httproot
-        # Special branch via repo:branch syntax? Otherwise, default to config global
-        branch = config.get("Misc", "branch")
-        if ':' in trueRepo:
-            trueRepo, branch = trueRepo.split(':', 1)
-        newURL = "%s%s.git" % (httproot, trueRepo)
-        
-        # Check if we need to pull or clone:
-        
-        # Existing repo?
-        if os.path.isdir(path):
-            os.chdir(path)
-            
-            # Check if the repo has moved, and if so, tear down and rebuild
+
+
+# Func for pulling changes into a checkout. Only the tip of the branch is
+# needed, so fetch shallow unless that fails (e.g. the server won't have it)
+def pullRepo(path, branch):
+    logging.info("Pulling changes into %s" % path)
+    if FETCH_DEPTH:
+        try:
+            rv = subprocess.check_output(("git", "fetch", "--depth", str(FETCH_DEPTH), "origin", branch), cwd=path, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            # Some remotes (and old gits) can't do shallow fetches
+            rv = subprocess.check_output(("git", "fetch", "origin", branch), cwd=path)
+    else:
+        rv = subprocess.check_output(("git", "fetch", "origin", branch), cwd=path)
+    logging.info(rv)
+    rv = subprocess.check_output(("git", "reset", "--hard", "origin/%s" % branch), cwd=path)
+    logging.info(rv)
+
+
+# Func for updating (or creating) a single checkout
+def updateRepo(repo, path):
+    newURL, branch = resolveRepo(repo)
+
+    # Check if we need to pull or clone:
+
+    # Existing repo?
+    if os.path.isdir(path):
+        # Check if the repo has moved, and if so, tear down and rebuild
+        try:
+            oldURL = ""
             try:
+                oldURL = str( subprocess.check_output(("git", "config", "remote.origin.url"), cwd=path), encoding='ascii' ).rstrip('\r\n')
+            except Exception as err:
+                logging.warn("Git config exited badly, not a Git repo??")
                 oldURL = ""
-                try:
-                    oldURL = str( subprocess.check_output(("git", "config", "remote.origin.url")), encoding='ascii' ).rstrip('\r\n')
-                except Exception as err:
-                    logging.warn("Git config exited badly, not a Git repo??")
-                    oldURL = ""
-                if newURL != oldURL:
-                    canClobber = True
-                    if oldURL == "":
-                        logging.warn("No previous git remote detected, checking for SVN info..")
+            if newURL != oldURL:
+                canClobber = True
+                if oldURL == "":
+                    logging.warn("No previous git remote detected, checking for SVN info..")
+                    canClobber = False
+                    try:
+                        rv =subprocess.check_output(("svn", "info"), cwd=path)
+                        if re.search(r"URL: ", rv.decode("utf-8"), re.MULTILINE):
+                            canClobber = True
+                            logging.warn("This is/was a subversion repo, okay to clobber")
+                    except Exception as err:
+                        logging.warn("Not a repo, not going to clobber it: %s" % err)
                         canClobber = False
-                        try:
-                            rv =subprocess.check_output(("svn", "info"))
-                            if re.search(r"URL: ", rv.decode("utf-8"), re.MULTILINE):
-                                canClobber = True
-                                logging.warn("This is/was a subversion repo, okay to clobber")
-                        except Exception as err:
-                            logging.warn("Not a repo, not going to clobber it: %s" % err)
-                            canClobber = False
-                    if canClobber:
-                        logging.warn("Local origin (%s) does not match configuration origin (%s), rebuilding!" % (oldURL, newURL))
-                        os.chdir("/")
-                        shutil.rmtree(path)
-                        buildRepo(path, newURL, branch)
-            # Otherwise, just pull in changes
-                else:
-                    logging.info("Pulling changes into %s" % path)
-                    rv = subprocess.check_output(("git", "fetch", "origin", branch))
-                    logging.info(rv)
-                    rv = subprocess.check_output(("git", "reset", "--hard", "origin/%s" % branch))
-                    logging.info(rv)
-            except Exception as err:
-                logging.error("Git update error: %s" % err)
-                
-        # New repo?
+                if canClobber:
+                    logging.warn("Local origin (%s) does not match configuration origin (%s), rebuilding!" % (oldURL, newURL))
+                    shutil.rmtree(path)
+                    buildRepo(path, newURL, branch)
+        # Otherwise, just pull in changes
+            else:
+                pullRepo(path, branch)
+        except Exception as err:
+            logging.error("Git update error: %s" % err)
+
+    # New repo?
+    else:
+        buildRepo(path, newURL, branch)
+
+
+def runUpdate(repo, path):
+    try:
+        updateRepo(repo, path)
+    except Exception as err:
+        logging.error("Could not update %s: %s" % (path, err))
+    finally:
+        with updatingLock:
+            updating.discard(path)
+
+
+# Func for updating whatever is in the queue
+def updatePending():
+    global pending
+    with updatingLock:
+        xpending = pending
+        pending = {}
+        for repo, path in xpending.items():
+            # Already being updated? Then it goes again once that's done,
+            # as this change may have come in after its fetch.
+            if path in updating:
+                pending[repo] = path
+                continue
+            updating.add(path)
+            updaters.submit(runUpdate, repo, path)
+
+
+# Func for finding out which checkouts are behind their remote, using one
+# ls-remote for all the branches tracked from a repository
+def checkRemote(URL, entries):
+    heads = {}
+    try:
+        refs = ["refs/heads/%s" % branch for repo, path, branch in entries]
+        for line in subprocess.check_output(["git", "ls-remote", URL] + refs).decode("utf-8").splitlines():
+            sha, ref = line.split("\t", 1)
+            heads[ref] = sha
+    except Exception as err:
+        logging.warn("Could not list heads of %s: %s" % (URL, err))
+    for repo, path, branch in entries:
+        sha = heads.get("refs/heads/%s" % branch)
+        try:
+            oldURL = subprocess.check_output(("git", "config", "remote.origin.url"), cwd=path).decode("ascii").strip()
+            head = subprocess.check_output(("git", "rev-parse", "HEAD"), cwd=path).decode("ascii").strip()
+        except Exception:
+            oldURL = head = None
+        if sha and oldURL == URL and head == sha:
+            logging.info("%s is up to date with %s" % (path, repo))
         else:
-            buildRepo(path, newURL, branch)
-            
+            logging.info("Adding %s (%s) to the update queue" % (path, repo))
+            with updatingLock:
+                pending[repo] = path
+
+
+# Func for queueing the checkouts that have changed while we weren't looking
+def coldStart():
+    byURL = collections.defaultdict(list)
+    for option in config.options("Tracking"):
+        repo = config.get("Tracking", option)
+        URL, branch = resolveRepo(repo)
+        byURL[URL].append((repo, option, branch))
+    for URL, entries in byURL.items():
+        updaters.submit(checkRemote, URL, entries)
+
 def read_chunk(req):
     while True:
         try:
@@ -246,35 +331,40 @@ def read_chunk(req):
             break
     return
     
+# Func for indexing the tracking config by the (project, branch) each checkout publishes
+def compileTracking():
+    index = collections.defaultdict(list)
+    for option in config.options("Tracking"):
+        branchNeeded = config.get("Misc", "branch")
+        path = option
+        repo = config.get("Tracking", option)
+        trueRepo = repo
+        # Check if non-default git root, weed that out if so
+        m = re.match(r"^\$([^/]+)/(.+)$", repo)
+        if m:
+            trueRepo = m.group(2)
+        # Check for non-standard publish branch
+        if ':' in trueRepo:
+            trueRepo, branchNeeded = trueRepo.split(':', 1)
+        index[(trueRepo, branchNeeded)].append((path, repo))
+    return dict(index)
+
 def parseGitCommit(commit):
     global pending
     if commit['repository'] == "git":
         if 'project' in commit:
             project = commit['project']
             branch = commit['ref'].replace("refs/heads/", "")
-            for option in config.options("Tracking"):
-                branchNeeded = config.get("Misc", "branch")
-                path = option
-                repo = config.get("Tracking", option)
-                trueRepo = repo
-                # Check if non-default git root, weed that out if so
-                m = re.match(r"^\$([^/]+)/(.+)$", repo)
-                if m:
-                    trueRepo = m.group(2)
-                    groot = m.group(1)
-                # Check for non-standard publish branch
-                if ':' in trueRepo:
-                    trueRepo, branchNeeded = trueRepo.split(':', 1)
-                if project == trueRepo and branch == branchNeeded:
-                    if commit.get('autopublish', False) == True:
-                        logging.info("Repository %s has autopublish via .asf.yaml, ignoring payload..." % repo)
-                    else:
-                        logging.info("Adding %s (%s) to the update queue" % (path, repo))
+            for path, repo in tracking.get((project, branch), ()):
+                if commit.get('autopublish', False) == True:
+                    logging.info("Repository %s has autopublish via .asf.yaml, ignoring payload..." % repo)
+                else:
+                    logging.info("Adding %s (%s) to the update queue" % (path, repo))
+                    with updatingLock:
                         pending[repo] = path
-                
 
-            
-    
+
+
 # PubSub class: handles connecting to a pubsub service and checking commits
 class PubSubClient(Thread):
    
@@ -339,16 +429,14 @@ def main():
         uid = pwd.getpwnam(args.user[0])[2]
         os.setuid(uid)
     
-    global pending
+    global pending, tracking
+    tracking = compileTracking()
     pubsub = PubSubClient()
     pubsub.url = config.get("Servers", "pubsub")
     pubsub.start()
     
     logging.warn("Service restarted, checking for updates in all tracked repos")
-    for option in config.options("Tracking"):
-        repo = config.get("Tracking", option)
-        path = option
-        pending[repo] = path
+    coldStart()
     
     while True:
         updatePending()
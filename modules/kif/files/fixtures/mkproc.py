@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Builds a fake /proc tree for trying out and benchmarking KIF rules
+# without touching real processes, e.g.:
+#
+#   python mkproc.py /tmp/proc 3000
+#   time python ../kif.py --procfs /tmp/proc -c kif.yaml
+#
+# proc/ next to this script is a small tree built with the default seed:
+#
+#   python mkproc.py proc 24
+
+from __future__ import print_function
+import os
+import sys
+import random
+import argparse
+
+NAMES = ['/usr/sbin/apache2', '/usr/bin/git', 'python2.7', '/usr/sbin/slapd', 'bash', '/usr/lib/postfix/master']
+TCPHDR = "  sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode\n"
+
+def write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+
+def mkproc(root, count, seed):
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(root, 'net'))
+    write(os.path.join(root, 'stat'), "cpu  1 2 3 4 5 6 7 0 0 0\nbtime 1700000000\n")
+    write(os.path.join(root, 'meminfo'),
+          "MemTotal: 16000000 kB\nMemFree: 8000000 kB\nMemAvailable: 9000000 kB\n"
+          "Buffers: 1 kB\nCached: 1 kB\nShmem: 1 kB\nSReclaimable: 1 kB\n"
+          "Active: 1 kB\nInactive: 1 kB\nSlab: 1 kB\n")
+    tcp = [TCPHDR]
+    inode = 1000
+    for pid in range(100, 100 + count):
+        d = os.path.join(root, str(pid))
+        os.makedirs(os.path.join(d, 'fd'))
+        name = rng.choice(NAMES)
+        comm = os.path.basename(name)[:15]
+        # Every tenth git is a zombie
+        state = 'Z' if name == '/usr/bin/git' and pid % 10 == 0 else 'S'
+        write(os.path.join(d, 'cmdline'), "%s\0-k\0start\0" % name)
+        # Field 22 is the start time, in clock ticks since boot
+        write(os.path.join(d, 'stat'),
+              "%u (%s) %s 1 %u %u 0 -1 4194560 100 0 0 0 10 5 0 0 20 0 1 0 %u 1000000 2500 "
+              "18446744073709551615 0 0 0 0 0 0 0 0 0 0 0 0 17 0 0 0 0 0 0\n" %
+              (pid, comm, state, pid, pid, rng.randint(1, 10**7)))
+        write(os.path.join(d, 'statm'), "24414 %u 500 100 0 1000 0\n" % rng.randint(100, 100000))
+        write(os.path.join(d, 'status'), "Name:\t%s\nState:\t%s\nUid:\t0\t0\t0\t0\nGid:\t0\t0\t0\t0\n" %
+              (comm, "Z (zombie)" if state == 'Z' else "S (sleeping)"))
+        for fd in range(4):
+            os.symlink('/dev/null', os.path.join(d, 'fd', str(fd)))
+        # Some connections for apache, to exercise the conns triggers
+        if 'apache' in name:
+            for c in range(3):
+                os.symlink('socket:[%u]' % inode, os.path.join(d, 'fd', str(10 + c)))
+                tcp.append("   0: 0100007F:0050 0%u00000A:%04X 01 00000000:00000000 00:00000000 "
+                           "00000000     0        0 %u 1 0 20 4 30 10 -1\n" % (c, 40000 + inode % 20000, inode))
+                inode += 1
+    write(os.path.join(root, 'net', 'tcp'), "".join(tcp))
+    for f in ('tcp6', 'udp', 'udp6'):
+        write(os.path.join(root, 'net', f), TCPHDR)
+    write(os.path.join(root, 'net', 'unix'), "Num RefCount Protocol Flags Type St Inode Path\n")
+
+parser = argparse.ArgumentParser()
+parser.add_argument("root", help="Where to create the tree (must not exist yet)")
+parser.add_argument("count", type = int, help="Number of processes")
+parser.add_argument("--seed", type = int, default = 1, help="Random seed (default 1)")
+args = parser.parse_args()
+
+if os.path.exists(args.root):
+    print("%s already exists" % args.root)
+    sys.exit(1)
+mkproc(args.root, args.count, args.seed)
@@ -19,6 +19,8 @@ import time
 import logging
 import atexit
 import signal
+import pwd
+import collections
 
 # define a megabyte and gigabyte
 MB = (2 ** 20)
@@ -32,6 +34,9 @@ CONFIG = None
 # Default to checking triggers every N seconds.
 DEFAULT_INTERVAL = 300
 
+# In sampling mode, don't spend more than this percentage of the time sampling
+DEFAULT_MAXOVERHEAD = 2
+
 
 # Miscellaneous auxiliary functions
 def notifyEmail(fro, to, subject, msg):
@@ -55,34 +60,37 @@ def notifyHipchat(room, token, msg, notify = False):
     requests.post('https://api.hipchat.com/v1/rooms/message', data = payload)
 
 
-class ProcessInfo(object):
-    def __init__(self, pid=None):
-        if pid is None:
-            # This instance will aggregate values across multiple processes,
-            # so we'll zero the numerics.
-            self.mem = 0
-            self.mempct = 0
-            self.fds = 0
-            self.age = 0
-            self.state = ''  # can't aggregate state, but needs a value
-            self.conns = 0
-            self.conns_local = 0
-            return
+# Which process attributes each trigger needs, so a scan only reads those
+TRIGGER_ATTRS = {
+    'maxmemory': ['memory_info'],
+    'maxfds': ['num_fds'],
+    'maxconns': ['connections'],
+    'maxlocalconns': ['connections'],
+    'maxage': ['create_time'],
+    'state': ['status'],
+    'fdgrowth': ['num_fds'],
+}
 
-        proc = psutil.Process(pid)
-        self.mem = proc.memory_info().rss
-        self.mempct = proc.memory_percent()
-        self.fds = proc.num_fds()
-        self.age = time.time() - proc.create_time()
-        self.state = proc.status()
 
-        self.conns = len(proc.connections())
+class ProcessInfo(object):
+    def __init__(self, pinfo=None):
+        # Numerics no rule asked for stay zeroed, as they do when this
+        # instance aggregates values across multiple processes (no pinfo).
+        self.mem = 0
+        self.mempct = 0
+        self.fds = 0
+        self.age = 0
+        self.state = ''  # can't aggregate state, but needs a value
+        self.conns = 0
         self.conns_local = 0
-        for connection in proc.connections():
-            if connection.raddr and connection.raddr[0]:
-                if RE_LOCAL_IP.match(connection.raddr[0]) \
-                   or connection.raddr[0] == '::1':
-                    self.conns_local += 1
+        if pinfo is None:
+            return
+
+        for key in ('mem', 'mempct', 'fds', 'age', 'state', 'conns', 'conns_local'):
+            if key in pinfo:
+                if pinfo[key] is None: # we weren't allowed to read it
+                    raise psutil.AccessDenied(pinfo['pid'])
+                setattr(self, key, pinfo[key])
 
     def accumulate(self, other):
         self.mem += other.mem
@@ -96,247 +104,541 @@ class ProcessInfo(object):
 RE_LOCAL_IP = re.compile(r'^(10|192|127)\.')
 
 
-def getuser(pid):
-    proc = psutil.Process(pid)
-    return proc.username()
-
-
-# getprocs: Get all processes and their command line stack
-def getprocs():
+# cookCounters: Turn the raw counters psutil read into ProcessInfo fields
+def cookCounters(pinfo, now, totalmem):
+    if 'memory_info' in pinfo:
+        meminfo = pinfo.pop('memory_info')
+        pinfo['mem'] = meminfo.rss if meminfo else None
+        pinfo['mempct'] = (100.0 * meminfo.rss / totalmem) if meminfo else None
+    if 'num_fds' in pinfo:
+        pinfo['fds'] = pinfo.pop('num_fds')
+    if 'create_time' in pinfo:
+        ctime = pinfo.pop('create_time')
+        pinfo['age'] = (now - ctime) if ctime else None
+    if 'status' in pinfo:
+        pinfo['state'] = pinfo.pop('status')
+
+
+# countConnections: Count connections per process from one pass over the
+# system's socket tables, instead of every process re-reading all of them
+def countConnections(procs):
+    for pinfo in procs.values():
+        pinfo['conns'] = 0
+        pinfo['conns_local'] = 0
+    for connection in psutil.net_connections('inet'):
+        pinfo = procs.get(connection.pid)
+        if pinfo is None:
+            continue
+        pinfo['conns'] += 1
+        if connection.raddr and connection.raddr[0]:
+            if RE_LOCAL_IP.match(connection.raddr[0]) \
+               or connection.raddr[0] == '::1':
+                pinfo['conns_local'] += 1
+
+
+# procStart: When a process started (field 22 of /proc/<pid>/stat, in clock
+# ticks since boot). Together with the PID, this tells a process apart from
+# a later one that got the same PID. None if the process is gone.
+def procStart(pid):
+    try:
+        with open(os.path.join(psutil.PROCFS_PATH, str(pid), 'stat')) as f:
+            return f.read().rpartition(')')[2].split()[19]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+# getprocs: Take one snapshot of all processes (or just the given PIDs),
+# their command line stack and whichever of the attrs above the rules
+# need, keyed by PID
+def getprocs(attrs = (), pids = None):
     procs = {}
-    for p in psutil.process_iter():
+    now = time.time()
+    fetch = ['pid', 'name', 'cmdline']
+    if 'username' in attrs:
+        fetch.append('uids') # looked up below, once per uid rather than per process
+    fetch += [a for a in attrs if a not in ('username', 'connections')]
+    totalmem = psutil.virtual_memory().total if 'memory_info' in attrs else 0
+    users = {}
+    for p in (psutil.process_iter() if pids is None else pids):
         try:
-            pinfo = p.as_dict(attrs=['pid', 'name', 'username', 'status', 'cmdline'])
-            content = pinfo['cmdline']
-            if not content:
-                content = pinfo['name'] # Fall back if no cmdline present
-            pid = pinfo['pid']
-            if len(content) > 0 and len(content[0]) > 0:
-                content = [c for c in content if len(c) > 0]
-                procs[pid] = content
+            if pids is not None:
+                p = psutil.Process(p)
+            pinfo = p.as_dict(attrs=fetch)
         except (psutil.ZombieProcess, psutil.AccessDenied, psutil.NoSuchProcess):
-            print("Could not access process, it might have gone away...")
+            if pids is None:
+                print("Could not access process, it might have gone away...")
+            continue
+        content = pinfo['cmdline']
+        if not content and pinfo['name']:
+            content = [pinfo['name']] # Fall back if no cmdline present
+        if not content or len(content[0]) == 0:
             continue
+        pinfo['content'] = [c for c in content if len(c) > 0]
+        if 'uids' in pinfo:
+            uid = pinfo.pop('uids')
+            uid = uid.real if uid else None
+            if uid not in users:
+                try:
+                    users[uid] = pwd.getpwuid(uid).pw_name
+                except (KeyError, TypeError):
+                    users[uid] = None if uid is None else str(uid)
+            pinfo['username'] = users[uid]
+        cookCounters(pinfo, now, totalmem)
+        procs[pinfo['pid']] = pinfo
+
+    if 'connections' in attrs:
+        countConnections(procs)
     return procs
 
 
 
-def checkTriggers(id, info, triggers, dead = False):
-    if len(triggers) > 0:
-        print("  - Checking triggers:")
-    for trigger, value in triggers.items():
-        print("    - Checking against trigger %s" % trigger)
-
+# Units the maxmemory and maxage triggers understand
+MEMORY_UNITS = {'mb': MB, 'gb': GB}
+AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# The ProcessInfo field each trigger looks at (maxmemory depends on its unit)
+TRIGGER_FIELDS = {
+    'maxfds': 'fds',
+    'maxconns': 'conns',
+    'maxlocalconns': 'conns_local',
+    'maxage': 'age',
+    'state': 'state',
+    'fdgrowth': 'fds',
+}
+
+
+def parseAge(value):
+    value = str(value).strip()
+    if value[-1:] in AGE_UNITS:
+        return int(value[:-1]) * AGE_UNITS[value[-1:]]
+    return int(value)
+
+
+class Trigger(object):
+    """ A single trigger of a rule, with its threshold parsed at load time.
+    In sampling mode, a threshold followed by 'for <age>' (e.g. '4gb for 60s')
+    only fires once it has held for that long, and fdgrowth ('N/<age>') fires
+    when a process opened more than N FDs within that time. """
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self.attrs = TRIGGER_ATTRS.get(name, [])
+        self.field = TRIGGER_FIELDS.get(name)
+        self.window = 0
+        value = str(value).strip()
+        if ' for ' in value:
+            value, window = value.split(' for ', 1)
+            self.window = parseAge(window)
+        if name == 'maxmemory':
+            if value.endswith('%'): # percentage check
+                self.field, self.limit, self.unit = 'mempct', float(value[:-1]), '%'
+            elif value[-2:] in MEMORY_UNITS:
+                self.field, self.limit, self.unit = 'mem', int(value[:-2]) * MEMORY_UNITS[value[-2:]], ' bytes'
+            else:
+                raise ValueError("Unknown maxmemory value '%s', use N%%, Nmb or Ngb" % value)
+        elif name in ('maxfds', 'maxconns', 'maxlocalconns'):
+            self.limit = int(value)
+        elif name == 'maxage':
+            self.limit = parseAge(value)
+        elif name == 'state':
+            self.limit = value
+        elif name == 'fdgrowth':
+            if '/' not in value:
+                raise ValueError("Unknown fdgrowth value '%s', use N/<age>" % value)
+            value, window = value.split('/', 1)
+            self.limit, self.window = int(value), parseAge(window)
+
+    def exceeds(self, value):
+        if self.name == 'state':
+            return value == self.limit
+        return value > self.limit
+
+    def describe(self, id, value):
         # maxmemory: Process can max use N amount of memory or it triggers
-        if trigger == 'maxmemory':
-            if value.find("%") != -1: # percentage check
-                maxmem = float(value.replace('%',''))
-                cmem = info.mempct
-                cvar = '%'
-            elif value.find('mb') != -1:    # mb check
-                maxmem = int(value.replace('mb','')) * MB
-                cmem = info.mem
-                cvar = ' bytes'
-            elif value.find('gb') != -1:    # gb check
-                maxmem = int(value.replace('gb','')) * GB
-                cmem = info.mem
-                cvar = ' bytes'
-            lstr = "      - Process '%s' is using %u%s memory, max allowed is %u%s" % (id, cmem+0.5, cvar, maxmem+0.5, cvar)
-            print(lstr)
-            if cmem > maxmem:
-                print("    - Trigger fired!")
-                return lstr
-
+        if self.name == 'maxmemory':
+            return "      - Process '%s' is using %u%s memory, max allowed is %u%s" % (id, value+0.5, self.unit, self.limit+0.5, self.unit)
         # maxfds: maximum number of file descriptors
-        if trigger == 'maxfds':
-            maxfds = int(value)
-            cfds = info.fds
-            lstr = "      - Process '%s' is using %u FDs, max allowed is %u" % (id, cfds, value)
-            print(lstr)
-            if cfds > maxfds:
-                print("    - Trigger fired!")
-                return lstr
-
+        if self.name == 'maxfds':
+            return "      - Process '%s' is using %u FDs, max allowed is %u" % (id, value, self.limit)
         # maxconns: maximum number of open connections
-        if trigger == 'maxconns':
-            maxconns = int(value)
-            ccons = info.conns
-            lstr = "      - Process '%s' is using %u connections, max allowed is %u" % (id, ccons, value)
-            print(lstr)
-            if ccons > maxconns:
-                print("    - Trigger fired!")
-                return lstr
-
+        if self.name == 'maxconns':
+            return "      - Process '%s' is using %u connections, max allowed is %u" % (id, value, self.limit)
         # maxlocalconns: maximum number of open connections in local network
-        if trigger == 'maxlocalconns':
-            maxconns = int(value)
-            ccons = info.conns_local
-            lstr ="      - Process '%s' is using %u LAN connections, max allowed is %u" % (id, ccons, value)
-            print(lstr)
-            if ccons > maxconns:
-                print("    - Trigger fired!")
-                return lstr
-            
+        if self.name == 'maxlocalconns':
+            return "      - Process '%s' is using %u LAN connections, max allowed is %u" % (id, value, self.limit)
         # maxage: maximum age of a process (NOT cpu time)
-        if trigger == 'maxage':
-            if value.find('s') != -1:    # seconds
-                maxage = int(value.replace('s',''))
-                cage = info.age
-                cvar = ' seconds'
-            elif value.find('m') != -1:    # minutes
-                maxage = int(value.replace('m','')) * 60
-                cage = info.age
-                cvar = ' minutes'
-            elif value.find('h') != -1:    # hours
-                maxage = int(value.replace('h','')) * 360
-                cage = info.age
-                cvar = ' hours'
-            elif value.find('d') != -1:    # days
-                maxage = int(value.replace('d','')) * 86400
-                cage = info.age
-                cvar = ' days'
-            else:
-                maxage = int(value)
-                cage = info.age
-            lstr ="      - Process '%s' is %u seconds old, max allowed is %u" % (id, cage,maxage)
-            print(lstr)
-            if cage > maxage:
-                print("    - Trigger fired!")
-                return lstr
-        
+        if self.name == 'maxage':
+            return "      - Process '%s' is %u seconds old, max allowed is %u" % (id, value, self.limit)
         # state: kill processes in a specific state (zombie etc)
-        if trigger == 'state':
-            cstate = info.state
-            lstr ="      - Process '%s' is in state '%s'" % (id, cstate)
-            print(lstr)
-            if cstate == value:
-                print("    - Trigger fired!")
-                return lstr
-    return None
-
-def scanForTriggers(config):
-    procs = getprocs() # get all current processes
+        if self.name == 'state':
+            return "      - Process '%s' is in state '%s'" % (id, value)
+        # fdgrowth: maximum number of FDs opened within a window of time
+        if self.name == 'fdgrowth':
+            return "      - Process '%s' opened %d FDs in %u seconds, max allowed is %u" % (id, value, self.window, self.limit)
+
+    def check(self, id, info):
+        """ Checks a process (or combined processes) against this trigger,
+        returning a description if it fired """
+        if not self.field:
+            return None
+        print("    - Checking against trigger %s" % self.name)
+        if self.window:
+            print("      - Needs %u seconds of samples, only checked in sampling mode" % self.window)
+            return None
+        value = getattr(info, self.field)
+        lstr = self.describe(id, value)
+        print(lstr)
+        if self.exceeds(value):
+            print("    - Trigger fired!")
+            return lstr
+        return None
+
+    def evaluate(self, id, samples, now):
+        """ Checks the trigger against recent (time, ProcessInfo) samples,
+        oldest first, returning a description if it fired """
+        if not self.field:
+            return None
+        latest = getattr(samples[-1][1], self.field)
+        if not self.window:
+            return self.describe(id, latest) if self.exceeds(latest) else None
+        start = now - self.window
+        if samples[0][0] > start:
+            return None # haven't been watching it for long enough yet
+        if self.name == 'fdgrowth':
+            base = [info for t, info in samples if t <= start][-1]
+            growth = latest - base.fds
+            return self.describe(id, growth) if self.exceeds(growth) else None
+        for t, info in samples:
+            if t >= start and not self.exceeds(getattr(info, self.field)):
+                return None
+        return self.describe(id, latest) + " (for %u seconds)" % self.window
+
+
+class Rule(object):
+    """ A rule from kif.yaml, compiled once when the config is loaded """
+
+    def __init__(self, id, rule):
+        self.id = id
+        self.procid = rule.get('procid')
+        if isinstance(self.procid, list):
+            self.procid = tuple(self.procid)
+        self.uid = rule.get('uid')
+        self.ignore = rule.get('ignore')
+        if isinstance(self.ignore, list):
+            self.ignore = tuple(self.ignore)
+        self.ignorepidfile = rule.get('ignorepidfile')
+        self.combine = rule.get('combine') == True
+        self.triggers = [Trigger(trigger, value) for trigger, value in rule.get('triggers', {}).items()]
+        self.window = max([trigger.window for trigger in self.triggers] + [0])
+        self.runlist = rule.get('runlist') or []
+        self.notify = rule.get('notify', None)
+        self.kills = rule.get('kill') == True
+        self.killwith = int(rule.get('killwith', 9))
+
+    def ignored(self, pinfo):
+        """ Whether a matching process is one the rule says to leave alone """
+        if isinstance(self.ignore, str):
+            return pinfo['cmdline_str'] == self.ignore
+        return tuple(pinfo['content']) == self.ignore
+
+    def ignorepid(self):
+        """ Reads the PID the rule should ignore, if any """
+        if not self.ignorepidfile:
+            return None
+        try:
+            return int(open(self.ignorepidfile).read())
+        except Exception as err:
+            print(err)
+            return None
+
+    def check(self, info):
+        """ Runs all triggers against a process, returning the first that fires """
+        if len(self.triggers) > 0:
+            print("  - Checking triggers:")
+        for trigger in self.triggers:
+            err = trigger.check(self.id, info)
+            if err:
+                return err
+        return None
+
+    def evaluate(self, samples, now):
+        """ Runs all triggers against a process's recent samples, quietly """
+        for trigger in self.triggers:
+            err = trigger.evaluate(self.id, samples, now)
+            if err:
+                return err
+        return None
+
+    def action(self, trigger, pids):
+        """ What to do now that a trigger fired for some PIDs """
+        return {
+            'pids': [],
+            'trigger': trigger,
+            'runlist': self.runlist,
+            'notify': self.notify,
+            'kills': dict((pid, self.killwith) for pid in pids) if self.kills else {}
+        }
+
+
+class RuleSet(object):
+    """ All rules of a config, indexed so that one pass over the process
+    table finds the processes every rule applies to """
+
+    def __init__(self, config):
+        self.rules = [Rule(id, rule) for id, rule in (config.get('rules') or {}).items()]
+        self.attrs = set() # process attributes the rules need
+        self.window = max([rule.window for rule in self.rules] + [0])
+        self.bysubstring = []
+        self.bystack = {}
+        self.byuid = {}
+        for rule in self.rules:
+            if isinstance(rule.procid, str):
+                self.bysubstring.append(rule)
+            elif isinstance(rule.procid, tuple):
+                self.bystack.setdefault(rule.procid, []).append(rule)
+            if rule.uid is not None:
+                self.byuid.setdefault(rule.uid, []).append(rule)
+                self.attrs.add('username')
+            for trigger in rule.triggers:
+                self.attrs.update(trigger.attrs)
+        # All substring procids as one pattern, so most processes take a
+        # single search to rule out, however many rules there are
+        self.substrings = None
+        if self.bysubstring:
+            patterns = sorted(set(rule.procid for rule in self.bysubstring), key = len, reverse = True)
+            self.substrings = re.compile("|".join(re.escape(p) for p in patterns))
+        self.matchattrs = self.attrs & set(['username'])
+
+    def match(self, procs):
+        """ Finds the PIDs each rule applies to, as {rule id: [pids]} """
+        matches = dict((rule.id, []) for rule in self.rules)
+        for xpid, pinfo in procs.items():
+            cmdline = pinfo['content']
+            pinfo['cmdline_str'] = " ".join(cmdline)
+            candidates = list(self.bystack.get(tuple(cmdline), []))
+            if self.substrings and self.substrings.search(pinfo['cmdline_str']):
+                candidates += [rule for rule in self.bysubstring if rule.procid in pinfo['cmdline_str']]
+            if self.byuid:
+                candidates += self.byuid.get(pinfo['username'], [])
+            for rule in candidates:
+                if not (rule.ignore and rule.ignored(pinfo)) and xpid not in matches[rule.id]:
+                    matches[rule.id].append(xpid)
+        # PID files are read once per scan, and only for rules that matched
+        for rule in self.rules:
+            if matches[rule.id] and rule.ignorepidfile:
+                ppid = rule.ignorepid()
+                if ppid in matches[rule.id]:
+                    print("Ignoring %u, matches pid file %s!" % (ppid, rule.ignorepidfile))
+                    matches[rule.id].remove(ppid)
+        return matches
+
+
+def scanForTriggers(rules):
+    then = time.time()
+    procs = getprocs(rules.attrs) # get all current processes
+    matches = rules.match(procs)
     actions = []
 
-    ### TODO: reindent
-    if True:
-
-        # For each rule..
-        for id, rule in config['rules'].items():
-            print("- Running rule %s" % id)
-            # Is this process running here?
-            pids = []
-            if 'procid' in rule:
-                procid = rule['procid']
-                print("  - Checking for process %s" % procid)
-                for xpid, cmdline in procs.items():
-                    addit = False
-                    if isinstance(procid, str):
-                        if " ".join(cmdline).find(rule['procid']) != -1:
-                            addit = True
-                    elif isinstance(procid, list):
-                        if cmdline == procid:
-                            addit = True
-                    if addit:
-                        if not ('ignore' in rule):
-                            addit = True
-                        elif isinstance(rule['ignore'], str) and " ".join(cmdline) != rule['ignore']:
-                            addit = True
-                        elif isinstance(rule['ignore'], list) and cmdline != rule['ignore']:
-                            addit = True
-                        if 'ignorepidfile' in rule:
-                            try:
-                                ppid = int(open(rule['ignorepidfile']).read())
-                                if ppid == xpid:
-                                    print("Ignoring %u, matches pid file %s!" % (ppid, rule['ignorepidfile']))
-                                    addit = False
-                            except Exception as err:
-                                print(err)
-                        if addit:
-                            pids.append(xpid)
-            if 'uid' in rule:
-                for xpid, cmdline in procs.items():
-                    uid = getuser(xpid)
-                    if uid == rule['uid']:
-                        addit = False
-                        if not ('ignore' in rule):
-                            addit = True
-                        elif isinstance(rule['ignore'], str) and " ".join(cmdline) != rule['ignore']:
-                            addit = True
-                        elif isinstance(rule['ignore'], list) and cmdline != rule['ignore']:
-                            addit = True
-                        if 'ignorepidfile' in rule:
-                            try:
-                                ppid = int(open(rule['ignorepidfile']).read())
-                                if ppid == xpid:
-                                    print("Ignoring %u, matches pid file %s!" % (ppid, rule['ignorepidfile']))
-                                    addit = False
-                            except Exception as err:
-                                print(err)
-                        if addit:
-                            pids.append(xpid)
-
-            # If proc is running, analyze it
-            analysis = ProcessInfo()  # no pid. accumulator.
-            for pid in pids:
-                print("  - Found process at PID %u" % pid)
+    # For each rule..
+    for rule in rules.rules:
+        print("- Running rule %s" % rule.id)
+        if rule.procid:
+            print("  - Checking for process %s" % (rule.procid if isinstance(rule.procid, str) else list(rule.procid)))
+        pids = matches[rule.id]
+
+        # If proc is running, analyze it
+        analysis = ProcessInfo()  # no pid. accumulator.
+        for pid in pids:
+            print("  - Found process at PID %u" % pid)
+
+            try:
+                # Get all relevant data from this PID
+                info = ProcessInfo(procs[pid])
+
+                # If combining, combine into the analysis hash
+                if rule.combine:
+                    analysis.accumulate(info)
+                else:
+                    # If running a per-pid test, run it:
+                    err = rule.check(info)
+                    if err:
+                        actions.append(rule.action(err, [pid]))
+            except:
+                print("Could not analyze proc %u, bailing!" % pid)
+                continue
+        if len(pids) > 0:
+            # If combined trigger test, run it now
+            if rule.combine:
+                err = rule.check(analysis)
+                if err:
+                    actions.append(rule.action(err, pids))
+        else:
+            print("  - No matching processes found")
+
+    print("Scanned %u processes against %u rules in %.3f seconds" % (len(procs), len(rules.rules), time.time() - then))
+    return actions
 
-                try:
-                    # Get all relevant data from this PID
-                    info = ProcessInfo(pid)
-    
-                    # If combining, combine into the analysis hash
-                    if 'combine' in rule and rule['combine'] == True:
-                        analysis.accumulate(info)
-                    else:
-                        # If running a per-pid test, run it:
-                        err = checkTriggers(id, info, rule['triggers'])
-                        if err:
-                            action = {
-                                'pids': [],
-                                'trigger': "",
-                                'runlist': [],
-                                'notify': rule.get('notify', None),
-                                'kills': {}
-                            }
-                            if 'runlist' in rule and len(rule['runlist']) > 0:
-                                action['runlist'] = rule['runlist']
-                            if 'kill' in rule and rule['kill'] == True:
-                                sig = 9
-                                if 'killwith' in rule:
-                                    sig = int(rule['killwith'])
-                                action['kills'][pid] = sig
-                            action['trigger'] = err
-                            actions.append(action)
-                except:
-                    print("Could not analyze proc %u, bailing!" % pid)
+
+class Sampler(object):
+    """ Sampling mode: instead of one scan per interval, follow the processes
+    the rules apply to every few seconds, keeping a ring buffer of recent
+    readings per process (and per combined rule) so triggers can look at a
+    window of time rather than a single reading. Processes are told apart by
+    PID and start time, so a reused PID starts out with an empty buffer.
+
+    Command lines and users are only read for PIDs we haven't seen before;
+    a sample reads just the counters the triggers need. Everything is
+    matched again once per interval, to catch processes that exec'd into
+    something else after we first saw them. If sampling takes more than
+    maxoverhead percent of the time, samples are spaced out further. """
+
+    def __init__(self, rules, period, interval, maxoverhead):
+        self.rules = rules
+        self.period = period
+        self.interval = interval
+        self.maxoverhead = min(max(maxoverhead, 0.01), 100) / 100.0
+        self.fetch = ['pid'] + [a for a in rules.attrs if a not in ('username', 'connections')]
+        self.totalmem = psutil.virtual_memory().total
+        self.history = int(rules.window / period) + 2 # samples kept per buffer
+        self.known = set()   # every PID seen so far, matched or not
+        self.handles = {}    # PID -> psutil.Process, for the PIDs we follow
+        self.starts = {}     # PID -> start time of the process we follow there
+        self.matches = {}    # rule id -> PIDs it applies to
+        self.buffers = {}    # (PID, start time), or (rule id,) when combined -> recent samples
+        self.fired = {}      # (rule id, (PID, start time) or None) -> when it last fired
+        self.lastscan = 0
+        self.stats = [0, 0, 0.0, 0.0] # samples, processes sampled, total and worst cost
+
+    def forget(self, pid):
+        """ Drops what we know about the process at a PID """
+        self.handles.pop(pid, None)
+        proc = (pid, self.starts.pop(pid, None))
+        self.buffers.pop(proc, None)
+        self.fired = dict((k, v) for k, v in self.fired.items() if k[1] != proc)
+
+    def rematch(self, now, pids):
+        """ Works out which rules apply to PIDs we haven't seen yet, or to
+        all of them once per interval """
+        gone = self.known - pids
+        if gone:
+            for mpids in self.matches.values():
+                mpids[:] = [pid for pid in mpids if pid not in gone]
+            for pid in gone:
+                self.forget(pid)
+        if now - self.lastscan >= self.interval:
+            self.matches = self.rules.match(getprocs(self.rules.matchattrs))
+            self.lastscan = now
+            self.known = pids
+            followed = set(pid for mpids in self.matches.values() for pid in mpids)
+            for pid in list(self.handles):
+                if pid not in followed:
+                    self.forget(pid)
+            return
+        new = pids - self.known
+        if new:
+            for id, mpids in self.rules.match(getprocs(self.rules.matchattrs, new)).items():
+                self.matches[id] += mpids
+        self.known = pids
+
+    def sample(self):
+        """ Takes one sample of every process a rule applies to, and returns
+        the actions for any triggers that fired """
+        now = time.time()
+        self.rematch(now, set(psutil.pids()))
+        procs = {}
+        reused = set()
+        for pid in set(pid for mpids in self.matches.values() for pid in mpids):
+            start = procStart(pid)
+            if start is None:
+                continue
+            if self.starts.get(pid, start) != start:
+                reused.add(pid)
+                continue
+            try:
+                if pid not in self.handles:
+                    self.handles[pid] = psutil.Process(pid)
+                    self.starts[pid] = start
+                pinfo = self.handles[pid].as_dict(attrs=self.fetch)
+            except (psutil.ZombieProcess, psutil.AccessDenied, psutil.NoSuchProcess):
+                continue
+            cookCounters(pinfo, now, self.totalmem)
+            procs[pid] = pinfo
+        if reused:
+            # Another process got the PID since we last looked, so what we
+            # had on it no longer applies; match it again like a new one
+            for pid in reused:
+                self.forget(pid)
+            for mpids in self.matches.values():
+                mpids[:] = [pid for pid in mpids if pid not in reused]
+            self.known -= reused
+        if 'connections' in self.rules.attrs:
+            countConnections(procs)
+
+        infos = {}
+        for pid, pinfo in procs.items():
+            try:
+                infos[pid] = ProcessInfo(pinfo)
+            except psutil.AccessDenied:
+                continue
+            proc = (pid, self.starts[pid])
+            if proc not in self.buffers:
+                self.buffers[proc] = collections.deque(maxlen = self.history)
+            self.buffers[proc].append((now, infos[pid]))
+
+        actions = []
+        for rule in self.rules.rules:
+            pids = [pid for pid in self.matches[rule.id] if pid in infos]
+            if rule.combine:
+                if not pids:
+                    self.buffers.pop((rule.id,), None)
                     continue
-            if len(pids) > 0:
-                # If combined trigger test, run it now
-                if 'combine' in rule and rule['combine'] == True:
-                    err = checkTriggers(id, analysis, rule['triggers'])
-                    if err:
-                        action = {
-                            'pids': [],
-                            'trigger': "",
-                            'runlist': [],
-                            'notify': rule.get('notify', None),
-                            'kills': {}
-                        }
-                        if 'runlist' in rule and len(rule['runlist']) > 0:
-                            action['runlist'] = rule['runlist']
-                        if 'kill' in rule and rule['kill'] == True:
-                            sig = 9
-                            if 'killwith' in rule:
-                                sig = int(rule['killwith'])
-                            for ypid in pids:
-                                action['kills'][ypid] = sig
-                        action['trigger'] = err
-                        actions.append(action)
+                analysis = ProcessInfo()  # no pid. accumulator.
+                for pid in pids:
+                    analysis.accumulate(infos[pid])
+                if (rule.id,) not in self.buffers:
+                    self.buffers[(rule.id,)] = collections.deque(maxlen = self.history)
+                self.buffers[(rule.id,)].append((now, analysis))
+                self.check(rule, None, pids, now, actions)
             else:
-                print("  - No matching processes found")
-                
-    return actions
+                for pid in pids:
+                    self.check(rule, (pid, self.starts[pid]), [pid], now, actions)
+        self.stats[1] += len(procs)
+        return actions
+
+    def check(self, rule, proc, pids, now, actions):
+        key = (rule.id, proc)
+        if now - self.fired.get(key, 0) < self.interval:
+            return # it fired recently, give whatever that did time to work
+        err = rule.evaluate(self.buffers[proc if proc is not None else (rule.id,)], now)
+        if err:
+            self.fired[key] = now
+            actions.append(rule.action(err, pids))
+
+    def report(self, elapsed):
+        samples, procs, total, worst = self.stats
+        if samples:
+            print("Took %u samples of %u processes on average in %u seconds: %.1fms per sample, %.1fms at worst, %.2f%% of the time" %
+                  (samples, procs / samples, elapsed, total * 1000 / samples, worst * 1000, total * 100 / elapsed))
+        self.stats = [0, 0, 0.0, 0.0]
+
+    def run(self, config):
+        print("Sampling every %g seconds, keeping %u samples per process" % (self.period, self.history))
+        lastreport = time.time()
+        while True:
+            then = time.time()
+            actions = self.sample()
+            cost = time.time() - then
+            self.stats[0] += 1
+            self.stats[2] += cost
+            self.stats[3] = max(self.stats[3], cost)
+            if actions:
+                run_actions(config, actions)
+            if then - lastreport >= self.interval:
+                self.report(then - lastreport)
+                lastreport = then
+            # Space samples out if taking them costs more than we allow
+            time.sleep(max(0, max(self.period, cost / self.maxoverhead) - cost))
 
 
 # Get args, if any
@@ -347,25 +649,43 @@ parser.add_argument("-F", "--foreground", help="Run Kif continuous in foreground
 parser.add_argument("-s", "--stop", help="Stop the Kif daemon", action = 'store_true')
 parser.add_argument("-r", "--restart", help="Restart the Kif daemon", action = 'store_true')
 parser.add_argument("-c", "--config", help="Path to the config file if not in ./kif.yaml")
+parser.add_argument("-p", "--procfs", help="Read processes from this /proc tree instead (for testing and benchmarks, implies --debug)")
 args = parser.parse_args()
 
+if args.procfs:
+    psutil.PROCFS_PATH = args.procfs
+    args.debug = True # these PIDs aren't ours to kill
+
 if not args.config:
     CONFIG = yaml.load(open("kif.yaml"))
 else:
     CONFIG = yaml.load(open(args.config))
+RULES = RuleSet(CONFIG)
 
 def main(config):
-    if 'rules' not in config:
+    if not RULES.rules:
         print('- NO RULES TO CHECK')
     else:
         # Now actually run things
-        actions = scanForTriggers(config)
+        actions = scanForTriggers(RULES)
         if actions:
             run_actions(config, actions)
 
     print('KIF run finished!')
 
 
+def loop(config):
+    dconfig = config.get('daemon', { })
+    interval = int(dconfig.get('interval', DEFAULT_INTERVAL))
+    if dconfig.get('sample') and RULES.rules:
+        sampler = Sampler(RULES, float(dconfig['sample']), interval,
+                          float(dconfig.get('maxoverhead', DEFAULT_MAXOVERHEAD)))
+        sampler.run(config)
+    while True:
+        main(config)
+        time.sleep(interval)
+
+
 def run_actions(config, actions):
         ### TODO: reindent
 
@@ -608,11 +928,7 @@ if 'logging' in CONFIG and 'logfile' in CONFIG['logging']:
 ## Daemon class
 class MyDaemon(Daemonize):
     def run(self, args):
-        interval = int(CONFIG.get('daemon', { })
-                       .get('interval', DEFAULT_INTERVAL))
-        while True:
-            main(CONFIG)
-            time.sleep(interval)
+        loop(CONFIG)
 
 # Get started!
 if args.stop:
@@ -629,10 +945,6 @@ else:
         daemon = MyDaemon(PIDFILE)
         daemon.start(args)
     elif args.foreground:
-        interval = int(CONFIG.get('daemon', { })
-                       .get('interval', DEFAULT_INTERVAL))
-        while True:
-            main(CONFIG)
-            time.sleep(interval)
+        loop(CONFIG)
     else:
         main(CONFIG)
@@ -24,6 +24,7 @@
 
 
 import os
+import io
 import select
 import sys
 import time, datetime
@@ -31,12 +32,14 @@ import json
 import re
 import socket
 import hashlib, random
-from collections import defaultdict, namedtuple
+from collections import defaultdict
 from threading import Thread
 import atexit, signal, inspect
 from threading import Lock
 import subprocess, collections, argparse, grp, pwd, shutil
 import ConfigParser
+import Queue
+import multiprocessing
 import platform
 import syslog
 import base64
@@ -91,7 +94,7 @@ except:
 inodes = {}
 inodes_path = {}
 
-# The names must agree with the tuples below
+# The names must agree with the formats below
 regexes = {
     'apache_access': re.compile( 
             r"(?P<client_ip>[\d\.]+)\s" 
@@ -143,42 +146,100 @@ regexes = {
 }
 
 
+# The order in which formats are tried for a file that has no pinned format.
 # The names must agree with the regexes above
-tuples = {
-    'apache_access': namedtuple('apache_access',
-        ['client_ip', 'identity', 'user', 'time', 'request',
-        'status', 'bytes', 'referer', 'user_agent',
-        'filepath', 'logtype', 'timestamp']
-        ),
-    'apache_error': namedtuple('apache_error', [
-        'date', 'module', 'pid', 'client_ip', 'message',
-        'filepath', 'logtype', 'timestamp']
-        ),
-    'syslog': namedtuple('syslog', [
-        'date', 'host', 'type', 'message',
-        'filepath', 'logtype', 'timestamp']
-        ),
-    'fail2ban': namedtuple('fail2ban', [
-        'date', 'type', 'message',
-        'filepath', 'logtype', 'timestamp']
-        ),
-    'rsync': namedtuple('rsync', [
-        'date', 'pid', 'message',
-        'filepath', 'logtype', 'timestamp']
-        ),
-    'pylogs': namedtuple('pylogs', [
-        'date', 'type', 'message',
-        'filepath', 'logtype', 'timestamp']
-        ),
-    'qmail': namedtuple('qmail', [
-        'mid', 'message',
-        'filepath', 'logtype', 'timestamp']
-        ),
-    'lastlog': namedtuple('lastlog', [
-        'user', 'term', 'stats',
-        'filepath', 'logtype', 'timestamp']
-        )
+formats = ['apache_access', 'apache_error', 'syslog', 'fail2ban', 'rsync',
+           'pylogs', 'qmail', 'lastlog']
+
+# What the first character of a line must look like for a format to stand
+# a chance of matching. Formats not listed here start with any non-space.
+leads = {
+    'apache_access': re.compile(r"[\d.]"),
+    'apache_error': re.compile(r"\["),
+    'qmail': re.compile(r"@"),
+    'lastlog': re.compile(r"[a-z0-9]"),
 }
+anylead = re.compile(r"\S")
+
+jsonline = re.compile(r"<%JSON:([^>%]+)%>\s*(.+)")
+
+
+class LineParser:
+    """Turns raw log data into (logtype, document, size) triples.
+
+    Each file is pinned to the format that last matched one of its lines,
+    so the common case costs a single regex match per line. Formats that
+    cannot match a line's first character are never tried."""
+
+    def __init__(self):
+        self.pinned = {}
+        self.candidates = {}
+
+    def forget(self, path):
+        self.pinned.pop(path, None)
+
+    def candidatesFor(self, c):
+        cands = self.candidates.get(c)
+        if cands is None:
+            cands = [r for r in formats if leads.get(r, anylead).match(c)]
+            self.candidates[c] = cands
+        return cands
+
+    def parseJSON(self, line):
+        m = jsonline.match(line)
+        if not m:
+            return None
+        try:
+            # Try normally
+            try:
+                js = json.loads(m.group(2))
+            # In case \x[..] has been used, try again!
+            except:
+                js = json.loads(re.sub(r"\\x..", "?", m.group(2)))
+        except:
+            return None
+        if not isinstance(js, dict):
+            return None
+        js['logtype'] = m.group(1)
+        return js
+
+    def parse(self, path, data):
+        now = time.time()
+        pinned = self.pinned.get(path)
+        docs = []
+        for line in data.split("\n"):
+            line = line.rstrip()
+            if not line:
+                continue
+            if line.startswith('<%JSON:'):
+                js = self.parseJSON(line)
+                if js:
+                    js['filepath'] = path
+                    js['timestamp'] = now
+                    docs.append((js['logtype'], js, len(line)))
+                continue
+            r = pinned
+            match = regexes[r].match(line) if r else None
+            if not match:
+                for r in self.candidatesFor(line[0]):
+                    if r == pinned:
+                        continue
+                    match = regexes[r].match(line)
+                    if match:
+                        if r != 'apache_access':
+                            print("Found a " + r + " match in " + path)
+                        pinned = r
+                        self.pinned[path] = r
+                        break
+            if match:
+                js = match.groupdict()
+                js['filepath'] = path
+                js['logtype'] = r
+                js['timestamp'] = now
+                docs.append((r, js, len(line)))
+        return docs
+
+lineparser = LineParser()
 
 
 class Daemonize:
@@ -301,73 +362,575 @@ class Daemonize:
 
 
 filehandles = {}
+partial = {}
+readsize = 1024 * 1024
 json_pending = {}
+json_marks = {}
+pending_bytes = {}
 last_push = {}
+ready = []
+pending_lock = Lock()
 
-for t in tuples:
+for t in formats:
     json_pending[t] = []
+    json_marks[t] = []
+    pending_bytes[t] = 0
     last_push[t] = time.time()
 
-gotindex = {}
+checkpoint = None
+parsepool = None
+shipper = None
+stopping = False
+mainpid = None
 
+# Fields every shipped document gets, see makeTemplate()
+doctemplate = {}
 
+requestline = re.compile(r"(GET|POST)\s+(.+)\s+HTTP/.+")
 
-class NodeThread(Thread):
-    def assign(self, json, logtype, xes):
-        self.json = json
-        self.logtype = logtype
+# Batch limits, overridden by the [Shipping] section of loggy.cfg
+batchsize = 500
+batchbytes = 5 * 1024 * 1024
+maxage = 15
+
+
+def cfgint(section, option, default):
+    if config.has_option(section, option):
+        return int(config.get(section, option))
+    return default
+
+
+def spoolDir():
+    return config.get('Spool', 'path') if config.has_option('Spool', 'path') else '/var/spool/loggy'
+
+
+def addPending(logtype, docs, size, marks = None):
+    """Buffers documents for shipping. marks holds, for each document, the
+    chunk it was read from (see Checkpoint), or None."""
+    global json_pending, pending_bytes, last_push
+    if marks is None:
+        marks = [None] * len(docs)
+    with pending_lock:
+        if not logtype in json_pending:
+            json_pending[logtype] = []
+            json_marks[logtype] = []
+            pending_bytes[logtype] = 0
+            last_push[logtype] = time.time()
+            print("got our first valid json as " + logtype + "!")
+        json_pending[logtype].extend(docs)
+        json_marks[logtype].extend(marks)
+        pending_bytes[logtype] += size
+        # Full batch? Set it aside for the next flush.
+        if len(json_pending[logtype]) >= batchsize or pending_bytes[logtype] >= batchbytes:
+            docs = json_pending[logtype]
+            marks = json_marks[logtype]
+            for i in range(0, len(docs), batchsize):
+                ready.append((logtype, docs[i:i+batchsize], marks[i:i+batchsize]))
+            json_pending[logtype] = []
+            json_marks[logtype] = []
+            pending_bytes[logtype] = 0
+            last_push[logtype] = time.time()
+
+
+def flushPending(shipper, force = False):
+    """Hands full batches, and those older than maxage, over to the shipper.
+    Blocks if the shipper's queue is full, which holds back the tailer."""
+    global json_pending, pending_bytes, last_push, ready
+    now = time.time()
+    with pending_lock:
+        batches = ready
+        ready = []
+        for x in json_pending:
+            if not json_pending[x]:
+                last_push[x] = now
+            elif force or now > (last_push[x] + maxage):
+                batches.append((x, json_pending[x], json_marks[x]))
+                json_pending[x] = []
+                json_marks[x] = []
+                pending_bytes[x] = 0
+                last_push[x] = now
+    for x, docs, marks in batches:
+        shipper.submit(x, docs, marks)
+
+
+def makeTemplate():
+    global doctemplate
+    doctemplate = {
+        '@version': 2,
+        'host': hostname,
+        '@node': hostname,
+        '@fingerprint': FINGERPRINT,
+        '@fingerprint_sha': FINGERPRINT_SHA
+    }
+    if mytags:
+        doctemplate['@tags'] = mytags
+
+
+def makeMappings():
+    mappings = {}
+    for entry in config.options('RawFields'):
+        js = {
+            "_all" : {"enabled" : True},
+            "properties": {
+                "@timestamp" : { "store": True, "type" : "date", "format": "yyyy/MM/dd HH:mm:ss"},
+                "@node" : { "store": True, "type" : "string", "index": "not_analyzed"},
+                "status" : { "store": True, "type" : "long"},
+                "date" : { "store": True, "type" : "string", "index": "not_analyzed"},
+                "geo_location" : { "type": "geo_point", "geohash": True }
+            }
+        }
+        for field in config.get('RawFields', entry).split(","):
+            x = field.strip()
+            js['properties'][x] = {"store": True, "type": "string", "index": "not_analyzed", "fields": { "keyword": { "type": "keyword" }}}
+        mappings[entry] = js
+    return mappings
+
+
+class IndexManager(Thread):
+    """Knows which daily loggy indices exist, and creates tomorrow's index
+    ahead of time so the first flush after midnight does not have to wait
+    for it. The mappings are built from RawFields once, at startup."""
+
+    def __init__(self, xes):
+        Thread.__init__(self)
+        self.daemon = True
         self.xes = xes
+        self.mappings = makeMappings()
+        self.known = set()
+        self.lock = Lock()
+        # Separate from self.lock, which is held while ensure() talks to ES
+        self.daylock = Lock()
+        self.index_name = None
+        self.until = 0
 
-    def run(self):
-        global gotindex, config, json_pending
-        random.seed(time.time())
-        #print("Pushing %u json objects" % len(json_pending))
-        iname = time.strftime("loggy-%Y.%m.%d")
-        sys.stderr.flush()
-        if not iname in gotindex:
-            gotindex[iname] = True
+    def current(self):
+        """Returns the name of today's index, making sure it exists."""
+        now = time.time()
+        with self.daylock:
+            if now >= self.until:
+                t = time.localtime(now)
+                self.until = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+                self.index_name = time.strftime("loggy-%Y.%m.%d", t)
+            iname = self.index_name
+        if not iname in self.known:
+            self.ensure(iname)
+        return iname
+
+    def ensure(self, iname):
+        with self.lock:
+            if iname in self.known:
+                return
             if not self.xes.indices.exists(index=iname):
-                mappings = {}
-                for entry in config.options('RawFields'):
-                    js = {
-                        "_all" : {"enabled" : True},
-                        "properties": {
-                            "@timestamp" : { "store": True, "type" : "date", "format": "yyyy/MM/dd HH:mm:ss"},
-                            "@node" : { "store": True, "type" : "string", "index": "not_analyzed"},
-                            "status" : { "store": True, "type" : "long"},
-                            "date" : { "store": True, "type" : "string", "index": "not_analyzed"},
-                            "geo_location" : { "type": "geo_point", "geohash": True }
-                        }
-                    }
-                    for field in config.get('RawFields', entry).split(","):
-                        x = field.strip()
-                        js['properties'][x] = {"store": True, "type": "string", "index": "not_analyzed", "fields": { "keyword": { "type": "keyword" }}}
-                    mappings[entry] = js
-                    
                 res = self.xes.indices.create(index = iname, ignore=400, body = {
                         "settings" : {
                             "index.mapping.ignore_malformed": True,
                             "number_of_shards": 2,
                             "number_of_replicas": 0
                         },
-                        "mappings" : mappings
+                        "mappings" : self.mappings
                     }
                 )
-                if not 'loggy-indices' in json_pending:
-                    json_pending['loggy-indices'] = []
-                    last_push['loggy-indices'] = time.time()
-                json_pending['loggy-indices'].append({
+                addPending('loggy-indices', [{
                     '@node': hostname,
                     'index_created': iname,
                     'logtype': 'loggy-indices',
                     '@timestamp': time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime()),
                     'res': res,
-                    'mappings': mappings
-                    })
-            
+                    'mappings': self.mappings
+                    }], 0)
+            self.known.add(iname)
+
+    def run(self):
+        while True:
+            try:
+                self.current()
+                self.ensure(time.strftime("loggy-%Y.%m.%d", time.localtime(time.time() + 86400)))
+            except Exception as err:
+                syslog.syslog(syslog.LOG_WARNING, "Could not prepare loggy indices: %s" % err)
+            time.sleep(600)
+
+
+class Chunk(object):
+    """A piece of a file that was read and handed to the parser. remaining
+    counts its documents not shipped yet (None until it has been parsed)."""
+    __slots__ = ('track', 'offset', 'remaining')
+
+    def __init__(self, track, offset):
+        self.track = track
+        self.offset = offset
+        self.remaining = None
+
+
+class Track(object):
+    """The chunks read from one open file, in order, and the offset up to
+    which all of them have been shipped."""
+    __slots__ = ('key', 'acked', 'chunks')
+
+    def __init__(self, key, offset):
+        self.key = key
+        self.acked = offset
+        self.chunks = collections.deque()
+
+    def advance(self):
+        while self.chunks and self.chunks[0].remaining == 0:
+            self.acked = self.chunks.popleft().offset
+
+
+class Checkpoint:
+    """Per-inode read offsets, saved to disk every few seconds so that a
+    restart resumes reading where the previous run stopped.
+
+    The saved offset only moves past a chunk of a file once every document
+    parsed from it has been shipped (or spooled, or rejected), so lines that
+    are still being parsed, buffered or shipped are read again after a
+    restart instead of being skipped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        self.tracks = {}
+        self.lock = Lock()
+        self.savelock = Lock()
+        self.pid = os.getpid()
+        self.last_save = 0
+        try:
+            with open(path, 'r') as f:
+                self.offsets = json.load(f)
+            syslog.syslog(syslog.LOG_INFO, "Loaded %u read offsets from %s" % (len(self.offsets), path))
+        except (IOError, ValueError):
+            pass
+
+    def resume(self, path, fh):
+        """Seeks a freshly opened file to its saved offset, or to EOF if
+        the file is new to us (or was truncated since)."""
+        st = os.fstat(fh.fileno())
+        key = "%u:%u" % (st.st_dev, st.st_ino)
+        with self.lock:
+            entry = self.offsets.get(key)
+        if entry and entry[0] <= st.st_size:
+            print("Resuming %s at offset %u" % (path, entry[0]))
+            fh.seek(entry[0])
+        else:
+            fh.seek(0,2)
+        with self.lock:
+            self.tracks[path] = Track(key, fh.tell())
+
+    def reset(self, path, fh):
+        """Starts over from the current offset of fh, e.g. after a file was
+        truncated. Chunks read before that no longer count."""
+        with self.lock:
+            track = self.tracks.get(path)
+            if track:
+                self.tracks[path] = Track(track.key, fh.tell())
+
+    def forget(self, path):
+        with self.lock:
+            track = self.tracks.pop(path, None)
+            if track:
+                self.offsets.pop(track.key, None)
+
+    def chunk(self, path, offset):
+        """Notes that path was read up to offset, returning the mark for
+        the documents parsed from that chunk."""
+        with self.lock:
+            track = self.tracks.get(path)
+            if not track:
+                return None
+            chunk = Chunk(track, offset)
+            track.chunks.append(chunk)
+            return chunk
+
+    def parsed(self, chunk, count):
+        with self.lock:
+            chunk.remaining = count
+            chunk.track.advance()
+
+    def ack(self, marks):
+        """Called once the documents with these marks are out of our hands."""
+        with self.lock:
+            tracks = set()
+            for chunk in marks:
+                if chunk:
+                    chunk.remaining -= 1
+                    tracks.add(chunk.track)
+            for track in tracks:
+                track.advance()
+
+    def save(self, force = False):
+        # Only the process that reads the files knows the offsets
+        if os.getpid() != self.pid:
+            return
+        now = time.time()
+        if not force and now < self.last_save + 5:
+            return
+        self.last_save = now
+        with self.lock:
+            for track in self.tracks.values():
+                self.offsets[track.key] = [track.acked, now]
+            # Files we have not heard from in a week are most likely gone
+            for key in [k for k, v in self.offsets.items() if v[1] < now - 7*86400]:
+                del self.offsets[key]
+            data = json.dumps(self.offsets)
+        with self.savelock:
+            try:
+                with open(self.path + ".tmp", 'w') as f:
+                    f.write(data)
+                os.rename(self.path + ".tmp", self.path)
+            except (IOError, OSError) as err:
+                syslog.syslog(syslog.LOG_WARNING, "Could not save read offsets: %s" % err)
+
+
+class Spool:
+    """Append-only on-disk buffer for batches that could not be shipped.
+
+    Batches are written as JSON lines to numbered segment files and replayed
+    oldest segment first, so an ElasticSearch outage costs disk, not memory."""
+
+    def __init__(self, path, segsize, maxbytes):
+        self.path = path
+        self.segsize = segsize
+        self.maxbytes = maxbytes
+        self.lock = Lock()
+        self.current = None
+        self.cursize = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        segs = self.segments()
+        self.seq = int(segs[-1][6:-5]) + 1 if segs else 1
+        self.size = sum(os.path.getsize(os.path.join(path, f)) for f in segs)
+
+    def segments(self):
+        return sorted(f for f in os.listdir(self.path) if f.startswith('spool-') and f.endswith('.json'))
+
+    def pending(self):
+        return self.size > 0
+
+    def encode(self, logtype, docs):
+        try:
+            return json.dumps([logtype, docs]) + "\n"
+        # Log lines are not always valid UTF-8
+        except UnicodeDecodeError:
+            return json.dumps([logtype, docs], encoding = 'latin-1') + "\n"
+
+    def append(self, logtype, docs):
+        """Appends a batch, returns False if the spool is full."""
+        line = self.encode(logtype, docs)
+        with self.lock:
+            if self.size + len(line) > self.maxbytes:
+                return False
+            if not self.current or self.cursize >= self.segsize:
+                self.rotate()
+            self.current.write(line)
+            self.current.flush()
+            self.cursize += len(line)
+            self.size += len(line)
+        return True
+
+    def rotate(self):
+        if self.current:
+            self.current.close()
+        self.current = open(os.path.join(self.path, "spool-%012u.json" % self.seq), 'a')
+        self.seq += 1
+        self.cursize = 0
+
+    def oldest(self):
+        """Returns the oldest segment, closing it first if it is the one
+        currently being written to."""
+        with self.lock:
+            segs = self.segments()
+            if not segs:
+                return None
+            oldest = os.path.join(self.path, segs[0])
+            if self.current and self.current.name == oldest:
+                self.current.close()
+                self.current = None
+                self.cursize = 0
+            return oldest
+
+    def replay(self, ship):
+        """Feeds the oldest segment through ship(docs, logtype), a line at
+        a time. On failure, keeps what was not shipped yet and returns False."""
+        seg = self.oldest()
+        if not seg:
+            return True
+        done = 0
+        with open(seg, 'r') as f:
+            for line in f:
+                try:
+                    logtype, docs = json.loads(line)
+                except ValueError:
+                    done += len(line)
+                    continue
+                try:
+                    ship(docs, logtype)
+                except Exception as err:
+                    syslog.syslog(syslog.LOG_WARNING, "Spool replay stalled: %s" % err)
+                    with open(seg + ".tmp", 'w') as rest:
+                        rest.write(line)
+                        for line in f:
+                            rest.write(line)
+                    os.rename(seg + ".tmp", seg)
+                    with self.lock:
+                        self.size -= done
+                    return False
+                done += len(line)
+        os.unlink(seg)
+        with self.lock:
+            self.size -= done
+        return True
+
+
+last_stats = [time.time()]
+
+def logStats(shipper):
+    """Logs the shipper counters once a minute."""
+    if time.time() > last_stats[0] + 60:
+        last_stats[0] = time.time()
+        syslog.syslog(syslog.LOG_INFO, "Shipping: %(queued)u queued, %(in_flight)u in flight, %(shipped)u shipped, %(spooled)u spooled, %(replayed)u replayed, %(dropped)u dropped" % shipper.stats())
+
+
+class Shipper:
+    """A fixed pool of bulk workers fed from a bounded queue.
+
+    submit() blocks while the queue is full, so a slow ElasticSearch makes
+    the tailer wait instead of piling up threads and memory. Failed bulk
+    requests are retried with a growing delay and then spooled to disk.
+    While the spool is being used, new batches go straight to it until a
+    replay succeeds, after which the spool is drained at full bulk speed."""
+
+    def __init__(self, xes):
+        self.xes = xes
+        self.indices = IndexManager(xes)
+        self.indices.start()
+        global batchsize, batchbytes, maxage
+        batchsize = cfgint('Shipping', 'batchsize', batchsize)
+        batchbytes = cfgint('Shipping', 'batchbytes', batchbytes)
+        maxage = cfgint('Shipping', 'maxage', maxage)
+        self.workers = cfgint('Shipping', 'workers', 4)
+        self.retries = cfgint('Shipping', 'retries', 3)
+        self.queue = Queue.Queue(cfgint('Shipping', 'queuesize', 32))
+        self.spool = Spool(spoolDir(), cfgint('Spool', 'segsize', 64 * 1024 * 1024), cfgint('Spool', 'maxbytes', 2048 * 1024 * 1024))
+        self.degraded = self.spool.pending()
+        self.next_replay = 0
+        self.replaying = Lock()
+        self.lock = Lock()
+        self.counters = {
+            'queued': 0,
+            'in_flight': 0,
+            'shipped': 0,
+            'spooled': 0,
+            'replayed': 0,
+            'dropped': 0
+        }
+        self.threads = []
+        for i in range(self.workers):
+            t = NodeThread()
+            t.assign(self)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def count(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                self.counters[k] += v
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def submit(self, logtype, docs, marks = None):
+        self.count(queued = len(docs))
+        self.queue.put((logtype, docs, marks))
+
+    def drain(self, timeout):
+        """Waits, for at most timeout seconds, until everything submitted
+        has been shipped or spooled."""
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+
+    def stash(self, logtype, docs):
+        if self.spool.append(logtype, docs):
+            self.count(spooled = len(docs))
+        else:
+            syslog.syslog(syslog.LOG_WARNING, "Spool is full, dropping %u %s documents" % (len(docs), logtype))
+            self.count(dropped = len(docs))
+
+    def replay(self, worker):
+        """Lets one worker at a time replay a spool segment, at most every
+        30 seconds while ElasticSearch looks unavailable."""
+        if not self.spool.pending() or time.time() < self.next_replay:
+            return
+        if not self.replaying.acquire(False):
+            return
+        try:
+            if self.spool.replay(worker.replay):
+                self.degraded = False
+                self.next_replay = 0
+            else:
+                self.degraded = True
+                self.next_replay = time.time() + 30
+        finally:
+            self.replaying.release()
+
+
+class NodeThread(Thread):
+    def assign(self, shipper):
+        self.shipper = shipper
+        self.xes = shipper.xes
+
+    def run(self):
+        while True:
+            self.shipper.replay(self)
+            try:
+                logtype, docs, marks = self.shipper.queue.get(timeout = 5)
+            except Queue.Empty:
+                continue
+            self.shipper.count(queued = -len(docs), in_flight = len(docs))
+            if self.shipper.degraded:
+                self.shipper.stash(logtype, docs)
+            else:
+                try:
+                    shipped, dropped = self.ship(docs, logtype)
+                    self.shipper.count(shipped = shipped, dropped = dropped)
+                except Exception as err:
+                    syslog.syslog(syslog.LOG_WARNING, "Could not ship %u %s documents, spooling: %s" % (len(docs), logtype, err))
+                    self.shipper.degraded = True
+                    self.shipper.next_replay = time.time() + 30
+                    self.shipper.stash(logtype, docs)
+            self.shipper.count(in_flight = -len(docs))
+            if marks and checkpoint:
+                checkpoint.ack(marks)
+            self.shipper.queue.task_done()
+
+    def replay(self, docs, logtype):
+        shipped, dropped = self.ship(docs, logtype)
+        self.shipper.count(replayed = shipped, dropped = dropped)
+
+    def bulk(self, js_arr):
+        """Sends one bulk request, retrying on transport errors.
+        Returns the number of documents indexed and rejected."""
+        delay = 1
+        attempt = 0
+        while True:
+            try:
+                ok, errors = helpers.bulk(self.xes, js_arr, raise_on_error = False)
+                return ok, len(errors)
+            except Exception as err:
+                attempt += 1
+                if attempt > self.shipper.retries:
+                    raise
+                syslog.syslog(syslog.LOG_WARNING, "Bulk push failed (%s), retrying in %u seconds" % (err, delay))
+                time.sleep(delay)
+                delay *= 2
+
+    def ship(self, docs, logtype):
+        random.seed(time.time())
+        iname = self.shipper.indices.current()
+        now = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime())
         js_arr = []
-        for entry in self.json:
-            js = entry
+        for js in docs:
             # GeoHash conversion
             if 'geo_lat' in js and 'geo_long' in js:
                 try:
@@ -377,23 +940,16 @@ class NodeThread(Thread):
                     }
                 except:
                     pass
-            js['@version'] = 2
-            js['@timestamp'] = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime())
-            js['host'] = hostname
-            js['@node'] = hostname
-            js['@fingerprint'] = FINGERPRINT
-            js['@fingerprint_sha'] = FINGERPRINT_SHA
-#             js['@rsa_key_mtime'] = RSA_KEY_MTIME
+            js.update(doctemplate)
+            js['@timestamp'] = now
             # Rogue string sometimes, we don't want that!
             if 'bytes' in js:
                 try:
                     js['bytes'] = int(js['bytes'])
                 except:
                     js['bytes'] = 0
-            if mytags:
-                js['@tags'] = mytags
             if 'request' in js and not 'url' in js:
-                match = re.match(r"(GET|POST)\s+(.+)\s+HTTP/.+", js['request'])
+                match = requestline.match(js['request'])
                 if match:
                     js['url'] = match.group(2)
             if 'bytes' in js and isinstance(js['bytes'], basestring) and js['bytes'].isdigit():
@@ -402,16 +958,14 @@ class NodeThread(Thread):
             js_arr.append({
                 '_op_type': 'index',
                 '_index': iname,
-                '_type': self.logtype,
+                '_type': logtype,
                 'doc': js,
                 '_source': js
             })
             
         if len(js_arr) > 0:
-            #es.bulk(index=iname, doc_type=self.logtype, body = js_arr )
-            helpers.bulk(self.xes, js_arr)
-        #except Exception as err:
-            #print(err)
+            return self.bulk(js_arr)
+        return 0, 0
             
 
 def connect_es(config):
@@ -439,39 +993,146 @@ def connect_es(config):
     return esx
 
 
-def parseLine(path, data):
-    global json_pending, config
-    for line in (l.rstrip() for l in data.split("\n")):
-        m = re.match(r"^<%JSON:([^>%]+)%>\s*(.+)", line)
-        if m:
-            try:
-                # Try normally
-                try:
-                    js = json.loads(m.group(2))
-                # In case \x[..] has been used, try again!    
-                except:
-                    js = json.loads(re.sub(r"\\x..", "?", m.group(2)))
-                js['filepath'] = path
-                js['timestamp'] = time.time()
-                js['logtype'] = m.group(1)
-                if not js['logtype'] in json_pending:
-                    json_pending[js['logtype']] = []
-                    last_push[js['logtype']] = time.time()
-                    print("got our first valid json as " + js['logtype'] + "!")
-                json_pending[js['logtype']].append(js)
-            except:
-                pass
-        else:
-            for r in regexes:
-                match = regexes[r].match(line)
-                if match:
-                    if not r == 'apache_access':
-                        print("Found a " + r + " match")
-                    js = tuples[r]( filepath=path, logtype=r, timestamp = time.time() , **match.groupdict())
-                    json_pending[r].append(js._asdict())
-                    if not r == 'apache_access':
-                        print("Appended a " + r + " match")
-                    break
+def readDelta(path):
+    """Reads whatever was appended to a file since the last read, in large
+    unbuffered chunks, and parses the complete lines. A trailing partial
+    line is kept back until the rest of it has been written.
+    
+    Once as many full batches are waiting as the shipper's queue holds,
+    they are handed over before reading on. That blocks while the shipper
+    is backed up, so a burst or a long backlog is read no faster than it
+    can be shipped, instead of piling up in memory."""
+    fh = filehandles[path]
+    while True:
+        if shipper and len(ready) >= shipper.queue.maxsize:
+            flushPending(shipper)
+        chunk = fh.read(readsize)
+        if not chunk:
+            break
+        data = partial.pop(path, '') + chunk
+        cut = data.rfind("\n") + 1
+        # A "line" this long is not going to get a newline any time soon
+        if cut == 0 and len(data) >= readsize:
+            cut = len(data)
+        if cut < len(data):
+            partial[path] = data[cut:]
+        if cut:
+            mark = checkpoint.chunk(path, fh.tell() - len(partial.get(path, ''))) if checkpoint else None
+            parseLine(path, data[:cut], mark)
+
+
+def groupDocs(parser, path, data):
+    """Parses data and groups the documents by logtype, returning a list of
+    (logtype, documents, size) batches."""
+    batches = {}
+    for logtype, js, size in parser.parse(path, data):
+        batch = batches.get(logtype)
+        if batch is None:
+            batch = batches[logtype] = [logtype, [], 0]
+        batch[1].append(js)
+        batch[2] += size
+    return batches.values()
+
+
+def forgetFormat(path):
+    """Unpins the format of a file that was rotated away or deleted."""
+    if parsepool:
+        parsepool.forget(path)
+    else:
+        lineparser.forget(path)
+
+
+def deliver(batches, mark, sink):
+    """Passes parsed batches on to sink, with each document marked as coming
+    from the chunk mark (if any)."""
+    if mark:
+        checkpoint.parsed(mark, sum(len(docs) for logtype, docs, size in batches))
+    for logtype, docs, size in batches:
+        sink(logtype, docs, size, [mark] * len(docs) if mark else None)
+
+
+def parseLine(path, data, mark = None):
+    if parsepool:
+        parsepool.submit(path, data, mark)
+        return
+    deliver(groupDocs(lineparser, path, data), mark, addPending)
+
+
+def parseWorker(inq, outq):
+    """Body of a parse process: raw chunks in, document batches out."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Forked from the main process; its shutdown is none of our business
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    parser = LineParser()
+    while True:
+        item = inq.get()
+        if item is None:
+            break
+        seq, path, data = item
+        if data is None:
+            parser.forget(path)
+            continue
+        outq.put((seq, groupDocs(parser, path, data)))
+
+
+class ParsePool:
+    """Hands raw chunks to a set of parse processes, to get around the GIL
+    on hosts with many busy log files. Every path always goes to the same
+    process, so lines from one file are never reordered. A collector thread
+    passes the parsed batches on to sink (addPending by default)."""
+
+    def __init__(self, workers, sink = None):
+        self.sink = sink or addPending
+        self.outq = multiprocessing.Queue(workers * 64)
+        self.inqs = []
+        self.procs = []
+        self.chunks = 0
+        self.seq = 0
+        self.marks = {}
+        self.lock = Lock()
+        for i in range(workers):
+            inq = multiprocessing.Queue(64)
+            proc = multiprocessing.Process(target = parseWorker, args = (inq, self.outq))
+            proc.daemon = True
+            proc.start()
+            self.inqs.append(inq)
+            self.procs.append(proc)
+        self.collector = Thread(target = self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+        syslog.syslog(syslog.LOG_INFO, "Started %u parse processes" % workers)
+
+    def submit(self, path, data, mark = None):
+        # Marks stay here, the worker only gets a number to hand back
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            if mark:
+                self.marks[seq] = mark
+        # Blocks while that worker is backed up
+        self.inqs[hash(path) % len(self.inqs)].put((seq, path, data))
+
+    def forget(self, path):
+        self.inqs[hash(path) % len(self.inqs)].put((0, path, None))
+
+    def collect(self):
+        while True:
+            seq, batches = self.outq.get()
+            with self.lock:
+                mark = self.marks.pop(seq, None)
+            deliver(batches, mark, self.sink)
+            with self.lock:
+                self.chunks += 1
+
+    def done(self):
+        with self.lock:
+            return self.chunks
+
+    def stop(self):
+        for inq in self.inqs:
+            inq.put(None)
+        for proc in self.procs:
+            proc.join()
 
 if osname == "freebsd":
     class BSDHandler(PatternMatchingEventHandler):
@@ -485,6 +1146,8 @@ if osname == "freebsd":
                 except Exception as err:
                     print(err)
                 del filehandles[path]
+                partial.pop(path, None)
+                forgetFormat(path)
                 inode = inodes_path[path]
                 del inodes[inode]
     
@@ -494,37 +1157,25 @@ if osname == "freebsd":
                     inode = idata.st_ino
                     if not inode in inodes:
                         print("Opening: " + path)
-                        filehandles[path] = open(path, "r")
+                        filehandles[path] = io.open(path, "rb", buffering = 0)
                         print("Started watching %s (%u)" % (path, inode))
-                        filehandles[path].seek(0,2)
+                        checkpoint.resume(path, filehandles[path])
                         inodes[inode] = path
                         inodes_path[path] = inode
                         print(path, filehandles[path])
                 except Exception as err:
                     print(err)
             elif event.event_type == 'modified' and path in filehandles:
-                print(path + " was modified")
-                rd = 0
-                data = ""
-                #print("Change in " + path)
                 try:
-                    while True:
-                        line = filehandles[path].readline()
-                        if not line:
-                            #filehandles[path].seek(0,2)
-                            break
-                        else:
-                            rd += len(line)
-                            data += line
-                    #print("Read %u bytes from %s" % (rd, path))
-                    parseLine(path, data)
+                    readDelta(path)
                 except Exception as err:
                     try:
-                        print("Could not utilize " + path + ", closing.." + err)
+                        print("Could not utilize " + path + ", closing.." + str(err))
                         filehandles[path].close()
                     except Exception as err:
                         print(err)
                     del filehandles[path]
+                    partial.pop(path, None)
                     inode = inodes_path[path]
                     del inodes[inode]
           # File deleted? (close handle)
@@ -536,6 +1187,9 @@ if osname == "freebsd":
                     except Exception as err:
                         print(err)
                     del filehandles[path]
+                    partial.pop(path, None)
+                    checkpoint.forget(path)
+                    forgetFormat(path)
                     inode = inodes_path[path]
                     del inodes[inode]
                     print("Stopped watching " + path)
@@ -551,9 +1205,29 @@ if osname == "freebsd":
             self.process(event)
 
 class Loggy(Thread):
+    def readOrClose(self, path, inodes, inodes_path):
+        try:
+            readDelta(path)
+        except Exception as err:
+            try:
+                print("Could not utilize " + path + ", closing.." + str(err))
+                filehandles[path].close()
+            except Exception as err:
+                print(err)
+            del filehandles[path]
+            partial.pop(path, None)
+            inode = inodes_path[path]
+            del inodes[inode]
+
     def run(self):
-        global timeout, w, tuples, regexes, json_pending, last_push, config
-        fp = {}
+        global timeout, w, regexes, config, checkpoint
+        global parsepool, shipper
+        checkpoint = Checkpoint(os.path.join(spoolDir(), 'offsets.json'))
+        makeTemplate()
+        # Fork parse processes before any of the shipping threads exist
+        workers = args.parsers[0] if args.parsers else cfgint('Analyzer', 'parsers', 0)
+        if workers > 0:
+            parsepool = ParsePool(workers)
         if osname == "linux":
             w = watcher.AutoWatcher()
             for path in config.get('Analyzer','paths').split(","):
@@ -576,7 +1250,8 @@ class Loggy(Thread):
     
             inodes = {}
             inodes_path = {}
-            xes = connect_es(config)
+            dirty = set()
+            shipper = Shipper(connect_es(config))
             while True:
                 events = poll.poll(timeout)
                 nread = 0
@@ -585,24 +1260,20 @@ class Loggy(Thread):
                     for evt in w.read(0):
                         nread += 1
             
-                        # The last thing to do to improve efficiency here would be
-                        # to coalesce similar events before passing them up to a
-                        # higher level.
-            
-                        # For example, it's overwhelmingly common to have a stream
-                        # of inotify events contain a creation, followed by
-                        # multiple modifications of the created file.
-            
-                        # Recognising this pattern (and others) and coalescing
-                        # these events into a single creation event would reduce
-                        # the number of trips into our app's presumably more
-                        # computationally expensive upper layers.
+                        # Modifications are coalesced: a path that was modified
+                        # (any number of times) during this poll cycle is read
+                        # once, after all events have been looked at. Any other
+                        # event on a dirty path reads it first, so nothing gets
+                        # skipped by a seek or close further down.
                         masks = inotify.decode_mask(evt.mask)
                         #print(masks)
                         path = evt.fullpath
                         #print(repr(evt.fullpath), ' | '.join(masks))
                         try:
                             if not u'IN_ISDIR' in masks:
+                                if path in dirty and not u'IN_MODIFY' in masks:
+                                    dirty.discard(path)
+                                    self.readOrClose(path, inodes, inodes_path)
                                 
                                 if (u'IN_MOVED_FROM' in masks) and (path in filehandles):
                                     print("File moved, closing original handle")
@@ -611,6 +1282,8 @@ class Loggy(Thread):
                                     except Exception as err:
                                         print(err)
                                     del filehandles[path]
+                                    partial.pop(path, None)
+                                    forgetFormat(path)
                                     inode = inodes_path[path]
                                     del inodes[inode]
                                     
@@ -620,9 +1293,9 @@ class Loggy(Thread):
                                         idata = os.stat(path)
                                         inode = idata.st_ino
                                         if not inode in inodes:
-                                            filehandles[path] = open(path, "r")
+                                            filehandles[path] = io.open(path, "rb", buffering = 0)
                                             print("Started watching " + path)
-                                            filehandles[path].seek(0,2)
+                                            checkpoint.resume(path, filehandles[path])
                                             inodes[inode] = path
                                             inodes_path[path] = inode
                                             
@@ -633,6 +1306,7 @@ class Loggy(Thread):
                                         except Exception as err:
                                             print(err)
                                         del filehandles[path]
+                                        partial.pop(path, None)
                                         inode = inodes_path[path]
                                         del inodes[inode]
                                         
@@ -648,33 +1322,12 @@ class Loggy(Thread):
                                 elif u'IN_CLOSE_WRITE' in masks and path in filehandles:
                                 #    print(path + " truncated!")
                                     filehandles[path].seek(0,2)
+                                    partial.pop(path, None)
+                                    checkpoint.reset(path, filehandles[path])
                                     
                                 # File contents modified?
                                 elif u'IN_MODIFY' in masks and path in filehandles:
-                              #      print(path + " was modified")
-                                    rd = 0
-                                    data = ""
-                                    #print("Change in " + path)
-                                    try:
-                                        while True:
-                                            line = filehandles[path].readline()
-                                            if not line:
-                                                #filehandles[path].seek(0,2)
-                                                break
-                                            else:
-                                                rd += len(line)
-                                                data += line
-                                        #print("Read %u bytes from %s" % (rd, path))
-                                        parseLine(path, data)
-                                    except Exception as err:
-                                        try:
-                                            print("Could not utilize " + path + ", closing.." + err)
-                                            filehandles[path].close()
-                                        except Exception as err:
-                                            print(err)
-                                        del filehandles[path]
-                                        inode = inodes_path[path]
-                                        del inodes[inode]
+                                    dirty.add(path)
                                 
                                 
                                 # File deleted? (close handle)
@@ -686,6 +1339,9 @@ class Loggy(Thread):
                                         except Exception as err:
                                             print(err)
                                         del filehandles[path]
+                                        partial.pop(path, None)
+                                        checkpoint.forget(path)
+                                        forgetFormat(path)
                                         inode = inodes_path[path]
                                         del inodes[inode]
                                         print("Stopped watching " + path)
@@ -696,17 +1352,14 @@ class Loggy(Thread):
                         except Exception as err:
                             print(err)
                             
+                for path in dirty:
+                    if path in filehandles:
+                        self.readOrClose(path, inodes, inodes_path)
+                dirty.clear()
             
-                for x in json_pending:
-                    if (time.time() > (last_push[x] + 15)) or len(json_pending[x]) >= 500:
-                        if not x in fp:
-                            fp[x] = True
-                            print("First push for " + x + "!")
-                        t = NodeThread()
-                        t.assign(json_pending[x], x, xes)
-                        t.start()
-                        json_pending[x] = []
-                        last_push[x] = time.time()
+                flushPending(shipper)
+                checkpoint.save()
+                logStats(shipper)
                     
                 if nread:
                     #print('plugging back in')
@@ -718,7 +1371,7 @@ class Loggy(Thread):
                     poll.unregister(w)
         
         if osname == "freebsd":
-            xes = connect_es(config)
+            shipper = Shipper(connect_es(config))
             observer = Observer()
             for path in paths:
                 observer.schedule(BSDHandler(), path, recursive=True)
@@ -726,18 +1379,9 @@ class Loggy(Thread):
             observer.start()
             try:
                 while True:
-                    for x in json_pending:
-                        if not x in last_push:
-                            last_push[x] = time.time()
-                        if len(json_pending[x]) > 0 and ((time.time() > (last_push[x] + 15)) or len(json_pending[x]) >= 500):
-                            if not x in fp:
-                                fp[x] = True
-                                syslog.syslog(syslog.LOG_INFO, "First push for " + x + "!")
-                            t = NodeThread()
-                            t.assign(json_pending[x], x, xes)
-                            t.start()
-                            json_pending[x] = []
-                            last_push[x] = time.time()
+                    flushPending(shipper)
+                    checkpoint.save()
+                    logStats(shipper)
                     time.sleep(0.5)
                     
             except KeyboardInterrupt:
@@ -758,13 +1402,36 @@ parser.add_argument('--daemonize', dest='daemon', action='store_true',
                    help='Run as a daemon')
 parser.add_argument('--stop', dest='kill', action='store_true',
                    help='Kill the currently running Loggy process')
+parser.add_argument('--benchmark', dest='benchmark', type=int, nargs=1,
+                   help='Parse this many synthetic access log lines, report lines/sec and exit')
+parser.add_argument('--parsers', dest='parsers', type=int, nargs=1,
+                   help='Number of parse processes to use (overrides Analyzer.parsers in loggy.cfg)')
 args = parser.parse_args()
 
 pidfile = "/var/run/loggy.pid"
 if args.pidfile and len(args.pidfile) > 2:
     pidfile = args.pidfile
 
+def shutdown(signum = None, frame = None):
+    """Ships whatever is still buffered and saves the read offsets, on
+    SIGTERM and at exit. Lines not shipped by then are read again on the
+    next start."""
+    global stopping
+    if stopping or os.getpid() != mainpid:
+        return
+    stopping = True
+    if shipper:
+        flushPending(shipper, force = True)
+        shipper.drain(30)
+    if checkpoint:
+        checkpoint.save(force = True)
+    if signum:
+        sys.exit(0)
+
+
 def main():
+    global mainpid
+    mainpid = os.getpid()
     
     if args.group and len(args.group) > 0:
         gid = grp.getgrnam(args.group[0])
@@ -776,16 +1443,51 @@ def main():
         os.setuid(uid)
     
     loggy = Loggy()
+    loggy.daemon = True
+    signal.signal(signal.SIGTERM, shutdown)
+    atexit.register(shutdown)
     loggy.start()
+    # Wait with a timeout, so that signals get handled
+    while loggy.is_alive():
+        loggy.join(1)
     
     
+def benchmark(nlines, workers):
+    """Measures parse throughput (lines/sec) on a synthetic access log,
+    optionally spread over a ParsePool."""
+    lines = []
+    for i in range(1000):
+        lines.append('10.%u.%u.%u - - [18/Oct/2016:12:%02u:%02u +0000] '
+                     '"GET /dist/project/%u/index.html HTTP/1.1" %u %u '
+                     '"https://www.apache.org/" "Mozilla/5.0 (X11; Linux x86_64)"' %
+                     (i % 7, i % 251, i % 13, i % 60, i % 59, i, 304 if i % 5 else 200, i * 17))
+    data = "\n".join(lines) + "\n"
+    rounds = max(1, nlines // len(lines))
+    if workers:
+        pool = ParsePool(workers, lambda logtype, docs, size, marks: None)
+        start = time.time()
+        for i in range(rounds):
+            pool.submit('/var/log/apache2/access-%u.log' % (i % (workers * 4)), data)
+        while pool.done() < rounds:
+            time.sleep(0.01)
+        pool.stop()
+    else:
+        start = time.time()
+        for i in range(rounds):
+            groupDocs(lineparser, '/var/log/apache2/access.log', data)
+    spent = max(time.time() - start, 0.000001)
+    print("Parsed %u lines in %.2f seconds (%u lines/sec)" % (rounds * len(lines), spent, (rounds * len(lines)) / spent))
+
+
 ## Daemon class
 class MyDaemon(Daemonize):
     def run(self, args):
         main()
     
 # Get started!
-if args.kill:
+if args.benchmark:
+    benchmark(args.benchmark[0], args.parsers[0] if args.parsers else 0)
+elif args.kill:
     print("Stopping Loggy")
     daemon = MyDaemon(pidfile)
     daemon.stop()
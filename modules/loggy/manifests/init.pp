@@ -35,6 +35,11 @@ class loggy (
       mode   => '0755',
       owner  => $username,
       group  => $group;
+    '/var/spool/loggy':
+      ensure => directory,
+      mode   => '0750',
+      owner  => $username,
+      group  => $group;
     '/etc/init.d/loggy':
       mode   => '0755',
       owner  => $username,
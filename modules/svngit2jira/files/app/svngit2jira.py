@@ -6,8 +6,9 @@
 # Built for Python 3, works with 2.7 with a few tweaks     #
 ############################################################
 
-from threading import Thread
+from threading import Thread, Lock
 from datetime import datetime
+from collections import OrderedDict
 import requests
 import sys
 haveinotify = False
@@ -201,6 +202,32 @@ def read_chunk(req):
 
 
 
+# ldapName: looks up the full name (cn) of an ASF uid, remembering
+# the answer (including "no such person") for a while
+LDAP_CACHE_SIZE = 1000
+LDAP_CACHE_TTL = 3600
+ldapCache = OrderedDict()
+ldapLock = Lock()
+
+def ldapName(uid):
+    now = time.time()
+    with ldapLock:
+        if uid in ldapCache:
+            cn, when = ldapCache.pop(uid)
+            if now - when < LDAP_CACHE_TTL:
+                ldapCache[uid] = (cn, when) # most recently used go last
+                return cn
+    ldapdata = subprocess.check_output(['ldapsearch', '-xLLL', 'uid=%s' % uid, 'cn'])
+    m = re.search(r"cn: ([^\r\n]+)", ldapdata.decode('ascii', 'replace'))
+    cn = m.group(1) if m else None
+    with ldapLock:
+        ldapCache[uid] = (cn, now)
+        while len(ldapCache) > LDAP_CACHE_SIZE:
+            ldapCache.popitem(last = False)
+    return cn
+
+
+
 ################
 # JIRA Updater #
 ################
@@ -226,10 +253,9 @@ class JiraTicket:
                 # Only run this stuff if the uid is actually an Apache uid
                 if re.match("^([a-z0-9]+)$", self.asfuid):
                     try:
-                        ldapdata = subprocess.check_output(['ldapsearch', '-xLLL', 'uid=%s' % self.asfuid, 'cn'])
-                        m = re.search(r"cn: ([^\r\n]+)", ldapdata.decode('ascii', 'replace'))
-                        if m:
-                            self.sender = m.group(1)
+                        cn = ldapName(self.asfuid)
+                        if cn:
+                            self.sender = cn
                             self.sendIt = True
                     except Exception as info:
                         logging.warning("LDAP error: %s", info)
@@ -432,38 +458,35 @@ class PubSubClient(Thread):
                             server = commit['server'] if 'server' in commit else 'git-wip-us'
 
                             # Find out if this is a project we're tracking
-                            for section in config.sections():
-                                if config.has_option(section, "trigger") and config.has_option(section, "git"):
-                                    trigger = config.get(section, "trigger")
-                                    match = config.get(section, "git")
-                                    # If a tracking channel's git value matches, then...
-                                    if re.match("^" + match + "$", project) and not (config.has_option(section, 'ignoredBranches') and re.match(config.get(section, 'ignoredBranches'), ref)):
-                                        logging.info("Git path for %s matches, seeing if %s matches the body" % (section, trigger))
-                                        doWorkLog = True if (config.has_option(section, 'worklog') and config.get(section, 'worklog') == "true") else False
-                                        # For each ticket reference we find, ...
-                                        for ticket in re.finditer(trigger, body):
-                                            logging.info("Found: " + ticket.group(0) + " in body, updating ticket")
-
-                                            # We're about to make a JIRA update!
-                                            jira = JiraTicket(ticket.group(0), author, email)
-
-
-                                            # Create a JSON object and RB body for sending
-                                            data = None;
-                                            if doWorkLog:
-                                                data = {'timeSpent': "10m", 'comment': "Commit %s in %s's branch %s from %s\n[ https://%s.apache.org/repos/asf?p=%s.git;h=%s ]\n\n%s" % (sha, project, ref, jira.sender, server, project, ssha, body) }
-                                            else:
-                                                data = {'body': "Commit %s in %s's branch %s from %s\n[ https://%s.apache.org/repos/asf?p=%s.git;h=%s ]\n\n%s" % (sha, project, ref, jira.sender, server, project, ssha, body) }
-
-                                            rb_data = "Commit %s in %s's branch %s from %s\n[ https://%s.apache.org/repos/asf?p=%s.git;h=%s ]\n\n%s" % (sha, project, ref, author, server, project, ssha, body)
-
-                                            # Update the ticket
-                                            jira.update(json.dumps(data), 'worklog' if doWorkLog else 'comment')
-
-                                            # Send to ReviewBoard if set to check that
-                                            if config.has_option(section, 'reviewboard') and config.get(section, 'reviewboard') == "true":
-                                                rb = ReviewBoard(ticket.group(0))
-                                                rb.update(rb_data)
+                            for tracker in trackers.forGit(project, ref):
+                                section = tracker.section
+                                trigger = tracker.trigger
+                                logging.info("Git path for %s matches, seeing if %s matches the body" % (section, trigger))
+                                doWorkLog = tracker.worklog
+                                # For each ticket reference we find, ...
+                                for ticket in tracker.gitTrigger.finditer(body):
+                                    logging.info("Found: " + ticket.group(0) + " in body, updating ticket")
+
+                                    # We're about to make a JIRA update!
+                                    jira = JiraTicket(ticket.group(0), author, email)
+
+
+                                    # Create a JSON object and RB body for sending
+                                    data = None;
+                                    if doWorkLog:
+                                        data = {'timeSpent': "10m", 'comment': "Commit %s in %s's branch %s from %s\n[ https://%s.apache.org/repos/asf?p=%s.git;h=%s ]\n\n%s" % (sha, project, ref, jira.sender, server, project, ssha, body) }
+                                    else:
+                                        data = {'body': "Commit %s in %s's branch %s from %s\n[ https://%s.apache.org/repos/asf?p=%s.git;h=%s ]\n\n%s" % (sha, project, ref, jira.sender, server, project, ssha, body) }
+
+                                    rb_data = "Commit %s in %s's branch %s from %s\n[ https://%s.apache.org/repos/asf?p=%s.git;h=%s ]\n\n%s" % (sha, project, ref, author, server, project, ssha, body)
+
+                                    # Update the ticket
+                                    jira.update(json.dumps(data), 'worklog' if doWorkLog else 'comment')
+
+                                    # Send to ReviewBoard if set to check that
+                                    if tracker.reviewboard:
+                                        rb = ReviewBoard(ticket.group(0))
+                                        rb.update(rb_data)
 
                         # If it's not git (and not JIRA), it must be subversion
                         elif obj['commit']['repository'] == "13f79535-47bb-0310-9956-ffa450edef68":
@@ -477,54 +500,50 @@ class PubSubClient(Thread):
                             email = svnuser + "@apache.org"
 
                             # Look for a tracker that matches the svn path..
-                            for section in config.sections():
-                                if config.has_option(section, "trigger") and config.has_option(section, "svn"):
-                                    trigger = config.get(section, "trigger")
-                                    match = config.get(section, "svn")
-
-                                    # If a tracker's svn path matches, then...
-                                    if re.match("^" + match + "/", path):
-                                        logging.info("SVN path for %s matches, seeing if %s matches the body" % (section, trigger))
-                                        doWorkLog = True if (config.has_option(section, 'worklog') and config.get(section, 'worklog') == "true") else False
-                                        # For each found ticket reference, do...
-                                        usedTickets = []
-                                        for ticket in re.finditer(r"\b" + trigger, body):
-                                            if ticket.group(1) in usedTickets:
-                                                logging.info("Found duplicate: " + ticket.group(1) + " in body, not updating ticket")
-                                                continue
-                                            logging.info("Found: " + ticket.group(1) + " in body, updating ticket")
-                                            usedTickets.append(ticket.group(1))
-                                            # We're about to make a JIRA update!
-                                            # First, let's find the sender's JIRA account, if such exists
-                                            jira = JiraTicket(ticket.group(1), None, email, svnuser)
-
-                                            # Create a JSON object for sending
-                                            data = None
-                                            if doWorkLog:
-                                                data = {'timeSpent': "10m", 'comment': "Commit %s from %s\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, revision, body) }
-                                            else:
-                                                data = {'body': "Commit %s from %s\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, revision, body) }
-
-                                            rb_data = "Commit %s from %s\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, email, revision, body)
-
-                                            # Are we dealing with a branch? If so, change the ticket data slightly
-                                            branch = re.search(r"(\w+/branches/[^/]+)", path)
-                                            if not branch:
-                                                branch = re.search(r"(\w+/trunk)", path)
-
-                                            if branch:
-                                                if doWorkLog:
-                                                    data['comment'] = "Commit %s from %s in branch '%s'\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, branch.group(1), revision, body)
-                                                else:
-                                                    data['body'] = "Commit %s from %s in branch '%s'\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, branch.group(1), revision, body)
-
-                                            # Send the ticket update
-                                            jira.update(json.dumps(data), 'worklog' if doWorkLog else 'comment')
-
-                                            # Send to ReviewBoard if set to check that
-                                            if config.has_option(section, 'reviewboard') and config.get(section, 'reviewboard') == "true":
-                                                rb = ReviewBoard(ticket.group(1))
-                                                rb.update(rb_data)
+                            for tracker in trackers.forSvn(path):
+                                section = tracker.section
+                                trigger = tracker.trigger
+                                logging.info("SVN path for %s matches, seeing if %s matches the body" % (section, trigger))
+                                doWorkLog = tracker.worklog
+                                # For each found ticket reference, do...
+                                usedTickets = []
+                                for ticket in tracker.svnTrigger.finditer(body):
+                                    if ticket.group(1) in usedTickets:
+                                        logging.info("Found duplicate: " + ticket.group(1) + " in body, not updating ticket")
+                                        continue
+                                    logging.info("Found: " + ticket.group(1) + " in body, updating ticket")
+                                    usedTickets.append(ticket.group(1))
+                                    # We're about to make a JIRA update!
+                                    # First, let's find the sender's JIRA account, if such exists
+                                    jira = JiraTicket(ticket.group(1), None, email, svnuser)
+
+                                    # Create a JSON object for sending
+                                    data = None
+                                    if doWorkLog:
+                                        data = {'timeSpent': "10m", 'comment': "Commit %s from %s\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, revision, body) }
+                                    else:
+                                        data = {'body': "Commit %s from %s\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, revision, body) }
+
+                                    rb_data = "Commit %s from %s\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, email, revision, body)
+
+                                    # Are we dealing with a branch? If so, change the ticket data slightly
+                                    branch = re.search(r"(\w+/branches/[^/]+)", path)
+                                    if not branch:
+                                        branch = re.search(r"(\w+/trunk)", path)
+
+                                    if branch:
+                                        if doWorkLog:
+                                            data['comment'] = "Commit %s from %s in branch '%s'\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, branch.group(1), revision, body)
+                                        else:
+                                            data['body'] = "Commit %s from %s in branch '%s'\n[ https://svn.apache.org/r%s ]\n\n%s" % (revision, jira.sender, branch.group(1), revision, body)
+
+                                    # Send the ticket update
+                                    jira.update(json.dumps(data), 'worklog' if doWorkLog else 'comment')
+
+                                    # Send to ReviewBoard if set to check that
+                                    if tracker.reviewboard:
+                                        rb = ReviewBoard(ticket.group(1))
+                                        rb.update(rb_data)
                 except Exception as detail:
                     logging.warning("Bad JSON or something: %s" % detail)
             logging.warning("Disconnected from %s, reconnecting" % self.url)
@@ -532,10 +551,103 @@ class PubSubClient(Thread):
 
 
 
+#################
+# Tracker index #
+#################
+
+# A tracking channel, with its patterns compiled
+class Tracker:
+    def __init__(self, section):
+        self.section = section
+        self.trigger = config.get(section, "trigger")
+        self.gitTrigger = re.compile(self.trigger)
+        self.svnTrigger = re.compile(r"\b" + self.trigger)
+        self.git = re.compile("^" + config.get(section, "git") + "$") if config.has_option(section, "git") else None
+        self.svn = re.compile("^" + config.get(section, "svn") + "/") if config.has_option(section, "svn") else None
+        self.ignoredBranches = re.compile(config.get(section, 'ignoredBranches')) if config.has_option(section, 'ignoredBranches') else None
+        self.worklog = config.has_option(section, 'worklog') and config.get(section, 'worklog') == "true"
+        self.reviewboard = config.has_option(section, 'reviewboard') and config.get(section, 'reviewboard') == "true"
+
+
+# hasAlternation: whether a pattern has a | outside of any group, so that
+# it matches things that don't start like it does
+def hasAlternation(pattern):
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 1  # skip whatever is escaped
+        elif c == '[':
+            # Skip the character class; a ] right at its start is literal
+            i += 2 if pattern[i + 1:i + 2] == '^' else 1
+            if pattern[i:i + 1] == ']':
+                i += 1
+            while i < len(pattern) and pattern[i] != ']':
+                i += 2 if pattern[i] == '\\' else 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+# literalPrefix: the part of a pattern that any match has to start with
+def literalPrefix(pattern):
+    if hasAlternation(pattern):
+        return ""
+    m = re.match(r"[^.^$*+?{}\[\]\\|()]*", pattern)
+    prefix = m.group(0)
+    # A quantifier applies to the character before it, which may then be missing
+    if pattern[len(prefix):len(prefix) + 1] in ('*', '?', '{'):
+        prefix = prefix[:-1]
+    return prefix
+
+
+# Index of the tracking channels by the literal prefix of their git and svn
+# patterns, so a commit only gets matched against the channels it could be for
+class TrackerIndex:
+    def __init__(self):
+        self.git = {}
+        self.svn = {}
+        for seq, section in enumerate(config.sections()):
+            if not config.has_option(section, "trigger"):
+                continue
+            try:
+                tracker = Tracker(section)
+            except Exception as info:
+                logging.warning("Could not compile tracker %s: %s", section, info)
+                continue
+            if tracker.git:
+                self.git.setdefault(literalPrefix(config.get(section, "git")), []).append((seq, tracker))
+            if tracker.svn:
+                self.svn.setdefault(literalPrefix(config.get(section, "svn")), []).append((seq, tracker))
+
+    def lookup(self, index, name):
+        found = []
+        for i in range(len(name) + 1):
+            found += index.get(name[:i], [])
+        return [tracker for seq, tracker in sorted(found, key = lambda entry: entry[0])]
+
+    def forGit(self, project, ref):
+        return [tracker for tracker in self.lookup(self.git, project)
+                if tracker.git.match(project) and not (tracker.ignoredBranches and tracker.ignoredBranches.match(ref))]
+
+    def forSvn(self, path):
+        return [tracker for tracker in self.lookup(self.svn, path) if tracker.svn.match(path)]
+
+trackers = TrackerIndex()
+
+
+
 ##########################
 # Configuration reloader #
 ##########################
 def updateConfig():
+    global trackers
     logging.info("Configuration was updated, reloading")
 
     # Remove all tracking sections (we'll reload them in a bit)
@@ -545,6 +657,7 @@ def updateConfig():
 
     # Re-read config
     config.read(path + '/svngit2jira.cfg')
+    trackers = TrackerIndex()
     projects = []
     for section in config.sections():
         match = re.match("Tracking:(.+)", section)
@@ -591,22 +704,7 @@ def main():
             xmodded = os.stat(path + '/svngit2jira.cfg').st_mtime
             if xmodded != modded:
                 modded = xmodded
-                logging.info("Configuration was updated, reloading")
-
-                # Remove all tracking sections (we'll reload them in a bit)
-                for section in config.sections():
-                    if re.match("Tracking:(.+)", section):
-                        config.remove_section(section)
-
-                # Re-read config
-                config.read(path + '/svngit2jira.cfg')
-                projects = []
-                for section in config.sections():
-                    match = re.match("Tracking:(.+)", section)
-                    if match:
-                        projects.append(match.group(1))
-                projects.sort()
-                logging.info("Found the following trackers: %s", ', '.join(projects))
+                updateConfig()
 
 
 ##############